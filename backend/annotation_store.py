@@ -0,0 +1,200 @@
+import contextlib
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import cv2
+import numpy as np
+from model_clean import preprocess_image
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sha256 TEXT NOT NULL UNIQUE,
+    image_path TEXT NOT NULL,
+    mask_path TEXT NOT NULL,
+    thumbnail_path TEXT NOT NULL,
+    tensor_path TEXT NOT NULL,
+    original_filename TEXT,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    tumor_pixels INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    shard_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS annotations_shard ON annotations (shard_id);
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    path TEXT NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is None:
+        raise ValueError("Could not decode image data")
+    return image
+
+
+class AnnotationStore:
+    """Content-addressed store of annotated images and masks with a SQLite index
+
+    Each ingested pair is deduplicated by content hash, and a thumbnail and a
+    preprocessed training tensor are generated once at ingestion time. New
+    pairs are exported to incremental .npz shards so retraining only reads
+    data it has not seen.
+    """
+
+    def __init__(self, root='dataset', image_size=256, thumbnail_size=64):
+        self.root = root
+        self.image_size = image_size
+        self.thumbnail_size = thumbnail_size
+        for directory in ('images', 'masks', 'thumbnails', 'tensors', 'shards'):
+            os.makedirs(os.path.join(root, directory), exist_ok=True)
+        self.db_path = os.path.join(root, 'index.db')
+        self._export_lock = threading.Lock()
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def content_hash(image_bytes, mask_bytes):
+        """Hash of the image and mask contents; identical pairs get the same key"""
+        digest = hashlib.sha256(hashlib.sha256(image_bytes).digest())
+        digest.update(hashlib.sha256(mask_bytes).digest())
+        return digest.hexdigest()
+
+    def get(self, annotation_id=None, sha256=None):
+        with self._connect() as db:
+            if sha256 is not None:
+                row = db.execute('SELECT * FROM annotations WHERE sha256 = ?', (sha256,)).fetchone()
+            else:
+                row = db.execute('SELECT * FROM annotations WHERE id = ?', (annotation_id,)).fetchone()
+        return dict(row) if row else None
+
+    def ingest(self, image_bytes, mask_bytes, filename=None):
+        """Store an annotated pair; returns (record, created) where created is False for duplicates"""
+        sha = self.content_hash(image_bytes, mask_bytes)
+        existing = self.get(sha256=sha)
+        if existing is not None:
+            return existing, False
+
+        image = cv2.cvtColor(decode_image(image_bytes), cv2.COLOR_BGR2RGB)
+        mask = decode_image(mask_bytes, cv2.IMREAD_GRAYSCALE)
+
+        # Training tensors: the model input (stored as uint8, it is a /255 scaling of uint8 data) and a binary mask
+        tensor_image = np.round(preprocess_image(image)[0] * 255).astype(np.uint8)
+        size = (self.image_size, self.image_size)
+        tensor_mask = (cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST) > 127).astype(np.uint8)[..., np.newaxis]
+
+        extension = os.path.splitext(filename or '')[1].lower() or '.png'
+        paths = {
+            'image_path': os.path.join(self.root, 'images', sha + extension),
+            'mask_path': os.path.join(self.root, 'masks', sha + '.png'),
+            'thumbnail_path': os.path.join(self.root, 'thumbnails', sha + '.png'),
+            'tensor_path': os.path.join(self.root, 'tensors', sha + '.npz')
+        }
+        _write_atomic(paths['image_path'], image_bytes)
+        _write_atomic(paths['mask_path'], cv2.imencode('.png', mask)[1].tobytes())
+        thumbnail = cv2.resize(image, (self.thumbnail_size, self.thumbnail_size), interpolation=cv2.INTER_AREA)
+        _write_atomic(paths['thumbnail_path'], cv2.imencode('.png', cv2.cvtColor(thumbnail, cv2.COLOR_RGB2BGR))[1].tobytes())
+        tensor_tmp = paths['tensor_path'] + '.tmp.npz'
+        np.savez_compressed(tensor_tmp, image=tensor_image, mask=tensor_mask)
+        os.replace(tensor_tmp, paths['tensor_path'])
+
+        with self._connect() as db:
+            db.execute(
+                'INSERT OR IGNORE INTO annotations (sha256, image_path, mask_path, thumbnail_path, tensor_path, '
+                'original_filename, width, height, tumor_pixels, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (sha, paths['image_path'], paths['mask_path'], paths['thumbnail_path'], paths['tensor_path'],
+                 filename, image.shape[1], image.shape[0], int(np.count_nonzero(mask > 127)), time.time())
+            )
+        logger.info(f"Ingested annotation {sha[:12]}")
+        return self.get(sha256=sha), True
+
+    def pending(self):
+        """Annotations that have not been exported to a shard yet"""
+        with self._connect() as db:
+            rows = db.execute('SELECT * FROM annotations WHERE shard_id IS NULL ORDER BY id').fetchall()
+        return [dict(row) for row in rows]
+
+    def export_shard(self):
+        """Write all pending annotations into a new .npz shard; returns the shard record or None"""
+        with self._export_lock:
+            return self._export_shard()
+
+    def _export_shard(self):
+        records = self.pending()
+        if not records:
+            return None
+
+        images, masks = [], []
+        for record in records:
+            with np.load(record['tensor_path']) as tensors:
+                images.append(tensors['image'])
+                masks.append(tensors['mask'])
+
+        with self._connect() as db:
+            cursor = db.execute(
+                'INSERT INTO shards (path, first_id, last_id, count, created_at) VALUES (?, ?, ?, ?, ?)',
+                ('', records[0]['id'], records[-1]['id'], len(records), time.time())
+            )
+            shard_id = cursor.lastrowid
+            path = os.path.join(self.root, 'shards', f'shard-{shard_id:05d}.npz')
+            np.savez(path, ids=np.array([r['id'] for r in records]), image=np.stack(images), mask=np.stack(masks))
+            db.execute('UPDATE shards SET path = ? WHERE id = ?', (path, shard_id))
+            db.executemany('UPDATE annotations SET shard_id = ? WHERE id = ?', [(shard_id, r['id']) for r in records])
+
+        logger.info(f"Exported {len(records)} annotations to {path}")
+        return self.shard(shard_id)
+
+    def shard(self, shard_id):
+        with self._connect() as db:
+            row = db.execute('SELECT * FROM shards WHERE id = ?', (shard_id,)).fetchone()
+        return dict(row) if row else None
+
+    def shards(self, after_id=0):
+        """Shards created after the given shard id, oldest first"""
+        with self._connect() as db:
+            rows = db.execute('SELECT * FROM shards WHERE id > ? ORDER BY id', (after_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def load_shard(path):
+        """Return (images, masks) of a shard as float32 arrays ready for training"""
+        with np.load(path) as shard:
+            return shard['image'].astype(np.float32) / 255.0, shard['mask'].astype(np.float32)
+
+    def stats(self):
+        with self._connect() as db:
+            total, pending = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(shard_id IS NULL), 0) FROM annotations'
+            ).fetchone()
+            shards = db.execute('SELECT COUNT(*) FROM shards').fetchone()[0]
+        return {'annotations': total, 'pending': pending, 'shards': shards}
@@ -1,22 +1,45 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 import cv2
 import numpy as np
-import tensorflow as tf
-from model import CustomModel, focal_tversky, tversky
-import io
 from PIL import Image
 import base64
 from flask_cors import CORS
 import pydicom
-import nibabel as nib
 import gzip
 import shutil
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.layers import Input
 import logging
-from model_clean import ResUNet, preprocess_image, postprocess_mask
+import tracemalloc
+import time
+import uuid
+import functools
+import hmac
+import json
+import queue
+import threading
+import weakref
+from model_clean import normalize_to_uint8, preprocess_image, postprocess_mask
+from cascade import CascadePipeline, load_classifier
+from dicomweb import SeriesQueue, check_uid, store_instances, stow_response
+from early_exit import FULL, SliceGate, downsample
+from history import PredictionHistory
+from lesions import analyze_lesions
+from mask_export import EXPORT_FORMATS
+from mask_geometry import mask_geometry
+from profiler import ContinuousProfiler, ProfileCapture
+from volume import expand_context, mask_to_nifti, segment_file, segment_volume
+from registry import ModelRegistry, ModelManager
+from scheduler import InferenceScheduler, QuotaExceeded, ScheduledModel
+from annotation_store import AnnotationStore
+from finetune import FineTuneJob
+from gzip_index import close_nifti, open_nifti
+from singleflight import SingleFlight, content_digest
+from memory import (LimitExceeded, MemoryProfile, MemoryStats, check_voxels, configure_allocator,
+                    configure_tensorflow, release_memory)
 
 # Configure logging
 logging.basicConfig(
@@ -28,45 +51,84 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Behind reverse proxies, take the client address from the X-Forwarded-For entries they add, so scheduler
+# quotas apply per client rather than to the proxy's address
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
 # Configure upload folder
 UPLOAD_FOLDER = 'uploads'
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Annotated images and masks, indexed by content hash
+ANNOTATION_STORE = os.environ.get('ANNOTATION_STORE', 'dataset')
+annotation_store = AnnotationStore(ANNOTATION_STORE)
+
+# Memory limits: oversized uploads are rejected by Flask before the body is read,
+# oversized images and volumes before their pixel data is decoded
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('MAX_UPLOAD_MB', 50)) * 1024 * 1024)
+MAX_VOLUME_VOXELS = int(os.environ.get('MAX_VOLUME_VOXELS', 256 * 512 * 512))
+MEMORY_PROFILING = os.environ.get('MEMORY_PROFILING', '0') == '1'
+if MEMORY_PROFILING:
+    tracemalloc.start()
+memory_stats = MemoryStats()
+
+# Runtime threading and allocator settings
+configure_allocator(os.environ.get('MALLOC_ARENA_MAX'))
+configure_tensorflow(
+    intra_op_threads=int(os.environ.get('TF_INTRA_OP_THREADS', 0)),
+    inter_op_threads=int(os.environ.get('TF_INTER_OP_THREADS', 0))
+)
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'dcm', 'nii', 'nii.gz', 'dicom', 'jpg', 'jpeg', 'png'}
+VOLUME_EXTENSIONS = {'dcm', 'dicom', 'nii', 'nii.gz'}
+
+def file_extension(filename):
+    """Lower-case extension, keeping the double extension of gzipped NIfTI files"""
+    filename = filename.lower()
+    if filename.endswith('.nii.gz'):
+        return 'nii.gz'
+    return filename.rsplit('.', 1)[1] if '.' in filename else ''
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    return file_extension(filename) in ALLOWED_EXTENSIONS
 
-def read_image(file_path):
-    """Read image based on file extension"""
-    extension = file_path.split('.')[-1].lower()
+def decode_image(file_path, max_voxels=None, digest=None):
+    """Decode an upload to a uint8 grayscale or RGB image; digest is the file's SHA-256, if known"""
+    extension = file_extension(file_path)
     
     if extension in ['dcm', 'dicom']:
+        # Check the size from the header before decoding the pixel data
+        header = pydicom.dcmread(file_path, stop_before_pixels=True)
+        check_voxels((header.Rows, header.Columns, int(header.get('NumberOfFrames', 1) or 1)), max_voxels)
         # Read DICOM
         ds = pydicom.dcmread(file_path)
         image = ds.pixel_array
         # Normalize DICOM image
-        image = ((image - image.min()) / (image.max() - image.min()) * 255).astype(np.uint8)
+        image = normalize_to_uint8(np.array(image, dtype=np.float32))
     elif extension in ['nii', 'nii.gz']:
-        # Read NIfTI
-        if extension == 'nii.gz':
-            with gzip.open(file_path, 'rb') as f_in:
-                with open(file_path[:-3], 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
-            nii_path = file_path[:-3]
-        else:
-            nii_path = file_path
-        
-        img = nib.load(nii_path)
-        image = img.get_fdata()
-        if len(image.shape) == 3:
-            image = image[:, :, image.shape[2]//2]
+        # Read NIfTI; gzipped files are read through a seek index instead of being decompressed to disk
+        img = open_nifti(file_path, key=digest)
+        try:
+            check_voxels(img.shape, max_voxels)
+            # Read only the middle slice through the array proxy instead of the whole float64 volume
+            if len(img.shape) == 3:
+                image = np.asarray(img.dataobj[:, :, img.shape[2]//2], dtype=np.float32)
+            else:
+                image = np.asarray(img.dataobj, dtype=np.float32)
+        finally:
+            # The upload is deleted after the request, which fails on Windows while it is open
+            close_nifti(img)
         # Normalize NIfTI image
-        image = ((image - image.min()) / (image.max() - image.min()) * 255).astype(np.uint8)
+        image = normalize_to_uint8(image)
     else:
+        # Check the dimensions from the header before decoding
+        with Image.open(file_path) as header:
+            check_voxels(header.size, max_voxels)
         # Read regular image formats
         image = cv2.imread(file_path)
         if image is None:
@@ -75,7 +137,10 @@ def read_image(file_path):
     # Convert to RGB if needed
     if len(image.shape) == 3 and image.shape[2] == 3:
         image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
+    return image
+
+def enhance_image(image):
+    """Resize a decoded image to at most 256 pixels and enhance its contrast for segmentation and display"""
     # Maintain aspect ratio while resizing
     if len(image.shape) == 2:
         h, w = image.shape
@@ -119,42 +184,258 @@ def read_image(file_path):
     
     return image
 
-# Load the model
+# Model calls wait for a slot in a priority lane: interactive single images ahead of bulk volume batches
+inference_scheduler = InferenceScheduler(
+    {'interactive': int(os.environ.get('SCHEDULER_INTERACTIVE_WEIGHT', 8)),
+     'bulk': int(os.environ.get('SCHEDULER_BULK_WEIGHT', 1))},
+    slots=int(os.environ.get('SCHEDULER_SLOTS', 1)),
+    max_pending=int(os.environ.get('SCHEDULER_CLIENT_QUOTA', 8))
+)
+
+# Load the active model version from the local registry
 logger.info("Loading model...")
-model = ResUNet()
-logger.info("Model loaded successfully")
+registry = ModelRegistry(os.environ.get('MODEL_REGISTRY', 'models'))
+optimize_model = None
+if os.environ.get('OPTIMIZED_INFERENCE', '0') == '1':
+    # Serve folded-decoder copies of each version, in bfloat16 where the CPU supports it
+    from functools import partial
+    from optimized_inference import build_optimized_model
+    optimize_model = partial(build_optimized_model, precision=os.environ.get('INFERENCE_PRECISION', 'auto'))
+
+def serve_model(model):
+    if optimize_model is not None:
+        model = optimize_model(model)
+    return ScheduledModel(model, inference_scheduler)
+
+model_manager = ModelManager(registry, optimize=serve_model)
+model_manager.start()
+logger.info(f"Model version {model_manager.select()[0]} loaded successfully")
+
+# Background fine-tuning on new annotations; published versions can be activated automatically
+FINETUNE_AUTO_ACTIVATE = os.environ.get('FINETUNE_AUTO_ACTIVATE', '0') == '1'
+finetune_job = FineTuneJob(
+    os.path.join(registry.root, 'finetune_status.json'),
+    on_published=model_manager.activate if FINETUNE_AUTO_ACTIVATE else None
+)
+
+# Classify-then-segment cascade: the cheap classifier gates the segmentation model
+CLASSIFIER_BACKBONE = os.environ.get('CLASSIFIER_BACKBONE', 'resnet50')
+CASCADE_THRESHOLD = float(os.environ.get('CASCADE_THRESHOLD', 0.2))
+cascade = None
+if os.environ.get('CASCADE_ENABLED', '1') == '1':
+    # The classifier module (and its Keras applications) is only imported when the cascade is enabled
+    from model import classifier_weights_path
+    CLASSIFIER_WEIGHTS = os.environ.get('CLASSIFIER_WEIGHTS', classifier_weights_path(CLASSIFIER_BACKBONE))
+    if os.path.exists(CLASSIFIER_WEIGHTS):
+        logger.info("Loading classifier for cascade...")
+        classifier = load_classifier(CLASSIFIER_WEIGHTS, backbone=CLASSIFIER_BACKBONE)
+        cascade = CascadePipeline(classifier, threshold=CASCADE_THRESHOLD)
+        logger.info(f"Cascade enabled with threshold {CASCADE_THRESHOLD}")
+    else:
+        logger.warning(f"Classifier weights not found at {CLASSIFIER_WEIGHTS}, cascade disabled")
+
+# Client-side overlay rendering: polygon simplification tolerance (display pixels) and bitmask size
+OVERLAY_TOLERANCE = float(os.environ.get('OVERLAY_TOLERANCE', 1.0))
+OVERLAY_BITMASK_SIZE = int(os.environ.get('OVERLAY_BITMASK_SIZE', 64))
+
+# Early exit: skip the full-resolution U-Net on blank slices and on slices a low-resolution pass finds negative
+slice_gate = None
+if os.environ.get('EARLY_EXIT_ENABLED', '0') == '1':
+    slice_gate = SliceGate(
+        min_foreground=float(os.environ.get('EARLY_EXIT_MIN_FOREGROUND', 0.02)),
+        low_res_size=int(os.environ.get('EARLY_EXIT_LOW_RES_SIZE', 128)),
+        exit_threshold=float(os.environ.get('EARLY_EXIT_THRESHOLD', 0.2))
+    )
+    slice_gate.prepare(model_manager.select()[1])
+    logger.info("Early exit enabled")
+
+# STOW-RS ingestion: instances are spooled per series and a series is segmented once it stops receiving
+STOW_SPOOL = os.environ.get('STOW_SPOOL', 'stow_spool')
+STOW_RESULTS = os.environ.get('STOW_RESULTS', 'stow_results')
+# STOW bodies are streamed to disk part by part, so they get their own, larger limit than MAX_UPLOAD_MB
+STOW_MAX_BYTES = int(float(os.environ.get('STOW_MAX_MB', 2048)) * 1024 * 1024)
+
+def segment_series(volume, output_dir):
+    model_version, model = model_manager.select()
+    with inference_scheduler.context('bulk', 'dicomweb'):
+        mask, summary = segment_volume(model, volume, gate=slice_gate, export_dir=output_dir,
+                                       export_formats=tuple(EXPORT_FORMATS))
+    summary['model_version'] = model_version
+    return mask, summary
+
+series_queue = SeriesQueue(segment_series, STOW_RESULTS, idle_seconds=float(os.environ.get('SERIES_IDLE_SECONDS', 5)))
+
+# Exported volume masks (NIfTI, DICOM SEG) are kept for download for EXPORT_RETENTION_HOURS
+EXPORT_FOLDER = os.environ.get('EXPORT_FOLDER', 'exports')
+EXPORT_RETENTION_HOURS = float(os.environ.get('EXPORT_RETENTION_HOURS', 24))
+os.makedirs(EXPORT_FOLDER, exist_ok=True)
+
+def purge_exports():
+    cutoff = time.time() - EXPORT_RETENTION_HOURS * 3600
+    for name in os.listdir(EXPORT_FOLDER):
+        path = os.path.join(EXPORT_FOLDER, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+
+# Prediction log with per-day aggregates for the admin dashboard
+prediction_history = None
+if os.environ.get('HISTORY_ENABLED', '1') == '1':
+    prediction_history = PredictionHistory(
+        os.environ.get('HISTORY_DB', 'history.db'),
+        critical_percentage=float(os.environ.get('CRITICAL_TUMOR_PERCENTAGE', 5.0)),
+        store_masks=os.environ.get('HISTORY_STORE_MASKS', '1') == '1'
+    )
+
+# In-flight coalescing of identical /api/predict requests
+predictions_in_flight = SingleFlight()
+
+# Admin endpoints (profiling, model registration and rollout) need this token in X-Admin-Token or an Authorization: Bearer header
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def admin_required(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are disabled, set ADMIN_TOKEN to enable them'}), 403
+        token = request.headers.get('X-Admin-Token', '')
+        authorization = request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({'error': 'Invalid admin token'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+# On-demand TensorFlow trace + Python sampling profile captures, and optional always-on low-rate sampling
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', 'profiles')
+profile_captures = ProfileCapture(PROFILE_FOLDER, max_seconds=float(os.environ.get('PROFILE_MAX_SECONDS', 60)))
+continuous_profiler = None
+if os.environ.get('PROFILE_CONTINUOUS', '0') == '1':
+    continuous_profiler = ContinuousProfiler(
+        PROFILE_FOLDER,
+        hz=float(os.environ.get('PROFILE_CONTINUOUS_HZ', 10)),
+        window_seconds=float(os.environ.get('PROFILE_WINDOW_SECONDS', 600))
+    ).start()
+    logger.info("Continuous profiling enabled")
+
+# Progressive /api/predict: a coarse mask from the same weights at this input size is streamed before the full result
+PROGRESSIVE_SIZE = int(os.environ.get('PROGRESSIVE_SIZE', 128))
+coarse_models = weakref.WeakKeyDictionary()
+coarse_models_lock = threading.Lock()
+
+def coarse_result(model, preprocessed_image, display_shape, tolerance, bitmask_size):
+    """Thresholded low-resolution mask as tumor percentage and client overlay geometry, without postprocessing"""
+    with coarse_models_lock:
+        coarse_model = coarse_models.get(model)
+        if coarse_model is None:
+            coarse_model = coarse_models[model] = model.at_resolution(PROGRESSIVE_SIZE)
+    probabilities = coarse_model.predict(downsample(preprocessed_image, PROGRESSIVE_SIZE))[0, ..., 0]
+    mask = cv2.resize((probabilities > 0.5).astype(np.uint8) * 255, (display_shape[1], display_shape[0]),
+                      interpolation=cv2.INTER_NEAREST)
+    return {
+        'stage': 'coarse',
+        'tumor_percentage': float(np.count_nonzero(mask) / mask.size * 100),
+        'image_size': {'width': display_shape[1], 'height': display_shape[0]},
+        **mask_geometry(mask, tolerance, bitmask_size)
+    }
+
+def progressive_events(run):
+    """NDJSON lines of a progressive prediction: 'coarse' as soon as it is ready, then 'final' (or 'error')
+
+    run(on_coarse) produces the final result in a worker thread, so the coarse
+    line is written to the response while the full-resolution pass runs.
+    """
+    events = queue.Queue()
+    start = time.perf_counter()
+
+    def emit(event):
+        events.put(dict(event, elapsed_ms=(time.perf_counter() - start) * 1000))
+
+    def work():
+        try:
+            emit(dict(run(emit), stage='final'))
+        except Exception as e:
+            logger.error(f"Error processing image: {str(e)}")
+            emit({'stage': 'error', 'error': str(e)})
+        finally:
+            events.put(None)
+
+    threading.Thread(target=work, name='progressive', daemon=True).start()
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        yield json.dumps(event) + '\n'
+
+def progressive_predict(file, digest, extension, key, patient_id, model, model_version, render, tolerance,
+                        bitmask_size, include_original, lane, client):
+    """Streaming response of a progressive prediction
+
+    The client's scheduler quota is taken and the upload is saved and decoded
+    before the response starts, so quota, size and decode errors still get
+    their status codes. Progressive requests coalesce with identical ones on
+    the final result: only the request that runs the segmentation gets a
+    coarse line, the others wait for the final one.
+    """
+    # The request's upload stream is closed once the view returns, and the file name must not collide
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{digest}-{uuid.uuid4().hex}.{extension}')
+    inference_scheduler.reserve(client, lane)
+    try:
+        file.save(file_path)
+        raw = decode_image(file_path, MAX_VOLUME_VOXELS, digest)
+    except Exception:
+        inference_scheduler.release(client)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+
+    # The stream and the response's close callback race for cleanup; a stream that never started cleans nothing up
+    claim = threading.Lock()
+
+    def clean_up():
+        inference_scheduler.release(client)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+    def run(on_coarse):
+        if not claim.acquire(blocking=False):
+            raise RuntimeError("Request closed before the prediction started")
+        try:
+            with inference_scheduler.context(lane, client, reserved=True):
+                result, shared = predictions_in_flight.do(key, lambda: segment_upload(
+                    file, file_path, digest, patient_id, model, model_version, render, tolerance, bitmask_size,
+                    include_original, on_coarse, raw=raw))
+            return dict(result, coalesced=shared)
+        finally:
+            # A coalesced request never hands its file to segment_upload
+            clean_up()
+
+    def on_close():
+        if claim.acquire(blocking=False):
+            clean_up()
+
+    response = Response(stream_with_context(progressive_events(run)), mimetype='application/x-ndjson')
+    response.call_on_close(on_close)
+    return response
+
+def request_lane(default):
+    """Scheduler lane and client of the current request; X-Priority picks another lane"""
+    lane = request.headers.get('X-Priority', default)
+    if lane not in inference_scheduler.lanes:
+        raise ValueError(f"X-Priority must be one of: {', '.join(inference_scheduler.lanes)}")
+    return lane, request.headers.get('X-Client-ID') or request.remote_addr
 
 def predict_mask(image_path):
     # Preprocess the image
     img = preprocess_image(image_path)
     
     # Get prediction
+    _, model = model_manager.select()
     pred_mask = model.predict(img)
     pred_mask = pred_mask[0].squeeze().round()
     
     return pred_mask
 
-def create_overlay_image(original_img, mask):
-    # Create overlay image with mask
-    overlay = original_img.copy()
-    
-    # Create a colored mask with better visibility
-    colored_mask = np.zeros_like(original_img)
-    colored_mask[mask > 0] = [0, 255, 0]  # Green color for tumor regions
-    
-    # Add edge highlighting
-    edges = cv2.Canny(mask, 100, 200)
-    colored_mask[edges > 0] = [255, 255, 0]  # Yellow edges
-    
-    # Create overlay with better alpha blending
-    overlay = cv2.addWeighted(overlay, 0.7, colored_mask, 0.3, 0)
-    
-    # Add contour highlighting
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    cv2.drawContours(overlay, contours, -1, (0, 255, 0), 1)
-    
-    return overlay
-
 @app.route('/api/save_annotation', methods=['POST'])
 def save_annotation():
     """Save an annotated image and its mask"""
@@ -168,85 +449,179 @@ def save_annotation():
         if image.filename == '' or mask.filename == '':
             return jsonify({'error': 'No selected file'}), 400
         
-        # Save the image
-        image_filename = secure_filename(image.filename)
-        image_path = os.path.join('dataset', 'images', image_filename)
-        image.save(image_path)
-        
-        # Save the mask
-        mask_filename = secure_filename(mask.filename)
-        mask_path = os.path.join('dataset', 'masks', mask_filename)
-        mask.save(mask_path)
+        # Store the pair by content hash; identical uploads map to the existing record
+        record, created = annotation_store.ingest(image.read(), mask.read(), secure_filename(image.filename))
         
-        return jsonify({'message': 'Annotation saved successfully'}), 200
+        return jsonify({
+            'message': 'Annotation saved successfully' if created else 'Annotation already exists',
+            'id': record['id'],
+            'sha256': record['sha256']
+        }), 201 if created else 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/predict', methods=['POST'])
-def predict():
+@app.route('/api/annotations', methods=['GET'])
+def annotation_stats():
+    """Number of stored, pending and exported annotations"""
+    return jsonify(annotation_store.stats())
+
+@app.route('/api/annotations/export', methods=['POST'])
+def export_annotations():
+    """Export annotations that are not in a shard yet as a new incremental shard"""
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type'}), 400
-        
-        # Save the file temporarily
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        shard = annotation_store.export_shard()
+        if shard is None:
+            return jsonify({'message': 'No new annotations to export'}), 200
+        return jsonify(shard), 201
+    except Exception as e:
+        logger.error(f"Error exporting annotations: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/finetune', methods=['POST'])
+def start_finetune():
+    """Start a low-priority fine-tuning job on annotations the active model has not seen"""
+    data = request.get_json(silent=True) or {}
+    started = finetune_job.start(
+        registry_root=registry.root,
+        store_root=ANNOTATION_STORE,
+        epochs=int(data.get('epochs', 5)),
+        batch_size=int(data.get('batch_size', 8))
+    )
+    if not started:
+        return jsonify({'error': 'A fine-tuning job is already running'}), 409
+    return jsonify({'message': 'Fine-tuning started'}), 202
+
+@app.route('/api/finetune', methods=['GET'])
+def finetune_status():
+    return jsonify(finetune_job.status())
+
+def segment_upload(file, file_path, digest, patient_id, model, model_version, render, tolerance, bitmask_size,
+                   include_original, on_coarse=None, raw=None):
+    """Decode, segment and encode one uploaded image; returns the JSON-ready result
+
+    With on_coarse, a coarse result (see coarse_result) is passed to it before
+    the full-resolution pass of images that will be segmented. raw is the
+    upload already saved to file_path and decoded by the caller, if it was.
+    """
+    start = time.perf_counter()
+    profile = MemoryProfile(MEMORY_PROFILING)
+    profile.start('upload')
+    if raw is None:
         file.save(file_path)
+
+    try:
+        # Read and preprocess the image
+        logger.info("Reading and preprocessing image...")
+        profile.start('read')
+        if raw is None:
+            raw = decode_image(file_path, MAX_VOLUME_VOXELS, digest)
+        image = enhance_image(raw)
         
-        try:
-            # Read and preprocess the image
-            logger.info("Reading and preprocessing image...")
-            image = read_image(file_path)
-            
-            # Store original image for display
-            if len(image.shape) == 2:
-                display_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
-            else:
-                display_image = image.copy()
-            
+        # Store original image for display; color images are not modified below, so no copy is needed
+        if len(image.shape) == 2:
+            display_image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        else:
+            display_image = image
+        
+        # Run the classifier first and only segment positive or uncertain scans
+        segment = True
+        tumor_probability = None
+        if cascade is not None:
+            profile.start('classify')
+            # The classifier was trained on rescaled images without the contrast enhancement
+            flags, probabilities = cascade.gate([raw])
+            segment = bool(flags[0])
+            tumor_probability = float(probabilities[0])
+            logger.info(f"Classifier tumor probability: {tumor_probability:.3f}")
+
+        early_exit = None
+        if segment:
             # Preprocess for model
-            preprocessed_image = preprocess_image(image)
+            profile.start('preprocess')
+            preprocessed_image = expand_context(preprocess_image(image), model.model.input_shape[-1])
             logger.info("Image preprocessing completed")
 
+            if slice_gate is not None:
+                profile.start('early_exit')
+                early_exit = slice_gate.check(model, preprocessed_image)[0]
+                segment = early_exit == FULL
+
+        if segment and on_coarse is not None:
+            profile.start('coarse')
+            on_coarse(coarse_result(model, preprocessed_image, display_image.shape, tolerance, bitmask_size))
+
+        if segment:
             # Make prediction
             logger.info("Making prediction...")
+            profile.start('predict')
             mask = model.predict(preprocessed_image)
             logger.info("Prediction completed")
+            if cascade is not None:
+                cascade.record_segmented()
 
             # Postprocess the mask
             logger.info("Postprocessing mask...")
+            profile.start('postprocess')
             processed_mask = postprocess_mask(mask)
-            
+
             # Resize mask to match display image size
-            processed_mask = cv2.resize(processed_mask, (display_image.shape[1], display_image.shape[0]), 
+            processed_mask = cv2.resize(processed_mask, (display_image.shape[1], display_image.shape[0]),
                                      interpolation=cv2.INTER_NEAREST)
-            
-            # Ensure mask is 2D
-            if len(processed_mask.shape) == 3:
-                processed_mask = processed_mask[:, :, 0]
-            
-            # Normalize mask for visualization
-            if processed_mask.max() > 0:  # Only normalize if mask is not all zeros
-                processed_mask = ((processed_mask - processed_mask.min()) / 
-                                (processed_mask.max() - processed_mask.min()) * 255).astype(np.uint8)
-            
-            # Create colored mask for better visibility
-            colored_mask = np.zeros_like(display_image)
-            colored_mask[processed_mask > 0] = [0, 255, 0]  # Green color for tumor
-            
-            logger.info("Mask postprocessing completed")
+        else:
+            logger.info(f"Skipping segmentation ({early_exit or 'classifier predicted no tumor'})")
+            processed_mask = np.zeros(display_image.shape[:2], dtype=np.uint8)
+        
+        # Ensure mask is 2D
+        if len(processed_mask.shape) == 3:
+            processed_mask = processed_mask[:, :, 0]
+        
+        # Normalize mask for visualization
+        if processed_mask.max() > 0:  # Only normalize if mask is not all zeros
+            processed_mask = ((processed_mask - processed_mask.min()) / 
+                            (processed_mask.max() - processed_mask.min()) * 255).astype(np.uint8)
+        
+        logger.info("Mask postprocessing completed")
 
+        # Calculate tumor area percentage
+        logger.info("Calculating tumor area percentage...")
+        tumor_pixels = np.sum(processed_mask > 0)
+        total_pixels = processed_mask.shape[0] * processed_mask.shape[1]
+        tumor_percentage = (tumor_pixels / total_pixels) * 100
+        logger.info(f"Tumor area percentage: {tumor_percentage:.2f}%")
+        # Per-lesion area, centroid, bounding box and diameter in display pixels
+        lesions = analyze_lesions(processed_mask[np.newaxis])
+
+        result = {
+            'tumor_percentage': float(tumor_percentage),
+            'lesions': lesions['lesions'],
+            'tumor_probability': tumor_probability,
+            'segmented': segment,
+            'early_exit': early_exit,
+            'model_version': model_version,
+            'render': render,
+            'image_size': {
+                'width': display_image.shape[1],
+                'height': display_image.shape[0]
+            }
+        }
+        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 9]
+
+        if render == 'client':
+            # The client draws the overlay from simplified polygons and a packed low-resolution bitmask
+            profile.start('geometry')
+            result.update(mask_geometry(processed_mask, tolerance, bitmask_size))
+        else:
             # Create overlay with better visibility
             logger.info("Creating overlay...")
-            # Use addWeighted with better alpha values for visibility
-            overlay = cv2.addWeighted(display_image, 0.7, colored_mask, 0.3, 0)
+            profile.start('overlay')
+            # Same result as addWeighted(display, 0.7, green mask, 0.3) without a full-size colored mask:
+            # scale the whole image, then blend green into the tumor pixels only
+            overlay = cv2.convertScaleAbs(display_image, alpha=0.7)
+            tumor = processed_mask > 0
+            if tumor.any():
+                overlay[..., 1][tumor] = cv2.convertScaleAbs(display_image[..., 1][tumor], alpha=0.7, beta=0.3 * 255).ravel()
             
             # Add contours for better edge visibility
             contours, _ = cv2.findContours(processed_mask.astype(np.uint8), 
@@ -257,53 +632,440 @@ def predict():
             
             logger.info("Overlay created")
 
-            # Calculate tumor area percentage
-            logger.info("Calculating tumor area percentage...")
-            tumor_pixels = np.sum(processed_mask > 0)
-            total_pixels = processed_mask.shape[0] * processed_mask.shape[1]
-            tumor_percentage = (tumor_pixels / total_pixels) * 100
-            logger.info(f"Tumor area percentage: {tumor_percentage:.2f}%")
+            # Compress images for transfer while maintaining quality; the overlay is converted to BGR
+            # in place since it is not used afterwards
+            profile.start('encode')
+            _, mask_encoded = cv2.imencode('.png', processed_mask, encode_params)
+            _, overlay_encoded = cv2.imencode('.png', cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR, dst=overlay), encode_params)
+            result['mask'] = base64.b64encode(mask_encoded).decode('utf-8')
+            result['overlay'] = base64.b64encode(overlay_encoded).decode('utf-8')
 
-            # Ensure the mask is visible by scaling to full range
-            processed_mask_display = cv2.cvtColor(processed_mask, cv2.COLOR_GRAY2BGR)
-            
-            # Compress images for transfer while maintaining quality
-            encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 9]
-            
-            # Convert to BGR for imencode
-            display_image_bgr = cv2.cvtColor(display_image, cv2.COLOR_RGB2BGR)
-            colored_mask_bgr = cv2.cvtColor(colored_mask, cv2.COLOR_RGB2BGR)
-            overlay_bgr = cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR)
-            
-            _, original_encoded = cv2.imencode('.png', display_image_bgr, encode_params)
-            _, mask_encoded = cv2.imencode('.png', processed_mask_display, encode_params)
-            _, overlay_encoded = cv2.imencode('.png', overlay_bgr, encode_params)
-
-            original_base64 = base64.b64encode(original_encoded).decode('utf-8')
-            mask_base64 = base64.b64encode(mask_encoded).decode('utf-8')
-            overlay_base64 = base64.b64encode(overlay_encoded).decode('utf-8')
-            logger.info("Image conversion completed")
-
-            return jsonify({
-                'original': original_base64,
-                'mask': mask_base64,
-                'overlay': overlay_base64,
-                'tumor_percentage': float(tumor_percentage),
-                'image_size': {
-                    'width': display_image.shape[1],
-                    'height': display_image.shape[0]
-                }
-            })
+        # Clients that can display the uploaded file themselves may skip the original
+        if include_original:
+            profile.start('encode_original')
+            # Grayscale images are encoded as single-channel PNGs; color ones are converted to BGR for imencode
+            if len(image.shape) == 2:
+                _, original_encoded = cv2.imencode('.png', image, encode_params)
+            else:
+                _, original_encoded = cv2.imencode('.png', cv2.cvtColor(display_image, cv2.COLOR_RGB2BGR), encode_params)
+            result['original'] = base64.b64encode(original_encoded).decode('utf-8')
+        logger.info("Image conversion completed")
+
+        if MEMORY_PROFILING:
+            result['memory_profile'] = profile.finish()
+            memory_stats.record(result['memory_profile'])
+
+        if prediction_history is not None:
+            result['prediction_id'] = prediction_history.record(
+                result, processed_mask, digest, (time.perf_counter() - start) * 1000,
+                patient_id=patient_id, filename=file.filename
+            )
+
+        return result
+
+    finally:
+        # Clean up the temporary file
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        release_memory()
+
+@app.route('/api/predict', methods=['POST'])
+def predict():
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No selected file'}), 400
+        
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type'}), 400
+        
+        # Pick the model version for this request (explicit version, canary or active)
+        requested_version = request.form.get('model_version') or request.headers.get('X-Model-Version')
+        try:
+            model_version, model = model_manager.select(requested_version)
+        except KeyError as e:
+            return jsonify({'error': e.args[0]}), 400
+
+        # render=client returns polygons and a bitmask instead of server-rendered mask and overlay PNGs
+        render = request.form.get('render', 'server')
+        if render not in ('server', 'client'):
+            return jsonify({'error': "render must be 'server' or 'client'"}), 400
+        try:
+            tolerance = float(request.form.get('tolerance', OVERLAY_TOLERANCE))
+            bitmask_size = int(request.form.get('bitmask_size', OVERLAY_BITMASK_SIZE))
+        except ValueError:
+            return jsonify({'error': 'tolerance and bitmask_size must be numbers'}), 400
+        include_original = render == 'server' or request.form.get('include_original', '1') == '1'
+        # progressive=1 streams NDJSON: a coarse low-resolution mask first, then the full result
+        progressive = request.form.get('progressive', '0') == '1'
+        try:
+            lane, client = request_lane('interactive')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Identical uploads with identical options that arrive while one is being processed share its result
+        digest = content_digest(file.stream)
+        extension = file_extension(file.filename)
+        patient_id = request.form.get('patient_id') or request.headers.get('X-Patient-ID')
+        key = (digest, extension, patient_id, model_version, render, tolerance, bitmask_size, include_original)
+        # Unique per request: uploads with the same content but other options are not coalesced, and must not
+        # overwrite or delete each other's temporary file
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f'{digest}-{uuid.uuid4().hex}.{extension}')
+        if progressive:
+            return progressive_predict(file, digest, extension, key, patient_id, model, model_version, render,
+                                       tolerance, bitmask_size, include_original, lane, client)
+        with inference_scheduler.context(lane, client):
+            result, shared = predictions_in_flight.do(key, lambda: segment_upload(
+                file, file_path, digest, patient_id, model, model_version, render, tolerance, bitmask_size,
+                include_original))
+        return jsonify(dict(result, coalesced=shared))
+
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+    except LimitExceeded as e:
+        logger.warning(f"Rejected image: {str(e)}")
+        return jsonify({'error': str(e)}), 413
+    except QuotaExceeded as e:
+        logger.warning(f"Rejected image: {str(e)}")
+        return jsonify({'error': str(e)}), 429
+    except Exception as e:
+        logger.error(f"Error processing image: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/predict_volume', methods=['POST'])
+def predict_volume():
+    """Segment every slice of a NIfTI or multi-frame DICOM volume and return the 3D mask"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+
+        file = request.files['file']
+        if file_extension(file.filename) not in VOLUME_EXTENSIONS:
+            return jsonify({'error': 'Expected a NIfTI or DICOM volume'}), 400
+
+        requested_version = request.form.get('model_version') or request.headers.get('X-Model-Version')
+        try:
+            model_version, model = model_manager.select(requested_version)
+        except KeyError as e:
+            return jsonify({'error': e.args[0]}), 400
+
+        # export=nifti,seg streams the mask to files for download instead of embedding it in the response
+        export_formats = [f for f in request.form.get('export', '').split(',') if f]
+        if any(f not in EXPORT_FORMATS for f in export_formats):
+            return jsonify({'error': f"export must be a list of: {', '.join(EXPORT_FORMATS)}"}), 400
+        try:
+            lane, client = request_lane('bulk')
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        export_id = export_dir = None
+        if export_formats:
+            purge_exports()
+            export_id = uuid.uuid4().hex
+            export_dir = os.path.join(EXPORT_FOLDER, export_id)
+            os.makedirs(export_dir)
 
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
+        file.save(file_path)
+        try:
+            # Each batch of slices waits for its own model slot, so interactive requests get in between batches
+            with inference_scheduler.context(lane, client):
+                mask, volume, summary = segment_file(
+                    model, file_path,
+                    smooth=request.form.get('smooth', '1') == '1',
+                    min_voxels=int(request.form.get('min_voxels', 64)),
+                    gate=slice_gate,
+                    max_voxels=MAX_VOLUME_VOXELS,
+                    export_dir=export_dir,
+                    export_formats=export_formats
+                )
+            logger.info(f"Segmented {volume.depth} slices at {summary['stats']['slices_per_second']:.1f} slices/s")
+
+            summary['model_version'] = model_version
+            if export_id:
+                summary['downloads'] = {name: f'/api/exports/{export_id}/{filename}'
+                                        for name, filename in summary.pop('exports').items()}
+            else:
+                summary['mask'] = base64.b64encode(gzip.compress(mask_to_nifti(mask, volume).to_bytes(), 6)).decode('utf-8')
+                summary['mask_format'] = 'nii.gz'
+            return jsonify(summary)
+        except Exception:
+            if export_dir:
+                shutil.rmtree(export_dir, ignore_errors=True)
+            raise
         finally:
-            # Clean up the temporary file
             if os.path.exists(file_path):
                 os.remove(file_path)
+            release_memory()
 
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+    except LimitExceeded as e:
+        logger.warning(f"Rejected volume: {str(e)}")
+        return jsonify({'error': str(e)}), 413
+    except QuotaExceeded as e:
+        logger.warning(f"Rejected volume: {str(e)}")
+        return jsonify({'error': str(e)}), 429
     except Exception as e:
-        logger.error(f"Error processing image: {str(e)}")
+        logger.error(f"Error processing volume: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/dicomweb/studies', methods=['POST'])
+@app.route('/dicomweb/studies/<study_uid>', methods=['POST'])
+def stow_instances(study_uid=None):
+    """Store DICOM instances sent as multipart/related (STOW-RS) and queue their series for segmentation"""
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/related' or 'boundary' not in options:
+        return jsonify({'error': 'Expected a multipart/related body with a boundary'}), 415
+    if options.get('type', 'application/dicom').lower() != 'application/dicom':
+        return jsonify({'error': 'Only application/dicom parts are supported'}), 415
+    if study_uid is not None:
+        try:
+            check_uid(study_uid)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    request.max_content_length = STOW_MAX_BYTES
+    try:
+        # Parts are parsed from the raw stream as they arrive instead of after buffering the whole body
+        stored, failed = store_instances(request.stream, options['boundary'], STOW_SPOOL, series_queue.add,
+                                         study_uid=study_uid)
+    except RequestEntityTooLarge as e:
+        return request_too_large(e)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    logger.info(f"STOW: stored {len(stored)} instances, {len(failed)} failed")
+    body, status = stow_response(stored, failed)
+    response = jsonify(body)
+    response.mimetype = 'application/dicom+json'
+    return response, status
+
+@app.route('/api/series', methods=['GET'])
+def list_series():
+    """Ingestion and segmentation state of every series received through STOW-RS"""
+    return jsonify({'series': series_queue.status()})
+
+@app.route('/api/series/<series_uid>', methods=['GET'])
+def series_status(series_uid):
+    """State of one series, with its segmentation summary once completed"""
+    try:
+        status = series_queue.status(series_uid)
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    if status['state'] == 'completed':
+        status['summary'] = series_queue.summary(series_uid)
+        status['downloads'] = {name: f'/api/series/{series_uid}/{filename}'
+                               for name, filename in status['summary'].get('exports', {}).items()}
+    return jsonify(status)
+
+@app.route('/api/series/<series_uid>/<filename>', methods=['GET'])
+def download_series_export(series_uid, filename):
+    """Download the NIfTI or DICOM SEG mask of a segmented series, with Range support"""
+    if filename not in {name for name, _ in EXPORT_FORMATS.values()}:
+        return jsonify({'error': 'Unknown export file'}), 404
+    try:
+        result_dir = series_queue.result_dir(series_uid)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return send_from_directory(result_dir, filename, conditional=True)
+
+@app.route('/api/exports/<export_id>/<filename>', methods=['GET'])
+def download_export(export_id, filename):
+    """Download an exported mask; Range requests are supported so large files can be fetched in parts"""
+    return send_from_directory(os.path.abspath(os.path.join(EXPORT_FOLDER, secure_filename(export_id))), filename,
+                               conditional=True)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f"Upload exceeds the {request.max_content_length // (1024 * 1024)}MB limit"}), 413
+
+@app.route('/api/memory', methods=['GET'])
+def memory_report():
+    """Current RSS, configured limits and per-stage allocation peaks when profiling is enabled"""
+    report = memory_stats.report()
+    report.update({
+        'profiling': MEMORY_PROFILING,
+        'max_upload_mb': app.config['MAX_CONTENT_LENGTH'] / (1024 * 1024),
+        'max_volume_voxels': MAX_VOLUME_VOXELS
+    })
+    return jsonify(report)
+
+@app.route('/api/cascade/stats', methods=['GET'])
+def cascade_stats():
+    """Report per-stage hit rates of the classify-then-segment cascade"""
+    if cascade is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(cascade.stats(), enabled=True))
+
+@app.route('/api/early_exit/stats', methods=['GET'])
+def early_exit_stats():
+    """Report how many slices were skipped as blank or low-resolution negative"""
+    if slice_gate is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(slice_gate.stats(), enabled=True))
+
+STATS_PERIODS = {'week': 7, 'month': 30, 'year': 365}
+
+@app.route('/api/stats', methods=['GET'])
+def dashboard_stats():
+    """Dashboard statistics from the pre-aggregated prediction log, plus analyses currently running"""
+    period = request.args.get('period', 'week')
+    if period not in STATS_PERIODS:
+        return jsonify({'error': f"period must be one of: {', '.join(STATS_PERIODS)}"}), 400
+    if prediction_history is None:
+        return jsonify({'enabled': False})
+    stats = prediction_history.stats(STATS_PERIODS[period])
+    stats.update({
+        'enabled': True,
+        'period': period,
+        'active_analyses': predictions_in_flight.stats()['in_flight'] +
+                           sum(1 for series in series_queue.status() if series['state'] in ('queued', 'segmenting'))
+    })
+    return jsonify(stats)
+
+@app.route('/api/history', methods=['GET'])
+def prediction_log():
+    """Page through past predictions, newest first; pass next_before as ?before= for the next page"""
+    if prediction_history is None:
+        return jsonify({'error': 'Prediction history is disabled'}), 404
+    try:
+        limit = min(int(request.args.get('limit', 50)), 500)
+        before = int(request.args['before']) if 'before' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'limit and before must be integers'}), 400
+    critical = request.args.get('critical')
+    return jsonify(prediction_history.history(
+        limit=limit, before=before, patient_id=request.args.get('patient_id'),
+        critical=None if critical is None else critical == '1'
+    ))
+
+@app.route('/api/history/<int:prediction_id>/mask', methods=['GET'])
+def prediction_mask(prediction_id):
+    """Stored mask of a past prediction as a PNG"""
+    if prediction_history is None:
+        return jsonify({'error': 'Prediction history is disabled'}), 404
+    try:
+        mask = prediction_history.mask(prediction_id)
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    _, encoded = cv2.imencode('.png', mask.astype(np.uint8), [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    return Response(encoded.tobytes(), mimetype='image/png')
+
+@app.route('/api/coalescing/stats', methods=['GET'])
+def coalescing_stats():
+    """Report how many identical in-flight predictions shared one execution"""
+    return jsonify(predictions_in_flight.stats())
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats():
+    """Per-lane queue times, waiting and running model calls of the inference scheduler"""
+    return jsonify(inference_scheduler.stats())
+
+@app.route('/api/admin/profile', methods=['POST'])
+@admin_required
+def start_profile():
+    """Capture a time-boxed TensorFlow trace and Python sampling profile in the background"""
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', 10))
+        interval = float(data.get('interval', 0.005))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'seconds and interval must be numbers'}), 400
+    if seconds <= 0 or interval <= 0:
+        return jsonify({'error': 'seconds and interval must be positive'}), 400
+    try:
+        capture_id = profile_captures.start(seconds, interval, tf_trace=bool(data.get('tf_trace', True)))
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'id': capture_id, 'seconds': min(seconds, profile_captures.max_seconds),
+                    'summary': f'/api/admin/profiles/{capture_id}/summary.json'}), 202
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    return jsonify({'captures': profile_captures.captures()})
+
+@app.route('/api/admin/profiles/<capture_id>/<path:filename>', methods=['GET'])
+@admin_required
+def profile_file(capture_id, filename):
+    return send_from_directory(os.path.abspath(os.path.join(PROFILE_FOLDER, secure_filename(capture_id))), filename)
+
+@app.route('/api/admin/profile/continuous', methods=['GET'])
+@admin_required
+def continuous_profile():
+    """Share of samples in decode_image, enhance_image, preprocess_image, postprocess_mask etc. in the current window"""
+    if continuous_profiler is None:
+        return jsonify({'error': 'Continuous profiling is disabled'}), 404
+    return jsonify(continuous_profiler.hot_spots(top=int(request.args.get('top', 20))))
+
+@app.route('/api/admin/profile/continuous/<filename>', methods=['GET'])
+@admin_required
+def continuous_profile_window(filename):
+    if continuous_profiler is None:
+        return jsonify({'error': 'Continuous profiling is disabled'}), 404
+    return send_from_directory(os.path.abspath(continuous_profiler.directory), filename)
+
+@app.route('/api/models', methods=['GET'])
+def list_models():
+    """List registered model versions and what is currently served"""
+    return jsonify(model_manager.status())
+
+@app.route('/api/models', methods=['POST'])
+@admin_required
+def register_model():
+    """Register uploaded weights as a new model version, optionally activating it"""
+    try:
+        if 'weights' not in request.files:
+            return jsonify({'error': 'No weights file provided'}), 400
+        
+        weights = request.files['weights']
+        weights_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(weights.filename) or 'weights.h5')
+        weights.save(weights_path)
+        try:
+            manifest = registry.register(
+                weights_path,
+                version=request.form.get('version') or None,
+                architecture=request.form.get('architecture', 'unet')
+            )
+        finally:
+            os.remove(weights_path)
+        
+        if request.form.get('activate') == '1':
+            model_manager.activate(manifest['version'])
+        
+        return jsonify(manifest), 201
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error registering model: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/models/<version>/activate', methods=['POST'])
+@admin_required
+def activate_model(version):
+    """Load and warm a version in the background, then swap it in"""
+    try:
+        model_manager.activate(version)
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    return jsonify({'message': f'Activating model version {version}'}), 202
+
+@app.route('/api/models/canary', methods=['POST'])
+@admin_required
+def set_canary():
+    """Send a percentage of traffic to a model version"""
+    data = request.get_json(silent=True) or {}
+    try:
+        model_manager.set_canary(data.get('version'), float(data.get('percent', 0)))
+    except KeyError as e:
+        return jsonify({'error': e.args[0]}), 404
+    except ValueError:
+        return jsonify({'error': 'Invalid canary percentage'}), 400
+    return jsonify({'message': 'Canary updated'}), 202
+
 if __name__ == '__main__':
     logger.info("Starting Flask server...")
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,184 @@
+import argparse
+import json
+import logging
+import math
+import time
+import numpy as np
+import tensorflow as tf
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentationAugmenter:
+    """Random flips, rotation, scaling, elastic deformation, intensity jitter and gamma for image/mask batches
+
+    All geometric transforms are folded into one sampling grid per image, so a
+    batch is resampled once with bilinear interpolation (masks are re-binarized
+    afterwards). Every random draw is a stateless op keyed by a per-batch seed:
+    the same seed gives the same batch however the input pipeline schedules it.
+    """
+
+    def __init__(self, flip=True, max_rotation=15.0, max_scale=0.1, elastic_probability=0.5, elastic_alpha=6.0,
+                 elastic_grid=5, brightness=0.1, contrast=0.15, max_gamma=1.3):
+        self.flip = flip
+        self.max_rotation = max_rotation
+        self.max_scale = max_scale
+        self.elastic_probability = elastic_probability
+        self.elastic_alpha = elastic_alpha
+        self.elastic_grid = elastic_grid
+        self.brightness = brightness
+        self.contrast = contrast
+        self.max_gamma = max_gamma
+
+    def _uniform(self, seed, shape, low, high):
+        return tf.random.stateless_uniform(shape, seed, minval=low, maxval=high)
+
+    def _sampling_grid(self, seeds, batch, height, width):
+        """Source (row, column) of every output pixel, each (B, H, W)"""
+        rows, columns = tf.meshgrid(tf.range(height, dtype=tf.float32), tf.range(width, dtype=tf.float32),
+                                    indexing='ij')
+        cy, cx = (height - 1) / 2.0, (width - 1) / 2.0
+        dy, dx = rows[None] - cy, columns[None] - cx
+
+        angle = self._uniform(seeds[0], [batch, 1, 1], -1.0, 1.0) * math.radians(self.max_rotation)
+        scale = 1.0 + self._uniform(seeds[1], [batch, 1, 1], -self.max_scale, self.max_scale)
+        if self.flip:
+            flips = tf.where(self._uniform(seeds[2], [batch, 2, 1, 1], 0.0, 1.0) < 0.5, -1.0, 1.0)
+        else:
+            flips = tf.ones([batch, 2, 1, 1])
+        cos, sin = tf.cos(angle), tf.sin(angle)
+        source_rows = (-sin * dx + cos * dy) / scale * flips[:, 0] + cy
+        source_columns = (cos * dx + sin * dy) / scale * flips[:, 1] + cx
+
+        if self.elastic_probability > 0 and self.elastic_alpha > 0:
+            # A coarse random displacement field upsampled bicubically is smooth without a full-size Gaussian filter
+            coarse = tf.random.stateless_normal([batch, self.elastic_grid, self.elastic_grid, 2], seeds[3])
+            field = tf.image.resize(coarse, [height, width], method='bicubic') * self.elastic_alpha
+            apply = tf.cast(self._uniform(seeds[4], [batch, 1, 1], 0.0, 1.0) < self.elastic_probability, tf.float32)
+            source_rows += field[..., 0] * apply
+            source_columns += field[..., 1] * apply
+        return source_rows, source_columns
+
+    @staticmethod
+    def _resample(images, rows, columns):
+        """Bilinear sampling of (B, H, W, C) images at (B, H, W) source coordinates; outside pixels are zero"""
+        shape = tf.shape(images)
+        batch, height, width, channels = shape[0], shape[1], shape[2], shape[3]
+        flat = tf.reshape(images, [-1, channels])
+        offsets = tf.reshape(tf.range(batch) * height * width, [-1, 1, 1])
+        row0, column0 = tf.floor(rows), tf.floor(columns)
+        row_weight, column_weight = (rows - row0)[..., None], (columns - column0)[..., None]
+        row0, column0 = tf.cast(row0, tf.int32), tf.cast(column0, tf.int32)
+
+        def corner(r, c):
+            inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+            index = offsets + tf.clip_by_value(r, 0, height - 1) * width + tf.clip_by_value(c, 0, width - 1)
+            return tf.gather(flat, index) * tf.cast(inside, images.dtype)[..., None]
+
+        top = corner(row0, column0) * (1 - column_weight) + corner(row0, column0 + 1) * column_weight
+        bottom = corner(row0 + 1, column0) * (1 - column_weight) + corner(row0 + 1, column0 + 1) * column_weight
+        return top * (1 - row_weight) + bottom * row_weight
+
+    def _intensity(self, seeds, images):
+        batch = tf.shape(images)[0]
+        shape = [batch, 1, 1, 1]
+        mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+        contrast = 1.0 + self._uniform(seeds[5], shape, -self.contrast, self.contrast)
+        brightness = self._uniform(seeds[6], shape, -self.brightness, self.brightness)
+        images = tf.clip_by_value((images - mean) * contrast + mean + brightness, 0.0, 1.0)
+        if self.max_gamma > 1:
+            # Log-uniform gamma so darkening and brightening are equally likely
+            log_gamma = self._uniform(seeds[7], shape, -math.log(self.max_gamma), math.log(self.max_gamma))
+            images = tf.pow(images, tf.exp(log_gamma))
+        return images
+
+    def __call__(self, images, masks, seed):
+        """Augment a (B, H, W, C) float batch in [0, 1] and its (B, H, W, 1) mask with a [2] int seed"""
+        seeds = tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), num=8)
+        shape = tf.shape(images)
+        rows, columns = self._sampling_grid(seeds, shape[0], images.shape[1] or shape[1], images.shape[2] or shape[2])
+        images = self._resample(images, rows, columns)
+        masks = tf.cast(self._resample(masks, rows, columns) >= 0.5, masks.dtype)
+        return self._intensity(seeds, images), masks
+
+
+def augmented_dataset(images, masks, batch_size=8, augmenter=None, seed=0, shuffle=True, repeat=False):
+    """tf.data pipeline of (image, mask) batches, augmented per batch in parallel with seeds tied to the batch index
+
+    Batch i of the stream is seeded with (seed, i), so training runs are
+    reproducible while batches are still augmented concurrently with the
+    training step. Use repeat=True for multi-epoch training: the count then
+    continues across epochs and each epoch sees new augmentations.
+    """
+    augmenter = augmenter or SegmentationAugmenter()
+    dataset = tf.data.Dataset.from_tensor_slices((images, masks))
+    if shuffle:
+        dataset = dataset.shuffle(len(images), seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+    dataset = dataset.batch(batch_size).enumerate()
+    dataset = dataset.map(
+        lambda index, batch: augmenter(batch[0], batch[1], tf.stack([tf.cast(seed, tf.int64), index])),
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=True
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def benchmark(batch_size=8, size=256, channels=1, batches=20, augmenter=None, train_step=True):
+    """Images/sec of the augmentation pipeline alone and, optionally, of ResUNet training steps without it"""
+    augmenter = augmenter or SegmentationAugmenter()
+    rng = np.random.default_rng(0)
+    images = rng.random((batch_size * 4, size, size, channels), dtype=np.float32)
+    masks = (rng.random((batch_size * 4, size, size, 1)) > 0.9).astype(np.float32)
+
+    dataset = augmented_dataset(images, masks, batch_size, augmenter, repeat=True)
+    iterator = iter(dataset)
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(batches):
+        next(iterator)
+    report = {
+        'batch_size': batch_size,
+        'image_size': size,
+        'augment_images_per_second': batches * batch_size / (time.perf_counter() - start)
+    }
+    # Stop the prefetching pipeline so it does not compete with the training steps for memory
+    del iterator, dataset
+
+    if train_step:
+        from model import focal_tversky
+        from model_clean import ResUNet
+
+        model = ResUNet(input_channels=channels).model
+        model.compile(optimizer='adam', loss=focal_tversky)
+        x, y = images[:batch_size], masks[:batch_size]
+        model.train_on_batch(x, y)
+        steps = max(3, batches // 4)
+        start = time.perf_counter()
+        for _ in range(steps):
+            model.train_on_batch(x, y)
+        report['train_images_per_second'] = steps * batch_size / (time.perf_counter() - start)
+        # With prefetching the pipeline runs alongside training; it only slows steps if it is the slower stage
+        report['augmentation_keeps_up'] = report['augment_images_per_second'] >= report['train_images_per_second']
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Benchmark the batched segmentation augmentation pipeline')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--no-train-step', action='store_true', help='Only measure augmentation throughput')
+    parser.add_argument('--no-elastic', action='store_true')
+    args = parser.parse_args()
+
+    augmenter = SegmentationAugmenter(elastic_probability=0.0 if args.no_elastic else 0.5)
+    report = benchmark(args.batch_size, args.size, args.channels, args.batches, augmenter,
+                       train_step=not args.no_train_step)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from memory import peak_rss_mb
+
+
+def load_labelled_images(csv_path, limit=None, target_size=(256, 256)):
+    """Load images and tumor labels from a brain_df-style CSV (image_path, mask)"""
+    import cv2
+    import pandas as pd
+
+    df = pd.read_csv(csv_path)
+    if limit:
+        df = df.sample(n=min(limit, len(df)), random_state=42)
+
+    images, labels = [], []
+    for image_path, label in zip(df['image_path'], df['mask']):
+        img = cv2.imread(image_path)
+        if img is None:
+            continue
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        images.append(cv2.resize(img, target_size).astype(np.float32) / 255.0)
+        labels.append(int(label))
+    return np.stack(images), np.array(labels)
+
+
+def classification_metrics(labels, predicted):
+    """Accuracy, sensitivity and specificity for binary tumor labels"""
+    tp = int(np.sum((predicted == 1) & (labels == 1)))
+    tn = int(np.sum((predicted == 0) & (labels == 0)))
+    fp = int(np.sum((predicted == 1) & (labels == 0)))
+    fn = int(np.sum((predicted == 0) & (labels == 1)))
+    return {
+        'accuracy': (tp + tn) / max(len(labels), 1),
+        'sensitivity': tp / max(tp + fn, 1),
+        'specificity': tn / max(tn + fp, 1)
+    }
+
+
+def benchmark_backbone(backbone, args, queue):
+    """Benchmark one backbone; runs in its own process so memory numbers are isolated"""
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    from model import create_model, classifier_weights_path
+
+    baseline_rss = peak_rss_mb()
+    weights_path = os.path.join(args.weights_dir, classifier_weights_path(backbone))
+    model = create_model(backbone=backbone, weights=None if os.path.exists(weights_path) else 'imagenet')
+    if os.path.exists(weights_path):
+        model.load_weights(weights_path)
+
+    batch = np.random.rand(args.batch_size, 256, 256, 3).astype(np.float32)
+    for _ in range(args.warmup):
+        model.predict_on_batch(batch)
+
+    timings = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        model.predict_on_batch(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    result = {
+        'backbone': backbone,
+        'parameters': int(model.count_params()),
+        'weights_mb': sum(w.size * w.dtype.itemsize for w in model.get_weights()) / 2**20,
+        'latency_ms_p50': float(np.percentile(timings, 50)),
+        'latency_ms_p95': float(np.percentile(timings, 95)),
+        'peak_rss_mb': peak_rss_mb() - baseline_rss,
+        'trained_weights': os.path.exists(weights_path)
+    }
+
+    if args.csv:
+        images, labels = load_labelled_images(args.csv, args.limit)
+        probabilities = model.predict(images, batch_size=32, verbose=0)
+        result.update(classification_metrics(labels, np.argmax(probabilities, axis=1)))
+
+    queue.put(result)
+
+
+def main():
+    from model import BACKBONES
+
+    parser = argparse.ArgumentParser(description='Benchmark classifier backbones: accuracy vs latency and memory')
+    parser.add_argument('--backbones', nargs='+', default=list(BACKBONES), choices=BACKBONES)
+    parser.add_argument('--csv', help='brain_df-style CSV with image_path and mask columns for accuracy')
+    parser.add_argument('--limit', type=int, default=None, help='Number of CSV rows to evaluate')
+    parser.add_argument('--weights-dir', default='.', help='Directory with trained classifier checkpoints')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=os.cpu_count())
+    parser.add_argument('--min-sensitivity', type=float, default=0.95)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for backbone in args.backbones:
+        queue = ctx.Queue()
+        process = ctx.Process(target=benchmark_backbone, args=(backbone, args, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+        print(json.dumps(results[-1]))
+
+    # Recommend the fastest backbone that meets the sensitivity target
+    eligible = [r for r in results if r.get('sensitivity', 0.0) >= args.min_sensitivity]
+    report = {
+        'results': results,
+        'min_sensitivity': args.min_sensitivity,
+        'recommended': min(eligible, key=lambda r: r['latency_ms_p50'])['backbone'] if eligible else None
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Recommended backbone: {report['recommended']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import logging
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Index of the tumor class in the classifier softmax output ('0' = healthy, '1' = tumor)
+TUMOR_CLASS = 1
+
+# Probability above which a scan counts as a confident positive (below it is "uncertain")
+POSITIVE_PROBABILITY = 0.5
+
+
+def load_classifier(weights_path, input_shape=(256, 256, 3), backbone='resnet50'):
+    """Build the tumor classifier and load its trained weights"""
+    # Imported lazily so the serving process only pays for the classifier when the cascade is enabled
+    from model import create_model
+
+    classifier = create_model(input_shape, backbone=backbone, weights=None)
+    classifier.load_weights(weights_path)
+    return classifier
+
+
+def preprocess_for_classifier(image, target_size=(256, 256)):
+    """Convert a decoded RGB or grayscale uint8 image to the classifier input format
+
+    Same as the training generators (train_model.setup_data_generators): an
+    RGB image resized with nearest-neighbour interpolation and rescaled to
+    [0, 1], without the contrast enhancement applied for segmentation.
+    """
+    if len(image.shape) == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    elif image.shape[2] == 1:
+        image = cv2.cvtColor(image[:, :, 0], cv2.COLOR_GRAY2RGB)
+    image = cv2.resize(image, target_size, interpolation=cv2.INTER_NEAREST)
+    return image.astype(np.float32) / 255.0
+
+
+class CascadePipeline:
+    """Classify-then-segment pipeline that only segments positive or uncertain scans"""
+
+    def __init__(self, classifier, threshold=0.2, cache_size=1024, batch_size=32):
+        self.classifier = classifier
+        # Scans with a tumor probability below the threshold skip segmentation
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'classified': 0,
+            'cache_hits': 0,
+            'negative': 0,
+            'uncertain': 0,
+            'positive': 0,
+            'segmented': 0
+        }
+
+    @staticmethod
+    def _cache_key(image):
+        digest = hashlib.sha1(np.ascontiguousarray(image).data)
+        digest.update(str(image.shape).encode('utf-8'))
+        return digest.hexdigest()
+
+    def classify(self, images):
+        """Return the tumor probability for each image, classifying cache misses in batches"""
+        keys = [self._cache_key(image) for image in images]
+        probabilities = np.zeros(len(images), dtype=np.float32)
+        misses = []
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    probabilities[i] = self._cache[key]
+                    self._stats['cache_hits'] += 1
+                else:
+                    misses.append(i)
+
+        for start in range(0, len(misses), self.batch_size):
+            indices = misses[start:start + self.batch_size]
+            batch = np.stack([preprocess_for_classifier(images[i]) for i in indices])
+            predictions = self.classifier.predict(batch, verbose=0)
+            with self._lock:
+                for i, prediction in zip(indices, predictions):
+                    probabilities[i] = float(prediction[TUMOR_CLASS])
+                    self._cache[keys[i]] = probabilities[i]
+                    if len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+        with self._lock:
+            self._stats['classified'] += len(images)
+
+        return probabilities
+
+    def gate(self, images):
+        """Decide which images need segmentation; returns (segment flags, probabilities)"""
+        probabilities = self.classify(images)
+        segment = probabilities >= self.threshold
+
+        with self._lock:
+            positive = int(np.sum(probabilities >= POSITIVE_PROBABILITY))
+            self._stats['positive'] += positive
+            self._stats['uncertain'] += int(np.sum(segment)) - positive
+            self._stats['negative'] += int(np.sum(~segment))
+
+        return segment, probabilities
+
+    def run(self, images, segment_fn):
+        """Run the cascade over a batch of images
+
+        segment_fn receives the list of images that passed the gate and must return
+        one mask per image. Images that were gated out get None as their mask.
+        """
+        segment, probabilities = self.gate(images)
+        masks = [None] * len(images)
+
+        selected = np.flatnonzero(segment)
+        if len(selected) > 0:
+            segmented = segment_fn([images[i] for i in selected])
+            for i, mask in zip(selected, segmented):
+                masks[i] = mask
+            self.record_segmented(len(selected))
+
+        return masks, probabilities
+
+    def record_segmented(self, count=1):
+        with self._lock:
+            self._stats['segmented'] += count
+
+    def stats(self):
+        """Return per-stage counters and hit rates"""
+        with self._lock:
+            stats = dict(self._stats)
+
+        gated = stats['negative'] + stats['uncertain'] + stats['positive']
+        stats['threshold'] = self.threshold
+        stats['cache_size'] = len(self._cache)
+        stats['cache_hit_rate'] = stats['cache_hits'] / stats['classified'] if stats['classified'] else 0.0
+        stats['skip_rate'] = stats['negative'] / gated if gated else 0.0
+        stats['segmentation_rate'] = stats['segmented'] / gated if gated else 0.0
+        return stats
@@ -0,0 +1,198 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from dataset_cache import cache_dataset, open_cache, patient_folds
+from hpsearch import _init_worker
+
+logger = logging.getLogger(__name__)
+
+# Training settings of every fold; the same keys as an hpsearch trial config, so a leaderboard entry can be reused
+DEFAULT_CONFIG = {
+    'learning_rate': 1e-4,
+    'epsilon': 0.1,
+    'batch_size': 8,
+    'loss': 'focal_tversky',
+    'augment': True
+}
+
+METRICS = ['val_dice', 'val_iou', 'val_tversky', 'patient_dice']
+
+
+def run_fold(fold, config, architecture, cache_dir, train_indices, val_indices, epochs, weights_path, seed):
+    """Train a fresh model on one fold's training patients and score it on its validation patients"""
+    import tensorflow as tf
+    from augment import SegmentationAugmenter
+    from dataset_cache import load_arrays, training_dataset
+    from metrics import confusion_counts, dice_from_counts, iou_from_counts, tversky_from_counts
+    from model import focal_tversky, tversky
+    from registry import ARCHITECTURES
+
+    start = time.perf_counter()
+    tf.keras.utils.set_random_seed(seed)
+    images, masks, index = open_cache(cache_dir)
+    model = ARCHITECTURES[architecture](input_size=images.shape[1]).model
+    if model.input_shape[-1] != 1:
+        raise ValueError("Cross-validation uses single-slice inputs; 2.5D architectures are not supported")
+    loss = focal_tversky if config['loss'] == 'focal_tversky' else 'binary_crossentropy'
+    optimizer = tf.keras.optimizers.Adam(learning_rate=config['learning_rate'], epsilon=config['epsilon'])
+    model.compile(optimizer=optimizer, loss=loss, metrics=[tversky])
+
+    augmenter = SegmentationAugmenter() if config['augment'] else None
+    dataset = training_dataset(images, masks, train_indices, config['batch_size'], augmenter, seed=seed)
+    steps = -(-len(train_indices) // config['batch_size'])
+    model.fit(dataset, epochs=epochs, steps_per_epoch=steps, verbose=0)
+    model.save_weights(weights_path)
+    train_seconds = time.perf_counter() - start
+
+    x_val, y_val = load_arrays(images, masks, val_indices)
+    predictions = model.predict(x_val, batch_size=16, verbose=0)[..., 0] > 0.5
+    tp, fp, fn = confusion_counts(y_val[..., 0], predictions)
+    # Per-patient volumetric Dice from the summed pixel counts of each patient's slices, as in evaluate.py
+    patients = index['patient_id'].to_numpy()[val_indices] if 'patient_id' in index else np.asarray(val_indices)
+    counts = pd.DataFrame({'patient': patients, 'tp': tp, 'fp': fp, 'fn': fn}).groupby('patient').sum()
+    return {
+        'fold': fold,
+        'train_samples': int(len(train_indices)),
+        'val_samples': int(len(val_indices)),
+        'val_patients': int(len(counts)),
+        'val_dice': float(np.mean(dice_from_counts(tp, fp, fn))),
+        'val_iou': float(np.mean(iou_from_counts(tp, fp, fn))),
+        'val_tversky': float(np.mean(tversky_from_counts(tp, fp, fn))),
+        'patient_dice': float(np.mean(dice_from_counts(counts['tp'], counts['fp'], counts['fn']))),
+        'train_seconds': train_seconds,
+        'seconds': time.perf_counter() - start
+    }
+
+
+def aggregate(folds):
+    """Mean, standard deviation, min and max of each metric over the completed folds"""
+    completed = [f for f in folds if f.get('state') == 'completed']
+    summary = {'folds': len(folds), 'completed': len(completed)}
+    for metric in METRICS:
+        values = np.array([f[metric] for f in completed], dtype=np.float64)
+        summary[metric] = {
+            'mean': float(values.mean()) if len(values) else None,
+            # Sample standard deviation: the folds are a sample of the possible patient splits
+            'std': float(values.std(ddof=1)) if len(values) > 1 else None,
+            'min': float(values.min()) if len(values) else None,
+            'max': float(values.max()) if len(values) else None
+        }
+    return summary
+
+
+def cross_validate(csv_path, output_dir='crossval', k=5, config=None, architecture='unet', epochs=10, workers=None,
+                   threads=None, size=256, limit=None, seed=0, slice_folds=False):
+    """Patient-grouped k-fold cross-validation with the folds trained concurrently
+
+    Folds run in a pool of worker processes (by default one per fold), each
+    with its own TensorFlow thread limit (threads, by default the cores
+    divided by the workers), and all of them read the same memory-mapped
+    preprocessed dataset, so the whole run takes about as long as one fold.
+    A CSV without patient_id is refused unless slice_folds is set, since
+    slice-level folds put slices of one patient on both sides of a split.
+    """
+    if 'patient_id' not in pd.read_csv(csv_path, nrows=0).columns:
+        if not slice_folds:
+            raise ValueError(f"{csv_path} has no patient_id column; slice-level folds overestimate the score on "
+                             f"new patients, pass slice_folds=True (--allow-slice-folds) to use them anyway")
+        logger.warning("No patient_id column: folds are split by slice, so scores are optimistic")
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    workers = min(k, workers or k)
+    threads = threads or max(1, os.cpu_count() // workers)
+    os.makedirs(os.path.join(output_dir, 'folds'), exist_ok=True)
+    cache_dir = cache_dataset(csv_path, os.path.join(output_dir, 'cache'), size=size, limit=limit)
+    _, _, index = open_cache(cache_dir)
+    splits = patient_folds(index, k, seed)
+    logger.info(f"{k}-fold cross-validation of {len(index)} slices on {workers} workers x {threads} threads")
+
+    folds = {}
+    start = time.perf_counter()
+    # spawn: workers start without the parent's state and set their thread limits before importing TensorFlow
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads,)) as pool:
+        futures = {
+            pool.submit(run_fold, fold, config, architecture, cache_dir, train_indices, val_indices, epochs,
+                        os.path.join(output_dir, 'folds', f'fold-{fold}.weights.h5'), seed + fold): fold
+            for fold, (train_indices, val_indices) in enumerate(splits)
+        }
+        for future in as_completed(futures):
+            fold = futures[future]
+            try:
+                folds[fold] = {**future.result(), 'state': 'completed'}
+            except Exception as e:
+                logger.error(f"Fold {fold} failed: {str(e)}")
+                folds[fold] = {'fold': fold, 'state': 'failed', 'error': str(e)}
+                continue
+            logger.info(f"Fold {fold}: Dice {folds[fold]['val_dice']:.4f}, patient Dice "
+                        f"{folds[fold]['patient_dice']:.4f} ({folds[fold]['seconds']:.0f} s)")
+
+    folds = [folds[fold] for fold in sorted(folds)]
+    wall_seconds = time.perf_counter() - start
+    report = {
+        'csv_path': csv_path,
+        'k': k,
+        'architecture': architecture,
+        'config': config,
+        'epochs': epochs,
+        'size': size,
+        'seed': seed,
+        'slice_folds': 'patient_id' not in index,
+        'workers': workers,
+        'threads': threads,
+        'wall_seconds': wall_seconds,
+        # Time the folds would have taken one after another, for comparison with wall_seconds
+        'sequential_seconds': float(sum(f.get('seconds', 0.0) for f in folds)),
+        'summary': aggregate(folds),
+        'folds': folds
+    }
+    with open(os.path.join(output_dir, 'crossval.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    pd.DataFrame(folds).to_csv(os.path.join(output_dir, 'folds.csv'), index=False)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Patient-grouped k-fold cross-validation of the segmentation model')
+    parser.add_argument('--csv', required=True, help='CSV with image_path, mask_path and optionally patient_id')
+    parser.add_argument('--output', default='crossval', help='Directory for the cache, fold weights and report')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--config', help='JSON file with training settings, e.g. the config of an hpsearch trial')
+    parser.add_argument('--architecture', default='unet', help='Registry architecture to train')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None, help='Parallel folds (default: one per fold)')
+    parser.add_argument('--allow-slice-folds', action='store_true',
+                        help='Split a CSV without patient_id by slice instead of refusing it')
+    parser.add_argument('--threads', type=int, default=None, help='TensorFlow threads per fold (default: cores / workers)')
+    parser.add_argument('--size', type=int, default=256, help='Training resolution')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        # Accept a whole leaderboard entry as well as a bare config
+        config = config.get('config', config)
+
+    report = cross_validate(args.csv, args.output, args.folds, config, args.architecture, args.epochs,
+                            args.workers, args.threads, args.size, args.limit, args.seed, args.allow_slice_folds)
+    for metric in METRICS:
+        stats = report['summary'][metric]
+        if stats['mean'] is not None:
+            spread = f" ± {stats['std']:.4f}" if stats['std'] is not None else ''
+            logger.info(f"{metric}: {stats['mean']:.4f}{spread} (min {stats['min']:.4f}, max {stats['max']:.4f})")
+    logger.info(f"{report['summary']['completed']}/{report['k']} folds in {report['wall_seconds']:.0f} s "
+                f"(sequential: {report['sequential_seconds']:.0f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(csv_path, size, limit):
+    stat = os.stat(csv_path)
+    source = f"{os.path.abspath(csv_path)}:{stat.st_size}:{stat.st_mtime_ns}:{size}:{limit}"
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+def cache_dataset(csv_path, cache_root='cache', size=256, limit=None, workers=None):
+    """Decode and preprocess a brain_df-style CSV once into uint8 .npy arrays; returns the cache directory
+
+    Images are stored as the model input scaled to 0-255 and masks as 0/1, both
+    (N, size, size, 1). The cache is keyed by the CSV's path, size and mtime, so
+    later runs (and parallel worker processes) memory-map the same files
+    instead of decoding the images again.
+    """
+    from evaluate import load_pair
+
+    cache_dir = os.path.join(cache_root, cache_key(csv_path, size, limit))
+    if os.path.exists(os.path.join(cache_dir, 'manifest.json')):
+        return cache_dir
+
+    frame = pd.read_csv(csv_path)
+    if limit is not None:
+        frame = frame.iloc[:limit]
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = {name: os.path.join(cache_dir, f'{name}.tmp.npy') for name in ('images', 'masks')}
+    images = np.lib.format.open_memmap(tmp['images'], mode='w+', dtype=np.uint8, shape=(len(frame), size, size, 1))
+    masks = np.lib.format.open_memmap(tmp['masks'], mode='w+', dtype=np.uint8, shape=(len(frame), size, size, 1))
+
+    def load(index):
+        image, mask = load_pair(frame['image_path'].iloc[index], frame['mask_path'].iloc[index], size)
+        image = np.round(image[..., 0] * 255).astype(np.uint8)
+        if image.shape[0] != size:
+            image = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+        images[index, ..., 0] = image
+        masks[index, ..., 0] = mask
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(load, range(len(frame))))
+    images.flush()
+    masks.flush()
+    del images, masks
+    for name, path in tmp.items():
+        os.replace(path, os.path.join(cache_dir, f'{name}.npy'))
+
+    columns = [c for c in ('patient_id', 'image_path', 'mask_path') if c in frame]
+    frame[columns].to_csv(os.path.join(cache_dir, 'index.csv'), index=False)
+    with open(os.path.join(cache_dir, 'manifest.json'), 'w') as f:
+        json.dump({'csv_path': os.path.abspath(csv_path), 'size': size, 'count': len(frame)}, f, indent=2)
+    logger.info(f"Cached {len(frame)} image/mask pairs in {cache_dir}")
+    return cache_dir
+
+
+def open_cache(cache_dir):
+    """Memory-mapped (images, masks, index) of a cache; pages are shared between processes by the OS"""
+    images = np.load(os.path.join(cache_dir, 'images.npy'), mmap_mode='r')
+    masks = np.load(os.path.join(cache_dir, 'masks.npy'), mmap_mode='r')
+    return images, masks, pd.read_csv(os.path.join(cache_dir, 'index.csv'))
+
+
+def patient_split(index, val_fraction=0.2, seed=0):
+    """(train, validation) row indices of a cache index, split by patient when it has patient ids
+
+    Validation slices then never come from a patient seen in training.
+    """
+    rng = np.random.default_rng(seed)
+    groups = index['patient_id'].to_numpy() if 'patient_id' in index else np.arange(len(index))
+    unique = rng.permutation(np.unique(groups))
+    val_groups = set(unique[:max(1, int(len(unique) * val_fraction))].tolist())
+    is_val = np.array([g in val_groups for g in groups])
+    return np.flatnonzero(~is_val), np.flatnonzero(is_val)
+
+
+def patient_folds(index, k=5, seed=0):
+    """k (train, validation) row index pairs of a cache index, grouped by patient when it has patient ids
+
+    Every patient is in exactly one validation fold. Patients are shuffled and
+    then given, largest first, to the fold with the fewest slices so far, so
+    folds stay balanced when patients have different numbers of slices.
+    """
+    rng = np.random.default_rng(seed)
+    groups = index['patient_id'].to_numpy() if 'patient_id' in index else np.arange(len(index))
+    unique, counts = np.unique(groups, return_counts=True)
+    if len(unique) < k:
+        raise ValueError(f"{k} folds need at least {k} patients, the dataset has {len(unique)}")
+    order = rng.permutation(len(unique))
+    order = order[np.argsort(-counts[order], kind='stable')]
+    sizes = np.zeros(k, dtype=np.int64)
+    fold_of = {}
+    for i in order:
+        fold = int(np.argmin(sizes))
+        fold_of[unique[i]] = fold
+        sizes[fold] += counts[i]
+    assignment = np.array([fold_of[g] for g in groups])
+    return [(np.flatnonzero(assignment != fold), np.flatnonzero(assignment == fold)) for fold in range(k)]
+
+
+def load_arrays(images, masks, indices):
+    """Float32 model inputs in [0, 1] and 0/1 masks of a selection of cached samples"""
+    indices = np.asarray(indices)
+    return np.asarray(images[indices], dtype=np.float32) / 255.0, np.asarray(masks[indices], dtype=np.float32)
+
+
+def training_dataset(images, masks, indices, batch_size=8, augmenter=None, seed=0):
+    """Endless tf.data stream of float batches read from cached arrays, optionally augmented
+
+    Only index batches go through the pipeline; pixels are read from the
+    memory-mapped cache per batch, so parallel trials share one copy in the
+    page cache.
+    """
+    import tensorflow as tf
+
+    size, channels = images.shape[1], images.shape[3]
+
+    def load(batch):
+        return load_arrays(images, masks, batch)
+
+    def read(index, batch):
+        x, y = tf.numpy_function(load, [batch], [tf.float32, tf.float32])
+        x.set_shape([None, size, size, channels])
+        y.set_shape([None, size, size, 1])
+        if augmenter is not None:
+            x, y = augmenter(x, y, tf.stack([tf.cast(seed, tf.int64), index]))
+        return x, y
+
+    dataset = tf.data.Dataset.from_tensor_slices(np.asarray(indices))
+    dataset = dataset.shuffle(len(indices), seed=seed, reshuffle_each_iteration=True).repeat()
+    dataset = dataset.batch(batch_size).enumerate()
+    return dataset.map(read, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True).prefetch(tf.data.AUTOTUNE)
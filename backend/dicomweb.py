@@ -0,0 +1,377 @@
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import numpy as np
+import pydicom
+from volume import Volume, dicom_affine, load_volume
+
+logger = logging.getLogger(__name__)
+
+# STOW-RS response attributes and failure reasons (PS3.18 / PS3.4)
+REFERENCED_SOP_SEQUENCE = '00081199'
+FAILED_SOP_SEQUENCE = '00081198'
+REFERENCED_SOP_CLASS_UID = '00081150'
+REFERENCED_SOP_INSTANCE_UID = '00081155'
+FAILURE_REASON = '00081197'
+PROCESSING_FAILURE = 0x0110
+STUDY_MISMATCH = 0xA900
+CANNOT_UNDERSTAND = 0xC000
+
+MAX_HEADER_BYTES = 16 * 1024
+
+# UI value representation: numeric components separated by dots, at most 64 characters (PS3.5 9.1),
+# which also rules out '.' and '..'
+UID_PATTERN = re.compile(r'^(?=.{1,64}$)[0-9]+(\.[0-9]+)*$')
+
+
+def check_uid(uid):
+    """Return a UID that is safe to use as a file name, or raise ValueError"""
+    if not isinstance(uid, str) or not UID_PATTERN.match(uid):
+        raise ValueError(f"Invalid DICOM UID: {uid!r}")
+    return uid
+
+
+def contained_path(root, *parts):
+    """Join parts onto root and raise ValueError unless the resolved path is strictly inside root"""
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, *parts))
+    if path == root or os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Path escapes {root}: {path}")
+    return path
+
+
+class MultipartRelatedParser:
+    """Incremental multipart/related parser that spools each part to a file as it arrives
+
+    feed() takes chunks of any size and returns the parts completed so far as
+    (headers, path) tuples; headers have lower-case names. Only the boundary
+    tail is kept in memory, so part size does not affect memory use.
+    """
+
+    def __init__(self, boundary, spool_dir):
+        self.delimiter = b'--' + boundary.encode('latin-1')
+        self.spool_dir = spool_dir
+        self.done = False
+        self._buffer = b''
+        self._state = 'preamble'
+        self._headers = None
+        self._file = None
+        self._path = None
+
+    def feed(self, data):
+        self._buffer += data
+        parts = []
+        while not self.done:
+            if self._state == 'preamble':
+                index = self._buffer.find(self.delimiter)
+                if index < 0:
+                    self._buffer = self._buffer[-len(self.delimiter):]
+                    break
+                self._buffer = self._buffer[index + len(self.delimiter):]
+                self._state = 'after_delimiter'
+            elif self._state == 'after_delimiter':
+                # The delimiter line ends with CRLF, or with "--" after the last part
+                if len(self._buffer) < 2:
+                    break
+                if self._buffer.startswith(b'--'):
+                    self.done = True
+                    break
+                index = self._buffer.find(b'\r\n')
+                if index < 0:
+                    break
+                self._buffer = self._buffer[index + 2:]
+                self._state = 'headers'
+            elif self._state == 'headers':
+                if self._buffer.startswith(b'\r\n'):
+                    block, self._buffer = b'', self._buffer[2:]
+                else:
+                    index = self._buffer.find(b'\r\n\r\n')
+                    if index < 0:
+                        if len(self._buffer) > MAX_HEADER_BYTES:
+                            raise ValueError("Multipart part headers too large")
+                        break
+                    block, self._buffer = self._buffer[:index], self._buffer[index + 4:]
+                self._headers = self._parse_headers(block)
+                fd, self._path = tempfile.mkstemp(suffix='.part', dir=self.spool_dir)
+                self._file = os.fdopen(fd, 'wb')
+                self._state = 'body'
+            else:
+                index = self._buffer.find(b'\r\n' + self.delimiter)
+                if index < 0:
+                    # Keep enough bytes to recognise a delimiter split across chunks
+                    keep = len(self.delimiter) + 1
+                    if len(self._buffer) > keep:
+                        self._file.write(self._buffer[:-keep])
+                        self._buffer = self._buffer[-keep:]
+                    break
+                self._file.write(self._buffer[:index])
+                self._file.close()
+                parts.append((self._headers, self._path))
+                self._file = None
+                self._buffer = self._buffer[index + 2 + len(self.delimiter):]
+                self._state = 'after_delimiter'
+        return parts
+
+    @staticmethod
+    def _parse_headers(block):
+        headers = {}
+        for line in block.decode('latin-1').split('\r\n'):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def close(self):
+        """Remove the spool file of an unfinished part; returns True if the stream ended properly"""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._path)
+            self._file = None
+        return self.done
+
+
+def store_instances(stream, boundary, spool_dir, on_instance, study_uid=None, chunk_size=1 << 16):
+    """Parse a STOW-RS request body and hand each stored instance to on_instance(metadata)
+
+    Instances are checked as soon as their part is complete, while the rest of
+    the body is still being received. Returns (stored, failed) lists of
+    (sop_class_uid, sop_instance_uid[, failure_reason]). A body that is cut
+    off or malformed after some parts were handled still returns them, with
+    the unread rest counted as one failed entry; ValueError is only raised
+    when no part was handled.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    parser = MultipartRelatedParser(boundary, spool_dir)
+    stored, failed = [], []
+
+    def handle(headers, path):
+        content_type = headers.get('content-type', 'application/dicom').split(';')[0].strip().lower()
+        if content_type != 'application/dicom':
+            os.remove(path)
+            failed.append((None, None, CANNOT_UNDERSTAND))
+            return
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True)
+            metadata = {
+                'sop_class_uid': str(ds.SOPClassUID),
+                'sop_instance_uid': str(ds.SOPInstanceUID),
+                'study_uid': str(ds.StudyInstanceUID),
+                'series_uid': str(ds.SeriesInstanceUID)
+            }
+        except Exception as e:
+            logger.warning(f"Could not parse DICOM part: {str(e)}")
+            os.remove(path)
+            failed.append((None, None, CANNOT_UNDERSTAND))
+            return
+        if study_uid and metadata['study_uid'] != study_uid:
+            os.remove(path)
+            failed.append((metadata['sop_class_uid'], metadata['sop_instance_uid'], STUDY_MISMATCH))
+            return
+
+        try:
+            # The UIDs come from the uploaded file and become path components below
+            for name in ('sop_instance_uid', 'study_uid', 'series_uid'):
+                check_uid(metadata[name])
+            series_dir = contained_path(spool_dir, metadata['series_uid'])
+            metadata['path'] = contained_path(series_dir, metadata['sop_instance_uid'] + '.dcm')
+        except ValueError as e:
+            logger.warning(f"Rejected DICOM part: {str(e)}")
+            os.remove(path)
+            failed.append((metadata['sop_class_uid'], None, CANNOT_UNDERSTAND))
+            return
+        os.makedirs(series_dir, exist_ok=True)
+        os.replace(path, metadata['path'])
+        try:
+            on_instance(metadata)
+        except Exception as e:
+            logger.error(f"Could not queue instance {metadata['sop_instance_uid']}: {str(e)}")
+            failed.append((metadata['sop_class_uid'], metadata['sop_instance_uid'], PROCESSING_FAILURE))
+            return
+        stored.append((metadata['sop_class_uid'], metadata['sop_instance_uid']))
+
+    error = None
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            for headers, path in parser.feed(chunk):
+                handle(headers, path)
+            if parser.done:
+                break
+    except ValueError as e:
+        error = str(e)
+    finally:
+        complete = parser.close()
+    if error is None and not complete:
+        error = "Multipart body ended before the closing boundary"
+    if error is not None:
+        if not stored and not failed:
+            raise ValueError(error)
+        # The earlier instances are already stored and queued, so they are reported rather than failing the request
+        logger.warning(f"STOW body not fully read after {len(stored) + len(failed)} parts: {error}")
+        failed.append((None, None, CANNOT_UNDERSTAND))
+    return stored, failed
+
+
+def stow_response(stored, failed):
+    """DICOM JSON body and HTTP status of a STOW-RS response"""
+    def reference(sop_class_uid, sop_instance_uid, reason=None):
+        item = {}
+        if sop_class_uid:
+            item[REFERENCED_SOP_CLASS_UID] = {'vr': 'UI', 'Value': [sop_class_uid]}
+        if sop_instance_uid:
+            item[REFERENCED_SOP_INSTANCE_UID] = {'vr': 'UI', 'Value': [sop_instance_uid]}
+        if reason is not None:
+            item[FAILURE_REASON] = {'vr': 'US', 'Value': [reason]}
+        return item
+
+    body = {}
+    if stored:
+        body[REFERENCED_SOP_SEQUENCE] = {'vr': 'SQ', 'Value': [reference(*s) for s in stored]}
+    if failed:
+        body[FAILED_SOP_SEQUENCE] = {'vr': 'SQ', 'Value': [reference(*f) for f in failed]}
+    if not failed:
+        return body, 200
+    return body, 202 if stored else 409
+
+
+def series_volume(paths):
+    """Sort single-frame instances of a series along the slice normal and open them as a lazy Volume"""
+    headers = [pydicom.dcmread(path, stop_before_pixels=True) for path in paths]
+    if len(headers) == 1 and int(headers[0].get('NumberOfFrames', 1) or 1) > 1:
+        return load_volume(paths[0])
+
+    def position(ds):
+        if 'ImagePositionPatient' in ds and 'ImageOrientationPatient' in ds:
+            orientation = np.array(ds.ImageOrientationPatient, dtype=np.float64)
+            return float(np.dot(np.cross(orientation[:3], orientation[3:]), np.array(ds.ImagePositionPatient, dtype=np.float64)))
+        return float(ds.get('InstanceNumber', 0) or 0)
+
+    order = sorted(range(len(paths)), key=lambda i: position(headers[i]))
+    paths = [paths[i] for i in order]
+    first = headers[order[0]]
+    positions = [position(headers[i]) for i in order]
+    slice_spacing = float(np.median(np.diff(positions))) if len(positions) > 1 else 0.0
+    if slice_spacing <= 0:
+        slice_spacing = float(first.get('SpacingBetweenSlices', first.get('SliceThickness', 1.0)) or 1.0)
+    row_spacing, column_spacing = (float(s) for s in first.get('PixelSpacing', (1.0, 1.0)))
+    return Volume(
+        depth=len(paths),
+        shape=(first.Rows, first.Columns),
+        read_slice=lambda z: pydicom.dcmread(paths[z]).pixel_array.astype(np.float32),
+        spacing=(row_spacing, column_spacing, slice_spacing),
+        affine=dicom_affine(first, row_spacing, column_spacing, slice_spacing),
+        headers=[headers[i] for i in order]
+    )
+
+
+class SeriesQueue:
+    """Groups stored instances by series and segments each series once no instance arrived for a while
+
+    DICOM has no end-of-series marker, so a series counts as complete after
+    idle_seconds without new instances. Complete series are segmented one at a
+    time on a worker thread by segment_fn(volume, output_dir) -> (mask, summary),
+    which can write its exports to output_dir = results_dir/<SeriesInstanceUID>/.
+    """
+
+    def __init__(self, segment_fn, results_dir, idle_seconds=5.0):
+        self.segment_fn = segment_fn
+        self.results_dir = results_dir
+        self.idle_seconds = idle_seconds
+        os.makedirs(results_dir, exist_ok=True)
+        self._series = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._monitor, name='series-monitor', daemon=True).start()
+        threading.Thread(target=self._worker, name='series-worker', daemon=True).start()
+
+    def add(self, metadata):
+        with self._lock:
+            series = self._series.get(metadata['series_uid'])
+            if series is None or series['state'] != 'receiving':
+                # A series that arrives again after completion is segmented again with all its instances
+                previous = series['instances'] if series else {}
+                series = {'series_uid': metadata['series_uid'], 'study_uid': metadata['study_uid'],
+                          'state': 'receiving', 'instances': dict(previous)}
+                self._series[metadata['series_uid']] = series
+            series['instances'][metadata['sop_instance_uid']] = metadata['path']
+            series['last_received'] = time.time()
+
+    def _monitor(self):
+        while True:
+            time.sleep(min(1.0, self.idle_seconds / 2))
+            self.flush(idle_seconds=self.idle_seconds)
+
+    def flush(self, idle_seconds=0.0):
+        """Queue every series that has been idle for idle_seconds; returns their UIDs"""
+        now = time.time()
+        queued = []
+        with self._lock:
+            for series in self._series.values():
+                if series['state'] == 'receiving' and now - series['last_received'] >= idle_seconds:
+                    series['state'] = 'queued'
+                    queued.append(series['series_uid'])
+                    self._queue.put(series['series_uid'])
+        return queued
+
+    def _worker(self):
+        while True:
+            series_uid = self._queue.get()
+            with self._lock:
+                series = self._series[series_uid]
+                series['state'] = 'segmenting'
+                paths = sorted(series['instances'].values())
+            try:
+                start = time.perf_counter()
+                volume = series_volume(paths)
+                output_dir = self.result_dir(series_uid)
+                os.makedirs(output_dir, exist_ok=True)
+                mask, summary = self.segment_fn(volume, output_dir)
+                summary['series_uid'] = series_uid
+                summary['instances'] = len(paths)
+                with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+                    json.dump(summary, f)
+                update = {'state': 'completed', 'seconds': time.perf_counter() - start,
+                          'tumor_volume_ml': summary.get('tumor_volume_ml')}
+                logger.info(f"Segmented series {series_uid} ({len(paths)} instances)")
+            except Exception as e:
+                logger.error(f"Failed to segment series {series_uid}: {str(e)}")
+                update = {'state': 'failed', 'error': str(e)}
+            with self._lock:
+                # New instances may have reopened the series in the meantime
+                if self._series[series_uid] is series:
+                    series.update(update)
+
+    def status(self, series_uid=None):
+        with self._lock:
+            if series_uid is not None:
+                series = self._series.get(series_uid)
+                if series is None:
+                    raise KeyError(f"Unknown series: {series_uid}")
+                return self._describe(series)
+            return [self._describe(series) for series in self._series.values()]
+
+    def _describe(self, series):
+        status = {k: v for k, v in series.items() if k != 'instances'}
+        status['instances'] = len(series['instances'])
+        return status
+
+    def result_dir(self, series_uid):
+        """Output directory of a series; raises ValueError for a UID that is not a valid DICOM UID"""
+        return contained_path(self.results_dir, check_uid(series_uid))
+
+    def summary(self, series_uid):
+        try:
+            path = os.path.join(self.result_dir(series_uid), 'summary.json')
+        except ValueError:
+            raise KeyError(f"No results for series: {series_uid}")
+        if not os.path.isfile(path):
+            raise KeyError(f"No results for series: {series_uid}")
+        with open(path) as f:
+            return json.load(f)
@@ -0,0 +1,199 @@
+import argparse
+import json
+import logging
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from dataset_cache import cache_dataset, load_arrays, open_cache, patient_split, training_dataset
+
+logger = logging.getLogger(__name__)
+
+
+def _logits(probabilities):
+    probabilities = tf.clip_by_value(probabilities, 1e-6, 1 - 1e-6)
+    return tf.math.log(probabilities) - tf.math.log1p(-probabilities)
+
+
+def distillation_loss(y_true, student, teacher, alpha=0.5, temperature=2.0):
+    """alpha * focal Tversky on the ground truth + (1 - alpha) * per-pixel soft cross-entropy to the teacher
+
+    Both models end in a sigmoid, so their probabilities are turned back into
+    logits and softened by the temperature; the soft term is scaled by T^2 to
+    keep its gradients comparable to the hard term's.
+    """
+    from model import focal_tversky
+
+    soft_teacher = tf.sigmoid(_logits(teacher) / temperature)
+    soft_student = tf.sigmoid(_logits(student) / temperature)
+    soft = tf.reduce_mean(tf.keras.losses.binary_crossentropy(soft_teacher, soft_student)) * temperature ** 2
+    return alpha * focal_tversky(y_true, student) + (1 - alpha) * soft
+
+
+class Distiller(tf.keras.Model):
+    """Trains a student segmentation model against the ground truth and a frozen teacher's soft masks
+
+    The teacher runs in inference mode on the same (augmented) batch as the
+    student, so its targets always match what the student sees.
+    """
+
+    def __init__(self, student, teacher, alpha=0.5, temperature=2.0):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+        self.alpha = alpha
+        self.temperature = temperature
+        self.loss_tracker = tf.keras.metrics.Mean(name='loss')
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker]
+
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+
+    def train_step(self, data):
+        x, y = data
+        teacher = self.teacher(x, training=False)
+        with tf.GradientTape() as tape:
+            student = self.student(x, training=True)
+            loss = distillation_loss(y, student, teacher, self.alpha, self.temperature)
+        gradients = tape.gradient(loss, self.student.trainable_variables)
+        self.optimizer.apply_gradients(zip(gradients, self.student.trainable_variables))
+        self.loss_tracker.update_state(loss)
+        return {'loss': self.loss_tracker.result()}
+
+
+def tradeoff(models, x_val, y_val, batch_sizes=(1, 8), precision='float32', runs=10, warmup=2):
+    """Parameters, validation Dice and serving latency of each named model, as report rows
+
+    Latency is measured on the optimized inference copy the API serves
+    (optimized_inference), so the numbers match production rather than
+    Model.predict overhead.
+    """
+    from metrics import dice_score
+    from optimized_inference import build_optimized_model, measure_latency
+
+    rows = []
+    for name, model in models.items():
+        served = build_optimized_model(model, precision)
+        predictions = served.predict(x_val)[..., 0] > 0.5
+        row = {
+            'model': name,
+            'parameters': int(model.model.count_params()),
+            'val_dice': float(np.mean(dice_score(y_val[..., 0], predictions))),
+            'latency': {}
+        }
+        for batch_size in batch_sizes:
+            images = np.zeros((batch_size,) + served.input_shape, dtype=np.float32)
+            row['latency'][str(batch_size)] = measure_latency(served.predict, images, runs, warmup)
+        rows.append(row)
+
+    reference = rows[0]
+    for row in rows[1:]:
+        row['dice_change'] = row['val_dice'] - reference['val_dice']
+        row['speedup'] = {b: reference['latency'][b]['p50_ms'] / row['latency'][b]['p50_ms'] for b in row['latency']}
+    return rows
+
+
+def run_distillation(csv_path, teacher_weights=None, teacher_version=None, registry_root='models',
+                     output_dir='distill', size=256, limit=None, epochs=10, batch_size=8, learning_rate=1e-3,
+                     alpha=0.5, temperature=2.0, augment=True, val_fraction=0.2, seed=0, precision='float32',
+                     register=False):
+    """Distill a CompactResUNet from the big ResUNet and report their latency/Dice tradeoff
+
+    With register=True the student is added to the model registry as a
+    'compact_resunet' version (not activated), with the report in its metadata.
+    """
+    from augment import SegmentationAugmenter
+    from evaluate import load_segmentation_model
+    from model_clean import CompactResUNet
+    from registry import ModelRegistry
+
+    os.makedirs(output_dir, exist_ok=True)
+    cache_dir = cache_dataset(csv_path, os.path.join(output_dir, 'cache'), size=size, limit=limit)
+    images, masks, index = open_cache(cache_dir)
+    train_indices, val_indices = patient_split(index, val_fraction, seed)
+
+    teacher = load_segmentation_model(teacher_weights, teacher_version, registry_root)
+    if teacher.model.input_shape[-1] != 1:
+        raise ValueError("Distillation uses single-slice inputs; 2.5D teachers are not supported")
+    if teacher.model.input_shape[1] != size:
+        teacher = teacher.at_resolution(size)
+    student = CompactResUNet(input_size=size)
+
+    distiller = Distiller(student.model, teacher.model, alpha, temperature)
+    distiller.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate))
+    dataset = training_dataset(images, masks, train_indices, batch_size,
+                               SegmentationAugmenter() if augment else None, seed=seed)
+    start = time.perf_counter()
+    distiller.fit(dataset, epochs=epochs, steps_per_epoch=-(-len(train_indices) // batch_size), verbose=2)
+    train_seconds = time.perf_counter() - start
+
+    x_val, y_val = load_arrays(images, masks, val_indices)
+    report = {
+        'csv_path': csv_path,
+        'teacher': teacher_version or teacher_weights or 'untrained',
+        'size': size,
+        'train_samples': int(len(train_indices)),
+        'val_samples': int(len(val_indices)),
+        'epochs': epochs,
+        'alpha': alpha,
+        'temperature': temperature,
+        'augment': augment,
+        'train_seconds': train_seconds,
+        'precision': precision,
+        'models': tradeoff({'teacher': teacher, 'student': student}, x_val, y_val, precision=precision)
+    }
+
+    weights_path = os.path.join(output_dir, 'student.weights.h5')
+    student.model.save_weights(weights_path)
+    if register:
+        manifest = ModelRegistry(registry_root).register(
+            weights_path,
+            architecture='compact_resunet',
+            metadata={'distilled_from': report['teacher'], 'validation_dice': report['models'][1]['val_dice'],
+                      'teacher_dice': report['models'][0]['val_dice'], 'tradeoff': report['models']}
+        )
+        report['registered_version'] = manifest['version']
+
+    with open(os.path.join(output_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Distill the compact residual U-Net from the big segmentation model')
+    parser.add_argument('--csv', required=True, help='CSV with image_path, mask_path and optionally patient_id')
+    parser.add_argument('--teacher-weights', help='Teacher ResUNet weights file')
+    parser.add_argument('--teacher-version', help='Teacher model registry version instead of --teacher-weights')
+    parser.add_argument('--registry', default='models')
+    parser.add_argument('--output', default='distill', help='Directory for the cache, student weights and report')
+    parser.add_argument('--size', type=int, default=256, help='Training resolution (multiple of 16)')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--learning-rate', type=float, default=1e-3)
+    parser.add_argument('--alpha', type=float, default=0.5, help='Weight of the ground truth loss against the teacher')
+    parser.add_argument('--temperature', type=float, default=2.0)
+    parser.add_argument('--no-augment', action='store_true')
+    parser.add_argument('--precision', default='float32', help='Precision of the latency measurement: float32, bfloat16, auto')
+    parser.add_argument('--register', action='store_true', help='Add the student to the registry (not activated)')
+    args = parser.parse_args()
+
+    report = run_distillation(
+        args.csv, args.teacher_weights, args.teacher_version, args.registry, args.output, args.size, args.limit,
+        args.epochs, args.batch_size, args.learning_rate, args.alpha, args.temperature, not args.no_augment,
+        precision=args.precision, register=args.register
+    )
+    for row in report['models']:
+        latency = ', '.join(f"batch {b}: {l['p50_ms']:.1f} ms" for b, l in row['latency'].items())
+        logger.info(f"{row['model']:>8}: {row['parameters']:,} parameters, val Dice {row['val_dice']:.4f}, {latency}")
+    if 'registered_version' in report:
+        logger.info(f"Registered the student as {report['registered_version']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import logging
+import threading
+import weakref
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Gate decisions for one slice
+BLANK = 'blank'
+LOW_RES_NEGATIVE = 'low_res_negative'
+FULL = 'full'
+
+
+def foreground_fraction(images, intensity_threshold=0.1, stride=4):
+    """Fraction of pixels above an intensity threshold for a (N, H, W, 1) batch in [0, 1]
+
+    A strided view is enough to tell empty slices from slices with tissue and
+    keeps the check far cheaper than a model pass.
+    """
+    sample = images[:, ::stride, ::stride]
+    return (sample > intensity_threshold).reshape(len(images), -1).mean(axis=1)
+
+
+def downsample(images, size):
+    """Average-pool a (N, H, W, C) batch to size x size; H and W must be multiples of size"""
+    n, height, width, channels = images.shape
+    fy, fx = height // size, width // size
+    return images.reshape(n, size, fy, size, fx, channels).mean(axis=(2, 4), dtype=np.float32)
+
+
+class SliceGate:
+    """Cheap pre-check that skips the full-resolution U-Net on empty or clearly negative slices
+
+    Slices with almost no foreground are skipped outright. The rest go through
+    the same weights at low resolution, and only slices whose low-resolution
+    tumor probability reaches exit_threshold are segmented at full size. The
+    exit threshold sits below the 0.5 decision threshold so borderline slices
+    still get a full pass.
+    """
+
+    def __init__(self, intensity_threshold=0.1, min_foreground=0.02, low_res_size=128, exit_threshold=0.2):
+        self.intensity_threshold = intensity_threshold
+        self.min_foreground = min_foreground
+        self.low_res_size = low_res_size
+        self.exit_threshold = exit_threshold
+        self._low_res_models = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.counts = {BLANK: 0, LOW_RES_NEGATIVE: 0, FULL: 0}
+
+    def _low_res_model(self, model):
+        with self._lock:
+            low_res = self._low_res_models.get(model)
+            if low_res is None:
+                low_res = model.at_resolution(self.low_res_size)
+                self._low_res_models[model] = low_res
+        return low_res
+
+    def prepare(self, model):
+        """Build the low-resolution copy of a model ahead of its first request"""
+        if self.low_res_size:
+            self._low_res_model(model)
+
+    def check(self, model, images):
+        """Return one decision per preprocessed slice of a (N, H, W, 1) batch"""
+        decisions = np.full(len(images), FULL, dtype=object)
+        if len(images) == 0:
+            return decisions
+
+        decisions[foreground_fraction(images, self.intensity_threshold) < self.min_foreground] = BLANK
+        remaining = np.flatnonzero(decisions == FULL)
+
+        if self.low_res_size and len(remaining):
+            probabilities = self._low_res_model(model).predict(downsample(images[remaining], self.low_res_size))
+            peak = probabilities.reshape(len(remaining), -1).max(axis=1)
+            decisions[remaining[peak < self.exit_threshold]] = LOW_RES_NEGATIVE
+
+        with self._lock:
+            for decision in (BLANK, LOW_RES_NEGATIVE, FULL):
+                self.counts[decision] += int(np.count_nonzero(decisions == decision))
+        return decisions
+
+    def run(self, model, images):
+        """Full-resolution probabilities for the slices that pass the gate, zeros for the others"""
+        decisions = self.check(model, images)
+        output = np.zeros(images.shape[:3] + (1,), dtype=np.float32)
+        keep = np.flatnonzero(decisions == FULL)
+        if len(keep):
+            output[keep] = model.predict(images[keep])
+        return output, decisions
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            skipped = self.counts[BLANK] + self.counts[LOW_RES_NEGATIVE]
+            return {
+                'slices': total,
+                **self.counts,
+                'skip_rate': skipped / total if total else 0.0
+            }
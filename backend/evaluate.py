@@ -0,0 +1,237 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+import pandas as pd
+from early_exit import FULL, SliceGate
+from volume import expand_context
+from metrics import dice_score, segmentation_metrics, hausdorff_distance, dice_from_counts, iou_from_counts, tversky_from_counts
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+METRIC_COLUMNS = ['dice', 'iou', 'tversky', 'hausdorff']
+
+
+def load_pair(image_path, mask_path, size=256):
+    """Read an MRI slice and its ground truth mask as model input and binary mask"""
+    from model_clean import preprocess_image
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Could not read image file: {image_path}")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not read mask file: {mask_path}")
+    mask = cv2.resize(mask, (size, size), interpolation=cv2.INTER_NEAREST) > 127
+
+    return preprocess_image(image)[0], mask
+
+
+def iter_batches(csv_path, batch_size, limit=None, tumor_only=False):
+    """Stream brain_df-style CSV rows in batches without loading the whole table"""
+    remaining = limit
+    for chunk in pd.read_csv(csv_path, chunksize=batch_size):
+        if tumor_only and 'mask' in chunk:
+            chunk = chunk[chunk['mask'] == 1]
+        if remaining is not None:
+            chunk = chunk.iloc[:remaining]
+            remaining -= len(chunk)
+        if len(chunk) > 0:
+            yield chunk
+        if remaining is not None and remaining <= 0:
+            break
+
+
+def _hausdorff(pair):
+    y_true, y_pred = pair
+    return hausdorff_distance(y_true, y_pred, percentile=95)
+
+
+def load_segmentation_model(weights_path=None, version=None, registry_root='models'):
+    """Load a registry version, a raw weights file or (with neither) an untrained model"""
+    from model_clean import ResUNet
+    from registry import ModelRegistry
+
+    if version:
+        return ModelRegistry(registry_root).load(version)
+    model = ResUNet()
+    if weights_path:
+        model.model.load_weights(weights_path)
+    return model
+
+
+def evaluate(model, csv_path, batch_size=32, workers=None, threshold=0.5, limit=None, tumor_only=False, gate=None):
+    """Run batched inference over the dataset and return per-image metrics as a DataFrame
+
+    With an early_exit.SliceGate every slice still gets a full pass, so the
+    metrics of gated inference (skipped slices predict no tumor) can be compared
+    with the full model on the same images.
+    """
+    workers = workers or os.cpu_count()
+    rows = []
+    if gate is not None:
+        gate.prepare(model)
+
+    with ThreadPoolExecutor(max_workers=workers) as io_pool, \
+            ThreadPoolExecutor(max_workers=1) as prefetcher, \
+            ProcessPoolExecutor(max_workers=workers) as cpu_pool:
+
+        def load_chunk(chunk):
+            return chunk, list(io_pool.map(load_pair, chunk['image_path'], chunk['mask_path']))
+
+        # Decode the next batch in the background while the current one runs through the model
+        batches = iter_batches(csv_path, batch_size, limit, tumor_only)
+        chunk = next(batches, None)
+        future = prefetcher.submit(load_chunk, chunk) if chunk is not None else None
+
+        while future is not None:
+            chunk, pairs = future.result()
+            next_chunk = next(batches, None)
+            future = prefetcher.submit(load_chunk, next_chunk) if next_chunk is not None else None
+
+            images = expand_context(np.stack([image for image, _ in pairs]), model.model.input_shape[-1])
+            y_true = np.stack([mask for _, mask in pairs])
+            if gate is not None:
+                start = time.perf_counter()
+                decisions = gate.check(model, images)
+                gate_ms = (time.perf_counter() - start) * 1000 / len(pairs)
+            start = time.perf_counter()
+            y_pred = model.predict(images)[..., 0] > threshold
+            full_ms = (time.perf_counter() - start) * 1000 / len(pairs)
+
+            metrics = segmentation_metrics(y_true, y_pred)
+            metrics['hausdorff'] = np.fromiter(
+                cpu_pool.map(_hausdorff, zip(y_true, y_pred), chunksize=8), dtype=np.float64, count=len(pairs)
+            )
+            batch = pd.DataFrame(metrics)
+            batch['image_path'] = chunk['image_path'].values
+            if 'patient_id' in chunk:
+                batch['patient_id'] = chunk['patient_id'].values
+            batch['has_tumor'] = y_true.reshape(len(pairs), -1).any(axis=1)
+            batch['predicted_tumor'] = y_pred.reshape(len(pairs), -1).any(axis=1)
+            batch['full_ms'] = full_ms
+            if gate is not None:
+                passed = decisions == FULL
+                batch['early_exit'] = decisions
+                batch['gate_ms'] = gate_ms
+                batch['dice_early_exit'] = np.where(passed, batch['dice'], dice_score(y_true, np.zeros_like(y_pred)))
+                batch['predicted_tumor_early_exit'] = batch['predicted_tumor'] & passed
+            rows.append(batch)
+            logger.info(f"Evaluated {sum(len(r) for r in rows)} images")
+
+    return pd.concat(rows, ignore_index=True) if rows else pd.DataFrame(columns=METRIC_COLUMNS)
+
+
+def summarize(results):
+    """Aggregate per-image metrics overall and per patient"""
+    def describe(frame):
+        finite = frame.replace([np.inf, -np.inf], np.nan)
+        return {
+            column: {
+                'mean': float(finite[column].mean()),
+                'median': float(finite[column].median())
+            }
+            for column in METRIC_COLUMNS
+        }
+
+    if results.empty:
+        # An empty evaluation has no classification columns to score
+        return {'images': 0}
+
+    summary = {
+        'images': int(len(results)),
+        'per_image': describe(results),
+        'detection': {
+            'sensitivity': float((results['predicted_tumor'] & results['has_tumor']).sum() / max(results['has_tumor'].sum(), 1)),
+            'specificity': float((~results['predicted_tumor'] & ~results['has_tumor']).sum() / max((~results['has_tumor']).sum(), 1))
+        }
+    }
+
+    if 'early_exit' in results:
+        # Sensitivity and Dice when skipped slices are predicted empty, next to the full model's
+        passed = results['early_exit'] == FULL
+        has_tumor = results['has_tumor']
+        gated_ms = results['gate_ms'].sum() + results.loc[passed, 'full_ms'].sum()
+        summary['early_exit'] = {
+            'skip_rate': float(1 - passed.mean()),
+            'decisions': {k: int(v) for k, v in results['early_exit'].value_counts().items()},
+            'skipped_tumor_slices': int((~passed & has_tumor).sum()),
+            'sensitivity': float((results['predicted_tumor_early_exit'] & has_tumor).sum() / max(has_tumor.sum(), 1)),
+            'sensitivity_change': float(
+                ((results['predicted_tumor_early_exit'] & has_tumor).sum() - (results['predicted_tumor'] & has_tumor).sum())
+                / max(has_tumor.sum(), 1)
+            ),
+            'dice_mean': float(results['dice_early_exit'].mean()),
+            'dice_change': float(results['dice_early_exit'].mean() - results['dice'].mean()),
+            'estimated_speedup': float(results['full_ms'].sum() / gated_ms) if gated_ms > 0 else 1.0
+        }
+
+    if 'patient_id' in results:
+        # Volumetric scores from the summed pixel counts of each patient's slices
+        counts = results.groupby('patient_id')[['tp', 'fp', 'fn']].sum()
+        patients = pd.DataFrame({
+            'dice': dice_from_counts(counts['tp'], counts['fp'], counts['fn']),
+            'iou': iou_from_counts(counts['tp'], counts['fp'], counts['fn']),
+            'tversky': tversky_from_counts(counts['tp'], counts['fp'], counts['fn']),
+            'hausdorff': results.replace([np.inf, -np.inf], np.nan).groupby('patient_id')['hausdorff'].max()
+        })
+        summary['patients'] = int(len(patients))
+        summary['per_patient'] = describe(patients)
+        summary['patient_scores'] = patients.reset_index().to_dict(orient='records')
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the segmentation model over a brain_df-style CSV')
+    parser.add_argument('--csv', required=True, help='CSV with image_path, mask_path and optionally patient_id and mask')
+    parser.add_argument('--weights', help='Segmentation weights to load into the model')
+    parser.add_argument('--version', help='Model registry version to evaluate instead of --weights')
+    parser.add_argument('--registry', default='models', help='Model registry directory')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=None, help='Worker threads/processes (default: all cores)')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--tumor-only', action='store_true', help='Only evaluate rows with mask == 1')
+    parser.add_argument('--early-exit', action='store_true', help='Also report skip rate and accuracy of early-exit inference')
+    parser.add_argument('--min-foreground', type=float, default=0.02, help='Early exit: skip slices with less foreground')
+    parser.add_argument('--exit-threshold', type=float, default=0.2, help='Early exit: skip slices below this low-res probability')
+    parser.add_argument('--low-res-size', type=int, default=128, help='Early exit: low-res pass size (0 disables the pass)')
+    parser.add_argument('--output', default='evaluation.json', help='JSON report path')
+    parser.add_argument('--per-image-csv', default=None, help='Optional CSV with per-image metrics')
+    args = parser.parse_args()
+
+    model = load_segmentation_model(args.weights, args.version, args.registry)
+    gate = None
+    if args.early_exit:
+        gate = SliceGate(min_foreground=args.min_foreground, low_res_size=args.low_res_size,
+                         exit_threshold=args.exit_threshold)
+
+    start = time.perf_counter()
+    results = evaluate(model, args.csv, args.batch_size, args.workers, args.threshold, args.limit, args.tumor_only, gate)
+    elapsed = time.perf_counter() - start
+
+    report = summarize(results)
+    report['seconds'] = elapsed
+    report['images_per_second'] = len(results) / elapsed if elapsed > 0 else 0.0
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, default=float)
+    if args.per_image_csv:
+        results.to_csv(args.per_image_csv, index=False)
+
+    logger.info(f"Evaluated {report['images']} images in {elapsed:.1f}s, mean Dice {report['per_image']['dice']['mean']:.4f}")
+
+
+if __name__ == '__main__':
+    main()
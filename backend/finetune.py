@@ -0,0 +1,251 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from metrics import dice_score
+
+logger = logging.getLogger(__name__)
+
+
+def write_status(status_path, status):
+    if status_path is None:
+        return
+    tmp_path = status_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, status_path)
+
+
+def read_status(status_path):
+    if not status_path or not os.path.exists(status_path):
+        return {'state': 'idle'}
+    with open(status_path) as f:
+        return json.load(f)
+
+
+def load_shards(store, shards):
+    """Concatenate the training tensors of several shards"""
+    images, masks = [], []
+    for shard in shards:
+        x, y = store.load_shard(shard['path'])
+        images.append(x)
+        masks.append(y)
+    if not images:
+        return np.zeros((0, 256, 256, 1), np.float32), np.zeros((0, 256, 256, 1), np.float32)
+    return np.concatenate(images), np.concatenate(masks)
+
+
+def predict_soft(model, images, batch_size=32):
+    return model.model.predict(images, batch_size=batch_size, verbose=0)[..., 0]
+
+
+def validation_dice(model, images, masks):
+    """Mean Dice of thresholded predictions against binary masks"""
+    if len(images) == 0:
+        return float('nan')
+    return float(np.mean(dice_score(masks[..., 0], predict_soft(model, images) > 0.5)))
+
+
+def select_replay(model, images, masks, size, hard_fraction=0.5, rng=None, mining_pool=2048):
+    """Pick old examples to replay: the ones the current model gets most wrong plus a random sample"""
+    rng = rng or np.random.default_rng()
+    if len(images) <= size:
+        return np.arange(len(images))
+
+    # Only score a random subset of the old data so mining cost does not grow with the dataset
+    candidates = rng.choice(len(images), min(mining_pool, len(images)), replace=False)
+    n_hard = min(int(size * hard_fraction), len(candidates))
+    scores = dice_score(masks[candidates, ..., 0], predict_soft(model, images[candidates]))
+    hard = candidates[np.argsort(scores)[:n_hard]]
+    rest = np.setdiff1d(np.arange(len(images)), hard)
+    return np.concatenate([hard, rng.choice(rest, size - n_hard, replace=False)])
+
+
+def run_finetune(registry_root='models', store_root='dataset', epochs=5, batch_size=8, learning_rate=1e-4,
+                 replay_size=256, hard_fraction=0.5, validation_fraction=0.2, min_improvement=0.0,
+                 status_path=None, seed=0, augment=True):
+    """Fine-tune the active model on annotations it has not been trained on and publish it if Dice improves"""
+    from tensorflow.keras.optimizers import Adam
+    from annotation_store import AnnotationStore
+    from model import focal_tversky, tversky
+    from registry import ModelRegistry
+
+    status = {'state': 'running', 'started_at': time.time()}
+    write_status(status_path, status)
+    rng = np.random.default_rng(seed)
+
+    try:
+        registry = ModelRegistry(registry_root)
+        store = AnnotationStore(store_root)
+
+        base_version = registry.get_active()
+        if base_version is None:
+            raise ValueError("No active model version to fine-tune")
+        base_manifest = registry.manifest(base_version)
+        last_shard_id = base_manifest['metadata'].get('last_shard_id', 0)
+        status['base_version'] = base_version
+
+        # Everything saved since the base version was trained becomes new data
+        store.export_shard()
+        new_shards = store.shards(after_id=last_shard_id)
+        old_shards = [s for s in store.shards() if s['id'] <= last_shard_id]
+        x_new, y_new = load_shards(store, new_shards)
+        status['new_samples'] = int(len(x_new))
+        if len(x_new) == 0:
+            status.update(state='skipped', reason='No new annotations', finished_at=time.time())
+            write_status(status_path, status)
+            return status
+
+        model = registry.load(base_version)
+        if model.model.input_shape[-1] != 1:
+            raise ValueError("Annotations are single slices; 2.5D models cannot be fine-tuned on them")
+
+        # Hold out part of the new data and of the replay pool for validation
+        order = rng.permutation(len(x_new))
+        n_val = max(1, int(len(x_new) * validation_fraction)) if len(x_new) > 1 else 0
+        val_idx, train_idx = order[:n_val], order[n_val:]
+        x_old, y_old = load_shards(store, old_shards)
+        replay = select_replay(model, x_old, y_old, replay_size, hard_fraction, rng) if len(x_old) else np.arange(0)
+        # select_replay lists the hard examples first; shuffle so they are split between training and validation too
+        replay = rng.permutation(replay)
+        n_replay_val = int(len(replay) * validation_fraction)
+        x_train = np.concatenate([x_new[train_idx], x_old[replay[n_replay_val:]]])
+        y_train = np.concatenate([y_new[train_idx], y_old[replay[n_replay_val:]]])
+        x_val = np.concatenate([x_new[val_idx], x_old[replay[:n_replay_val]]])
+        y_val = np.concatenate([y_new[val_idx], y_old[replay[:n_replay_val]]])
+        status['replay_samples'] = int(len(replay))
+        if len(x_val) == 0:
+            # Without held-out samples there is no evidence the fine-tuned model is better, so nothing is published
+            status.update(state='skipped', reason='Not enough annotations for a validation set',
+                          finished_at=time.time())
+            write_status(status_path, status)
+            return status
+
+        baseline = validation_dice(model, x_val, y_val)
+        status['baseline_dice'] = baseline
+        write_status(status_path, status)
+
+        model.model.compile(optimizer=Adam(learning_rate=learning_rate), loss=focal_tversky, metrics=[tversky])
+        if augment:
+            # Augmented batches are produced by tf.data in parallel with the training steps
+            from augment import augmented_dataset
+            dataset = augmented_dataset(x_train, y_train, batch_size, seed=seed, repeat=True)
+            model.model.fit(dataset, epochs=epochs, steps_per_epoch=-(-len(x_train) // batch_size), verbose=2)
+        else:
+            model.model.fit(x_train, y_train, epochs=epochs, batch_size=batch_size, shuffle=True, verbose=2)
+
+        finetuned = validation_dice(model, x_val, y_val)
+        status['finetuned_dice'] = finetuned
+        logger.info(f"Validation Dice {baseline:.4f} -> {finetuned:.4f}")
+
+        if not finetuned > baseline + min_improvement:
+            status.update(state='completed', published_version=None, finished_at=time.time())
+            write_status(status_path, status)
+            return status
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            weights_path = os.path.join(tmp_dir, 'finetuned.weights.h5')
+            model.model.save_weights(weights_path)
+            manifest = registry.register(
+                weights_path,
+                architecture=base_manifest['architecture'],
+                metadata={
+                    'base_version': base_version,
+                    'last_shard_id': new_shards[-1]['id'],
+                    'validation_dice': finetuned,
+                    'baseline_dice': baseline,
+                    'train_samples': int(len(x_train))
+                }
+            )
+        status.update(state='completed', published_version=manifest['version'], finished_at=time.time())
+    except Exception as e:
+        logger.error(f"Fine-tuning failed: {str(e)}")
+        status.update(state='failed', error=str(e), finished_at=time.time())
+
+    write_status(status_path, status)
+    return status
+
+
+class FineTuneJob:
+    """Runs the fine-tuning CLI in a low-priority background process, one job at a time
+
+    A separate interpreter is used instead of multiprocessing so the child does
+    not re-import the API module or inherit TensorFlow state from the server.
+    """
+
+    def __init__(self, status_path, on_published=None, niceness=10, threads=None):
+        self.status_path = status_path
+        self.on_published = on_published
+        self.niceness = niceness
+        self.threads = threads or max(1, (os.cpu_count() or 2) // 2)
+        self._process = None
+        self._lock = threading.Lock()
+
+    def running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, registry_root='models', store_root='dataset', epochs=5, batch_size=8):
+        """Start a job unless one is already running; returns False if it was"""
+        with self._lock:
+            if self.running():
+                return False
+            write_status(self.status_path, {'state': 'starting', 'started_at': time.time()})
+            command = [
+                sys.executable, os.path.abspath(__file__),
+                '--registry', registry_root, '--store', store_root,
+                '--epochs', str(epochs), '--batch-size', str(batch_size),
+                '--threads', str(self.threads), '--status', self.status_path
+            ]
+            self._process = subprocess.Popen(command, preexec_fn=lambda: os.nice(self.niceness))
+            threading.Thread(target=self._watch, args=(self._process,), daemon=True).start()
+            return True
+
+    def _watch(self, process):
+        process.wait()
+        status = self.status()
+        if status.get('state') in ('starting', 'running'):
+            # The process died without writing a final status
+            status.update(state='failed', error=f'Process exited with code {process.returncode}')
+            write_status(self.status_path, status)
+        elif status.get('published_version') and self.on_published is not None:
+            self.on_published(status['published_version'])
+
+    def status(self):
+        status = read_status(self.status_path)
+        status['running'] = self.running()
+        return status
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Fine-tune the active model on newly saved annotations')
+    parser.add_argument('--registry', default='models')
+    parser.add_argument('--store', default='dataset')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--learning-rate', type=float, default=1e-4)
+    parser.add_argument('--replay-size', type=int, default=256)
+    parser.add_argument('--min-improvement', type=float, default=0.0)
+    parser.add_argument('--no-augment', action='store_true', help='Train on the annotations as they are')
+    parser.add_argument('--status', default=None, help='Write job status JSON to this file')
+    parser.add_argument('--threads', type=int, default=0, help='TensorFlow intra-op threads (0 = default)')
+    args = parser.parse_args()
+
+    if args.threads:
+        from memory import configure_tensorflow
+        configure_tensorflow(intra_op_threads=args.threads, inter_op_threads=1)
+
+    status = run_finetune(args.registry, args.store, args.epochs, args.batch_size, args.learning_rate,
+                          args.replay_size, min_improvement=args.min_improvement, status_path=args.status,
+                          augment=not args.no_augment)
+    print(json.dumps(status, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import argparse
+import collections
+import gzip
+import hashlib
+import io
+import logging
+import random
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Uncompressed bytes between seek points; each point keeps a copy of the inflater (about 40 KB with its window)
+DEFAULT_SPACING = 4 << 20
+READ_SIZE = 64 << 10
+# Indexes of recently read files, by SHA-256 of the compressed file
+MAX_CACHED_INDEXES = 32
+
+_indexes = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GzipIndex:
+    """Seek points of a gzip file: (uncompressed offset, compressed offset, inflater state)
+
+    Points are added as readers get further into the file, so the first read
+    of a slice only decompresses up to that slice and later reads start from
+    the nearest point before it. The inflater copies cannot be written to
+    disk, so an index lives in memory and is shared through get_index.
+    """
+
+    def __init__(self, spacing=DEFAULT_SPACING):
+        self.spacing = spacing
+        # Start of the first gzip member; 47 makes zlib accept a gzip or zlib header
+        self.points = [(0, 0, zlib.decompressobj(47))]
+        self.size = None
+        self._lock = threading.Lock()
+
+    def nearest(self, offset):
+        """Last seek point at or before an uncompressed offset"""
+        with self._lock:
+            lo, hi = 0, len(self.points) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.points[mid][0] <= offset:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            return self.points[lo]
+
+    def add(self, offset, compressed_offset, inflater):
+        with self._lock:
+            if offset >= self.points[-1][0] + self.spacing:
+                self.points.append((offset, compressed_offset, inflater.copy()))
+
+    def stats(self):
+        with self._lock:
+            return {'points': len(self.points), 'indexed_bytes': self.points[-1][0], 'size': self.size}
+
+
+def get_index(key, spacing=DEFAULT_SPACING):
+    """Shared index of the file with SHA-256 key, created empty on first use"""
+    with _indexes_lock:
+        if key in _indexes:
+            _indexes.move_to_end(key)
+            return _indexes[key]
+        index = _indexes[key] = GzipIndex(spacing)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+        return index
+
+
+class IndexedGzipReader(io.RawIOBase):
+    """Read-only, seekable view of the decompressed contents of a gzip file
+
+    A seek only moves the position; the next read restarts decompression
+    from the index's nearest seek point before it, so nibabel can read a
+    slice of a .nii.gz without decompressing the slices in front of it
+    again (or, on first access, anything behind it).
+    """
+
+    def __init__(self, path, index=None, key=None):
+        self.path = path
+        self.index = index or get_index(key or file_digest(path))
+        self._file = open(path, 'rb')
+        self._position = 0
+        # Decompression state: uncompressed offset it has reached and the inflater to continue with
+        self._offset = None
+        self._inflater = None
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size()
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def _size(self):
+        if self.index.size is None:
+            # Reading to the end records the size
+            self.seek(self.index.points[-1][0])
+            while self.read(READ_SIZE << 4):
+                pass
+        return self.index.size
+
+    def _restart(self):
+        offset, compressed_offset, inflater = self.index.nearest(self._position)
+        self._offset = offset
+        self._inflater = inflater.copy()
+        self._pending = b''
+        self._file.seek(compressed_offset)
+
+    def _inflate(self, limit):
+        """Up to limit decompressed bytes from the current decompression state; b'' at the end of the file"""
+        while True:
+            if self._inflater.eof:
+                # Concatenated gzip members: start a new inflater on the bytes after this member. At the end of a
+                # member zlib moves all input it did not use into unused_data, so _pending holds nothing more
+                rest = self._inflater.unused_data
+                self._inflater = zlib.decompressobj(47)
+                self._pending = rest
+                if not rest:
+                    rest = self._file.read(READ_SIZE)
+                    if not rest:
+                        self.index.size = self._offset
+                        return b''
+                    self._pending = rest
+            if not self._pending:
+                self._pending = self._file.read(READ_SIZE)
+                if not self._pending:
+                    raise EOFError(f"Compressed file ended before the end of the stream: {self.path}")
+            data = self._inflater.decompress(self._pending, limit)
+            self._pending = self._inflater.unconsumed_tail
+            if data:
+                self._offset += len(data)
+                if not self._pending and not self._inflater.eof:
+                    # All input up to the file position is consumed, so the inflater state can be saved
+                    self.index.add(self._offset, self._file.tell(), self._inflater)
+                return data
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if self._offset is None or self._offset > self._position or \
+                self.index.nearest(self._position)[0] > self._offset:
+            self._restart()
+        # Decompress and drop the bytes in front of the read position
+        while self._offset < self._position:
+            if not self._inflate(min(self._position - self._offset, READ_SIZE << 4)):
+                return 0
+        data = self._inflate(len(view))
+        view[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def open_nifti(path, key=None):
+    """nibabel image of a .nii or .nii.gz file; gzipped data is read through a shared seek index
+
+    key is the SHA-256 of the file when the caller already has it. The image
+    keeps its file open, so slices can be read from img.dataobj as needed,
+    until close_nifti(img) is called.
+    """
+    import nibabel as nib
+
+    if not path.lower().endswith('.gz'):
+        return nib.load(path)
+    reader = io.BufferedReader(IndexedGzipReader(path, key=key), buffer_size=READ_SIZE)
+    return nib.Nifti1Image.from_file_map({'image': nib.FileHolder(fileobj=reader)})
+
+
+def close_nifti(img):
+    """Close the file an open_nifti image keeps open; nibabel opens plain .nii files per read"""
+    fileobj = img.file_map['image'].fileobj
+    if fileobj is not None:
+        fileobj.close()
+
+
+def verify(path, reads=200, seed=0, spacing=64 << 10):
+    """Compare random reads through a fresh index with gzip.decompress of the whole file; returns the mismatches
+
+    The small default spacing puts seek points in every member of a
+    multi-member file, so reads restart inside members and cross their
+    boundaries.
+    """
+    with open(path, 'rb') as f:
+        expected = gzip.decompress(f.read())
+    rng = random.Random(seed)
+    mismatches = []
+    reader = IndexedGzipReader(path, index=GzipIndex(spacing))
+    try:
+        if reader.seek(0, io.SEEK_END) != len(expected):
+            mismatches.append(('size', reader.tell(), len(expected)))
+        for _ in range(reads):
+            offset = rng.randrange(len(expected) + 1)
+            length = rng.randrange(1, READ_SIZE << 2)
+            reader.seek(offset)
+            # A raw read can stop short at a member boundary, so read until the length or the end
+            data = b''
+            while len(data) < length:
+                chunk = reader.read(length - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            if data != expected[offset:offset + length]:
+                mismatches.append(('read', offset, length))
+    finally:
+        reader.close()
+    return mismatches
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Time slice reads from a .nii.gz through the seek index')
+    parser.add_argument('input', help='Gzipped NIfTI volume (any gzip file with --verify)')
+    parser.add_argument('--slices', type=int, nargs='*', help='Slices to read (default: middle, last, first)')
+    parser.add_argument('--repeat', type=int, default=2, help='Passes over the slices')
+    parser.add_argument('--verify', type=int, metavar='READS', default=0,
+                        help='Instead of timing, check this many random reads against gzip.decompress')
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatches = verify(args.input, reads=args.verify)
+        for mismatch in mismatches[:10]:
+            logger.error(f"Mismatch: {mismatch}")
+        logger.info(f"{args.verify} random reads, {len(mismatches)} mismatches")
+        raise SystemExit(1 if mismatches else 0)
+
+    key = file_digest(args.input)
+    img = open_nifti(args.input, key=key)
+    depth = img.shape[2]
+    slices = args.slices if args.slices else [depth // 2, depth - 1, 0]
+    for repeat in range(args.repeat):
+        for z in slices:
+            start = time.perf_counter()
+            img.dataobj[:, :, z]
+            logger.info(f"Pass {repeat + 1}, slice {z}: {(time.perf_counter() - start) * 1000:.1f} ms")
+    logger.info(f"Index: {get_index(key).stats()}")
+
+
+if __name__ == '__main__':
+    main()
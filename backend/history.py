@@ -0,0 +1,188 @@
+import contextlib
+import datetime
+import logging
+import os
+import sqlite3
+import time
+import zlib
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS predictions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    day TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    patient_id TEXT,
+    filename TEXT,
+    model_version TEXT,
+    segmented INTEGER NOT NULL,
+    tumor_percentage REAL NOT NULL,
+    tumor_probability REAL,
+    lesions INTEGER NOT NULL,
+    critical INTEGER NOT NULL,
+    processing_ms REAL NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mask BLOB
+);
+CREATE INDEX IF NOT EXISTS predictions_patient ON predictions (patient_id, id);
+CREATE INDEX IF NOT EXISTS predictions_critical ON predictions (critical, id);
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    first_seen REAL NOT NULL,
+    predictions INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT PRIMARY KEY,
+    predictions INTEGER NOT NULL DEFAULT 0,
+    tumor_scans INTEGER NOT NULL DEFAULT 0,
+    critical_cases INTEGER NOT NULL DEFAULT 0,
+    new_patients INTEGER NOT NULL DEFAULT 0,
+    processing_ms REAL NOT NULL DEFAULT 0
+);
+"""
+
+# Aggregates over all days are kept under this key, so totals are a single-row lookup
+TOTAL = 'total'
+
+
+def pack_binary_mask(mask):
+    """Binary mask as zlib-compressed bits, 8 pixels per byte"""
+    return zlib.compress(np.packbits(mask > 0).tobytes(), 6)
+
+
+def unpack_binary_mask(data, height, width):
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(data), dtype=np.uint8), count=height * width)
+    return bits.reshape(height, width)
+
+
+class PredictionHistory:
+    """Persistent log of predictions with aggregates maintained at write time
+
+    Each record adds to a per-day row and to the running total in the same
+    transaction, so dashboard statistics are read from a handful of rows
+    however many predictions exist. History is paged by id (keyset pagination),
+    which stays an index range scan at any depth.
+    """
+
+    def __init__(self, path='history.db', critical_percentage=5.0, store_masks=True):
+        self.path = path
+        self.critical_percentage = critical_percentage
+        self.store_masks = store_masks
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        # WAL only needs a sync at checkpoints; a crash can lose the last commits but not corrupt the log
+        db.execute('PRAGMA synchronous=NORMAL')
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record(self, result, mask, sha256, processing_ms, patient_id=None, filename=None):
+        """Store one /api/predict result and its mask; returns the prediction id"""
+        now = time.time()
+        day = datetime.date.fromtimestamp(now).isoformat()
+        tumor = result['tumor_percentage'] > 0
+        critical = result['tumor_percentage'] >= self.critical_percentage
+        with self._connect() as db:
+            cursor = db.execute(
+                'INSERT INTO predictions (created_at, day, sha256, patient_id, filename, model_version, segmented, '
+                'tumor_percentage, tumor_probability, lesions, critical, processing_ms, width, height, mask) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (now, day, sha256, patient_id, filename, result['model_version'], int(result['segmented']),
+                 result['tumor_percentage'], result['tumor_probability'], len(result['lesions']), int(critical),
+                 processing_ms, mask.shape[1], mask.shape[0], pack_binary_mask(mask) if self.store_masks else None)
+            )
+            new_patient = 0
+            if patient_id:
+                new_patient = db.execute(
+                    'INSERT OR IGNORE INTO patients (patient_id, first_seen, predictions) VALUES (?, ?, 0)',
+                    (patient_id, now)
+                ).rowcount
+                db.execute('UPDATE patients SET predictions = predictions + 1 WHERE patient_id = ?', (patient_id,))
+            db.executemany(
+                'INSERT INTO daily_stats (day, predictions, tumor_scans, critical_cases, new_patients, processing_ms) '
+                'VALUES (?, 1, ?, ?, ?, ?) ON CONFLICT (day) DO UPDATE SET '
+                'predictions = predictions + 1, tumor_scans = tumor_scans + excluded.tumor_scans, '
+                'critical_cases = critical_cases + excluded.critical_cases, '
+                'new_patients = new_patients + excluded.new_patients, '
+                'processing_ms = processing_ms + excluded.processing_ms',
+                [(key, int(tumor), int(critical), new_patient, processing_ms) for key in (day, TOTAL)]
+            )
+        return cursor.lastrowid
+
+    def stats(self, days=7):
+        """All-time totals, totals over the last `days` days and their per-day aggregates, oldest first"""
+        today = datetime.date.today()
+        first = (today - datetime.timedelta(days=days - 1)).isoformat()
+        with self._connect() as db:
+            total = db.execute('SELECT * FROM daily_stats WHERE day = ?', (TOTAL,)).fetchone()
+            rows = {row['day']: dict(row) for row in db.execute(
+                'SELECT * FROM daily_stats WHERE day >= ? AND day != ? ORDER BY day', (first, TOTAL)
+            )}
+
+        def summarize(row):
+            row = dict(row) if row else {'predictions': 0, 'tumor_scans': 0, 'critical_cases': 0,
+                                         'new_patients': 0, 'processing_ms': 0.0}
+            row.pop('day', None)
+            row['mean_processing_ms'] = row['processing_ms'] / row['predictions'] if row['predictions'] else 0.0
+            return row
+
+        daily = []
+        for offset in range(days):
+            day = (today - datetime.timedelta(days=days - 1 - offset)).isoformat()
+            daily.append(dict(summarize(rows.get(day)), day=day))
+        totals = summarize(total)
+        totals['patients'] = totals.pop('new_patients')
+        # Sums over the requested days, so the period selector changes the headline numbers too
+        period = summarize({name: sum(row[name] for row in daily)
+                            for name in ('predictions', 'tumor_scans', 'critical_cases', 'new_patients', 'processing_ms')})
+        return {'totals': totals, 'period_totals': period, 'daily': daily}
+
+    def history(self, limit=50, before=None, patient_id=None, critical=None):
+        """Newest predictions first; pass the returned next_before to get the following page"""
+        conditions, parameters = [], []
+        if before is not None:
+            conditions.append('id < ?')
+            parameters.append(before)
+        if patient_id is not None:
+            conditions.append('patient_id = ?')
+            parameters.append(patient_id)
+        if critical is not None:
+            conditions.append('critical = ?')
+            parameters.append(int(critical))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._connect() as db:
+            rows = db.execute(
+                'SELECT id, created_at, sha256, patient_id, filename, model_version, segmented, tumor_percentage, '
+                f'tumor_probability, lesions, critical, processing_ms, width, height FROM predictions {where} '
+                'ORDER BY id DESC LIMIT ?', parameters + [limit]
+            ).fetchall()
+        items = []
+        for row in rows:
+            item = dict(row)
+            item['segmented'] = bool(item['segmented'])
+            item['critical'] = bool(item['critical'])
+            items.append(item)
+        return {'items': items, 'next_before': items[-1]['id'] if len(items) == limit else None}
+
+    def mask(self, prediction_id):
+        """Stored mask of a prediction as a uint8 0/255 array"""
+        with self._connect() as db:
+            row = db.execute('SELECT mask, width, height FROM predictions WHERE id = ?', (prediction_id,)).fetchone()
+        if row is None or row['mask'] is None:
+            raise KeyError(f"No mask stored for prediction {prediction_id}")
+        return unpack_binary_mask(row['mask'], row['height'], row['width']) * 255
@@ -0,0 +1,282 @@
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import pandas as pd
+from dataset_cache import cache_dataset, open_cache, patient_split
+
+logger = logging.getLogger(__name__)
+
+# Hyperparameters explored by the search: ('log', low, high) is log-uniform, ('choice', values) uniform
+SEARCH_SPACE = {
+    'learning_rate': ('log', 1e-5, 1e-2),
+    'epsilon': ('log', 1e-8, 1e-1),
+    'batch_size': ('choice', [4, 8, 16]),
+    'loss': ('choice', ['focal_tversky', 'binary_crossentropy']),
+    'augment': ('choice', [True, False])
+}
+
+
+def sample_config(rng, space=SEARCH_SPACE):
+    config = {}
+    for name, spec in space.items():
+        if spec[0] == 'log':
+            config[name] = float(math.exp(rng.uniform(math.log(spec[1]), math.log(spec[2]))))
+        else:
+            config[name] = spec[1][rng.integers(len(spec[1]))]
+            if isinstance(config[name], np.generic):
+                config[name] = config[name].item()
+    return config
+
+
+def _init_worker(threads):
+    # Runs in each fresh worker process before TensorFlow is imported there
+    for variable in ('OMP_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[variable] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    from memory import configure_tensorflow
+    configure_tensorflow(intra_op_threads=threads, inter_op_threads=1)
+
+
+def run_trial(trial_id, config, cache_dir, train_indices, val_indices, start_epoch, end_epoch, checkpoint, seed):
+    """Train one trial from start_epoch to end_epoch (resuming its checkpoint) and return its validation Dice"""
+    import tensorflow as tf
+    from augment import SegmentationAugmenter
+    from dataset_cache import load_arrays, training_dataset
+    from metrics import dice_score
+    from model import focal_tversky, tversky
+    from model_clean import ResUNet
+
+    start = time.perf_counter()
+    images, masks, _ = open_cache(cache_dir)
+    if start_epoch > 0:
+        model = tf.keras.models.load_model(checkpoint)
+    else:
+        model = ResUNet(input_size=images.shape[1]).model
+        loss = focal_tversky if config['loss'] == 'focal_tversky' else 'binary_crossentropy'
+        optimizer = tf.keras.optimizers.Adam(learning_rate=config['learning_rate'], epsilon=config['epsilon'])
+        model.compile(optimizer=optimizer, loss=loss, metrics=[tversky])
+
+    augmenter = SegmentationAugmenter() if config['augment'] else None
+    # Resumed runs continue with new seeds instead of replaying the first epochs' batches
+    dataset = training_dataset(images, masks, train_indices, config['batch_size'], augmenter,
+                               seed=seed * 1000 + start_epoch)
+    steps = -(-len(train_indices) // config['batch_size'])
+    model.fit(dataset, initial_epoch=start_epoch, epochs=end_epoch, steps_per_epoch=steps, verbose=0)
+    model.save(checkpoint)
+
+    x_val, y_val = load_arrays(images, masks, val_indices)
+    predictions = model.predict(x_val, batch_size=16, verbose=0)[..., 0] > 0.5
+    val_dice = float(np.mean(dice_score(y_val[..., 0], predictions)))
+    if not np.isfinite(val_dice):
+        val_dice = 0.0
+    return {'trial': trial_id, 'epochs': end_epoch, 'val_dice': val_dice, 'seconds': time.perf_counter() - start}
+
+
+class ASHAScheduler:
+    """Asynchronous successive halving: a trial is promoted to the next rung once it ranks in the top 1/eta
+    of the results seen at its rung, so workers never wait for a rung to fill up"""
+
+    def __init__(self, n_trials, min_epochs=1, max_epochs=27, eta=3):
+        self.n_trials = n_trials
+        self.eta = eta
+        self.milestones = [min_epochs]
+        while self.milestones[-1] * eta <= max_epochs:
+            self.milestones.append(self.milestones[-1] * eta)
+        self.rungs = [dict() for _ in self.milestones]
+        self.promoted = [set() for _ in self.milestones]
+        self.started = 0
+
+    def next_job(self):
+        """(trial, start_epoch, end_epoch) to run next, or None if nothing can start yet"""
+        for rung in range(len(self.milestones) - 2, -1, -1):
+            results = sorted(self.rungs[rung].items(), key=lambda item: -item[1])
+            for trial, _ in results[:len(results) // self.eta]:
+                if trial not in self.promoted[rung]:
+                    self.promoted[rung].add(trial)
+                    return trial, self.milestones[rung], self.milestones[rung + 1]
+        if self.started < self.n_trials:
+            self.started += 1
+            return self.started - 1, 0, self.milestones[0]
+        return None
+
+    def report(self, trial, epochs, score):
+        """Record a result; returns the trial's state ('paused' until promoted, or 'completed')"""
+        rung = self.milestones.index(epochs)
+        self.rungs[rung][trial] = score
+        return 'completed' if rung == len(self.milestones) - 1 else 'paused'
+
+    def fail(self, trial, epochs):
+        # Rank a failed trial last so it is never promoted
+        self.rungs[self.milestones.index(epochs)][trial] = -math.inf
+        self.promoted[self.milestones.index(epochs)].add(trial)
+
+
+class MedianStoppingScheduler:
+    """Random search where each trial trains in steps of min_epochs and stops early when its score is
+    below the median of other trials at the same epoch"""
+
+    def __init__(self, n_trials, min_epochs=1, max_epochs=27, min_peers=3):
+        self.n_trials = n_trials
+        self.milestones = list(range(min_epochs, max_epochs + 1, min_epochs))
+        self.results = {epochs: {} for epochs in self.milestones}
+        self.waiting = []
+        self.started = 0
+        self.min_peers = min_peers
+
+    def next_job(self):
+        # New trials go first so every milestone has peers to compare against before trials continue
+        if self.started < self.n_trials:
+            self.started += 1
+            return self.started - 1, 0, self.milestones[0]
+        if self.waiting:
+            trial, epochs = self.waiting.pop(0)
+            return trial, epochs, self.milestones[self.milestones.index(epochs) + 1]
+        return None
+
+    def report(self, trial, epochs, score):
+        peers = [s for t, s in self.results[epochs].items() if t != trial]
+        self.results[epochs][trial] = score
+        if epochs == self.milestones[-1]:
+            return 'completed'
+        if len(peers) >= self.min_peers and score < np.median(peers):
+            return 'stopped'
+        self.waiting.append((trial, epochs))
+        return 'paused'
+
+    def fail(self, trial, epochs):
+        pass
+
+
+def write_leaderboard(output_dir, trials):
+    """Rank trials by the budget they reached, then by validation Dice"""
+    rows = sorted(trials.values(), key=lambda t: (-t['epochs'], -t['val_dice']))
+    with open(os.path.join(output_dir, 'leaderboard.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+    flat = [{k: v for k, v in row.items() if k != 'config'} | row['config'] for row in rows]
+    pd.DataFrame(flat).to_csv(os.path.join(output_dir, 'leaderboard.csv'), index=False)
+    return rows
+
+
+def search(csv_path, output_dir='hpsearch', scheduler='asha', n_trials=20, workers=None, threads=None,
+           min_epochs=1, max_epochs=27, eta=3, size=256, limit=None, val_fraction=0.2, seed=0, keep=3):
+    """Run a hyperparameter search over SEARCH_SPACE and return the leaderboard
+
+    Trials run in a pool of worker processes, each with its own TensorFlow
+    thread limit (threads, by default the cores divided by the workers).
+    All trials train on the same memory-mapped preprocessed dataset. Only
+    the checkpoints of the best `keep` trials are kept.
+    """
+    workers = workers or max(1, os.cpu_count() // 4)
+    threads = threads or max(1, os.cpu_count() // workers)
+    # Checkpoints left by an earlier search would otherwise be resumed by mistake
+    shutil.rmtree(os.path.join(output_dir, 'trials'), ignore_errors=True)
+    os.makedirs(os.path.join(output_dir, 'trials'))
+    cache_dir = cache_dataset(csv_path, os.path.join(output_dir, 'cache'), size=size, limit=limit)
+    _, _, index = open_cache(cache_dir)
+
+    train_indices, val_indices = patient_split(index, val_fraction, seed)
+
+    if scheduler == 'asha':
+        schedule = ASHAScheduler(n_trials, min_epochs, max_epochs, eta)
+    else:
+        schedule = MedianStoppingScheduler(n_trials, min_epochs, max_epochs)
+    with open(os.path.join(output_dir, 'search.json'), 'w') as f:
+        json.dump({'csv_path': csv_path, 'scheduler': scheduler, 'n_trials': n_trials, 'workers': workers,
+                   'threads': threads, 'milestones': schedule.milestones, 'size': size,
+                   'train_samples': int(len(train_indices)), 'val_samples': int(len(val_indices)),
+                   'search_space': SEARCH_SPACE}, f, indent=2, default=str)
+    logger.info(f"{scheduler} search: {n_trials} trials on {workers} workers x {threads} threads, "
+                f"epoch milestones {schedule.milestones}")
+
+    trials = {}
+    running = {}
+    start = time.perf_counter()
+    # spawn: workers start without the parent's state and set their thread limits before importing TensorFlow
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads,)) as pool:
+        while True:
+            while len(running) < workers:
+                job = schedule.next_job()
+                if job is None:
+                    break
+                trial, start_epoch, end_epoch = job
+                if trial not in trials:
+                    trials[trial] = {'trial': trial, 'config': sample_config(np.random.default_rng([seed, trial])),
+                                     'epochs': 0, 'val_dice': 0.0, 'seconds': 0.0, 'state': 'running',
+                                     'history': []}
+                trials[trial]['state'] = 'running'
+                checkpoint = os.path.join(output_dir, 'trials', f'trial-{trial:03d}.keras')
+                future = pool.submit(run_trial, trial, trials[trial]['config'], cache_dir, train_indices, val_indices,
+                                     start_epoch, end_epoch, checkpoint, seed + trial)
+                running[future] = job
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                trial, _, end_epoch = running.pop(future)
+                record = trials[trial]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"Trial {trial} failed: {str(e)}")
+                    record.update(state='failed', error=str(e))
+                    schedule.fail(trial, end_epoch)
+                    continue
+                record['state'] = schedule.report(trial, end_epoch, result['val_dice'])
+                record['epochs'] = end_epoch
+                record['val_dice'] = result['val_dice']
+                record['seconds'] += result['seconds']
+                record['history'].append([end_epoch, result['val_dice']])
+                logger.info(f"Trial {trial} at {end_epoch} epochs: Dice {result['val_dice']:.4f} ({record['state']})")
+            write_leaderboard(output_dir, trials)
+
+    for record in trials.values():
+        if record['state'] == 'paused':
+            # Never promoted: successive halving stopped it early
+            record['state'] = 'stopped'
+    leaderboard = write_leaderboard(output_dir, trials)
+    best = {row['trial'] for row in leaderboard[:keep]}
+    for trial in trials:
+        path = os.path.join(output_dir, 'trials', f'trial-{trial:03d}.keras')
+        if trial not in best and os.path.exists(path):
+            os.remove(path)
+    logger.info(f"Search finished in {time.perf_counter() - start:.0f} s; best trial "
+                f"{leaderboard[0]['trial']} with Dice {leaderboard[0]['val_dice']:.4f}")
+    return leaderboard
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Hyperparameter search for the segmentation model')
+    parser.add_argument('--csv', required=True, help='brain_df-style CSV with image_path and mask_path columns')
+    parser.add_argument('--output', default='hpsearch', help='Directory for the cache, checkpoints and leaderboard')
+    parser.add_argument('--scheduler', choices=['asha', 'random'], default='asha')
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=None, help='Parallel trials (default: cores / 4)')
+    parser.add_argument('--threads', type=int, default=None, help='TensorFlow threads per trial')
+    parser.add_argument('--min-epochs', type=int, default=1)
+    parser.add_argument('--max-epochs', type=int, default=27)
+    parser.add_argument('--eta', type=int, default=3, help='ASHA reduction factor')
+    parser.add_argument('--size', type=int, default=256, help='Training resolution')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', type=int, default=3, help='Checkpoints of the best trials to keep')
+    args = parser.parse_args()
+
+    leaderboard = search(args.csv, args.output, args.scheduler, args.trials, args.workers, args.threads,
+                         args.min_epochs, args.max_epochs, args.eta, args.size, args.limit, seed=args.seed,
+                         keep=args.keep)
+    print(json.dumps(leaderboard[:5], indent=2))
+
+
+if __name__ == '__main__':
+    main()
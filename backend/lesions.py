@@ -0,0 +1,228 @@
+import argparse
+import json
+import logging
+import time
+import cv2
+import numpy as np
+from scipy import ndimage
+
+logger = logging.getLogger(__name__)
+
+# 26-connectivity: voxels touching by a face, an edge or a corner belong to the same lesion
+STRUCTURE = np.ones((3, 3, 3), dtype=bool)
+
+
+def _find(parent, label):
+    root = label
+    while parent[root] != root:
+        root = parent[root]
+    while parent[label] != root:
+        parent[label], label = root, parent[label]
+    return root
+
+
+def _boundary_pairs(previous, current):
+    """Label pairs that touch across two adjacent slices labelled in different chunks"""
+    pairs = []
+    height, width = current.shape
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            # previous[y, x] touches current[y + dy, x + dx]
+            a = previous[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)]
+            b = current[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)]
+            touching = (a > 0) & (b > 0)
+            if touching.any():
+                pairs.append(np.stack([a[touching], b[touching]], axis=1))
+    return np.unique(np.concatenate(pairs), axis=0) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def _foreground_bounds(chunk):
+    """((z0, z1), (y0, y1), (x0, x1)) bounding the nonzero voxels of a boolean chunk, or None if it is empty"""
+    bounds = []
+    for axis in range(3):
+        present = np.flatnonzero(chunk.any(axis=tuple(a for a in range(3) if a != axis)))
+        if len(present) == 0:
+            return None
+        bounds.append((present[0], present[-1] + 1))
+    return bounds
+
+
+def _hull_points(plane, labels, origin):
+    """Convex hull vertices of every 2D component of one slice as (label, z, y, x) rows
+
+    The convex hull of a 3D lesion is spanned by the hull vertices of its
+    slices, so the maximum diameter only needs these points.
+    """
+    contours, _ = cv2.findContours(plane, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rows = []
+    for contour in contours:
+        hull = cv2.convexHull(contour)[:, 0]
+        label = labels[hull[0, 1], hull[0, 0]]
+        rows.append(np.column_stack([
+            np.full(len(hull), label), np.full(len(hull), origin[0]), hull[:, 1] + origin[1], hull[:, 0] + origin[2]
+        ]))
+    return rows
+
+
+def max_diameter(points):
+    """Largest distance between any two points of an (N, 3) array"""
+    if len(points) < 2:
+        return 0.0
+    if len(points) > 512 and np.ptp(points[:, 0]) > 0:
+        # Only vertices of the 3D hull can be the endpoints of the diameter; QJ copes with flat lesions
+        from scipy.spatial import ConvexHull
+        points = points[ConvexHull(points, qhull_options='QJ').vertices]
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab, in row blocks so the distance matrix never exists in full
+    squared = np.einsum('ij,ij->i', points, points)
+    longest = 0.0
+    for i in range(0, len(points), 512):
+        block = squared[i:i + 512, None] + squared[None, :] - 2 * points[i:i + 512] @ points.T
+        longest = max(longest, float(block.max()))
+    return float(np.sqrt(max(longest, 0.0)))
+
+
+def analyze_lesions(mask, spacing=None, chunk_slices=64, min_voxels=1):
+    """3D lesion statistics of a (slices, H, W) mask, read chunk by chunk
+
+    mask can be a NumPy array or np.memmap; nonzero voxels are foreground.
+    spacing is the (slice, row, column) voxel size in mm; without it sizes are
+    reported in voxels. Lesions are labelled per chunk and merged across chunk
+    boundaries with a union-find, so only one chunk of labels is held at once.
+    """
+    units = 'mm' if spacing is not None else 'voxel'
+    spacing = np.asarray(spacing if spacing is not None else (1.0, 1.0, 1.0), dtype=np.float64)
+    depth = mask.shape[0]
+    start = time.perf_counter()
+
+    parent = [0]
+    counts, sums, lows, highs = [np.zeros(0)], [np.zeros((0, 3))], [np.zeros((0, 3))], [np.zeros((0, 3))]
+    hull_rows = []
+    previous = None
+    offset = 0
+
+    for z0 in range(0, depth, chunk_slices):
+        chunk = np.asarray(mask[z0:z0 + chunk_slices]) > 0
+        # Label only the bounding box of this chunk's foreground; lesions are small next to the volume
+        bounds = _foreground_bounds(chunk)
+        if bounds is None:
+            previous = None
+            continue
+        (za, zb), (ya, yb), (xa, xb) = bounds
+        labels, count = ndimage.label(chunk[za:zb, ya:yb, xa:xb], structure=STRUCTURE)
+        origin = np.array([z0 + za, ya, xa])
+
+        # Per-label voxel counts, coordinate sums and bounding boxes of this chunk
+        flat = labels.ravel()
+        foreground = np.flatnonzero(flat)
+        ids = flat[foreground]
+        coordinates = np.column_stack(np.unravel_index(foreground, labels.shape)) + origin
+        counts.append(np.bincount(ids, minlength=count + 1)[1:])
+        sums.append(np.column_stack([np.bincount(ids, coordinates[:, k], count + 1)[1:] for k in range(3)]))
+        boxes = np.array([[(s.start, s.stop) for s in box] for box in ndimage.find_objects(labels)])
+        lows.append(boxes[:, :, 0] + origin)
+        highs.append(boxes[:, :, 1] - 1 + origin)
+
+        # Labels of this chunk become offset + 1 .. offset + count globally
+        np.add(labels, offset, out=labels, where=labels > 0)
+        parent.extend(range(offset + 1, offset + count + 1))
+        for z in range(len(labels)):
+            hull_rows.extend(_hull_points((labels[z] > 0).astype(np.uint8), labels[z], origin + [z, 0, 0]))
+
+        # Merge with lesions of the previous chunk that touch its last slice
+        if previous is not None and za == 0:
+            current = np.zeros(chunk.shape[1:], dtype=labels.dtype)
+            current[ya:yb, xa:xb] = labels[0]
+            for a, b in _boundary_pairs(previous, current):
+                root_a, root_b = _find(parent, a), _find(parent, b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+        previous = None
+        if zb == len(chunk):
+            previous = np.zeros(chunk.shape[1:], dtype=labels.dtype)
+            previous[ya:yb, xa:xb] = labels[-1]
+        offset += count
+
+    if offset == 0:
+        return {'count': 0, 'units': units, 'spacing': spacing.tolist(), 'total_volume': 0.0, 'lesions': [],
+                'seconds': time.perf_counter() - start}
+
+    # Merge chunk-level statistics by union-find root
+    roots = np.array([_find(parent, label) for label in range(1, offset + 1)])
+    unique_roots, lesion_index = np.unique(roots, return_inverse=True)
+    n = len(unique_roots)
+    voxels = np.bincount(lesion_index, np.concatenate(counts), n)
+    coordinate_sums = np.column_stack([np.bincount(lesion_index, np.concatenate(sums)[:, k], n) for k in range(3)])
+    low = np.full((n, 3), np.inf)
+    high = np.full((n, 3), -np.inf)
+    np.minimum.at(low, lesion_index, np.concatenate(lows))
+    np.maximum.at(high, lesion_index, np.concatenate(highs))
+
+    hull = np.concatenate(hull_rows)
+    hull_lesion = lesion_index[hull[:, 0] - 1]
+    hull_mm = hull[:, 1:] * spacing
+    order = np.argsort(hull_lesion, kind='stable')
+    split = np.split(hull_mm[order], np.cumsum(np.bincount(hull_lesion, minlength=n))[:-1])
+
+    voxel_volume = float(np.prod(spacing))
+    lesions = []
+    for i in np.argsort(-voxels, kind='stable'):
+        if voxels[i] < min_voxels:
+            continue
+        centroid = coordinate_sums[i] / voxels[i]
+        lesions.append({
+            'id': len(lesions) + 1,
+            'voxels': int(voxels[i]),
+            'volume': float(voxels[i] * voxel_volume),
+            'centroid': (centroid * spacing).round(3).tolist(),
+            'centroid_voxel': centroid.round(2).tolist(),
+            'bbox': {'min': low[i].astype(int).tolist(), 'max': high[i].astype(int).tolist()},
+            'max_diameter': max_diameter(split[i])
+        })
+
+    return {
+        'count': len(lesions),
+        'units': units,
+        'spacing': spacing.tolist(),
+        'total_volume': float(sum(lesion['volume'] for lesion in lesions)),
+        'lesions': lesions,
+        'seconds': time.perf_counter() - start
+    }
+
+
+def load_mask(path):
+    """Memory-map a .npy mask or a NIfTI mask as (slices, H, W) with its spacing in mm"""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r'), None
+    import nibabel as nib
+
+    img = nib.load(path)
+    zooms = img.header.get_zooms()[:3]
+    # Uncompressed NIfTI data is memory-mapped by nibabel; moveaxis only creates a view
+    return np.moveaxis(np.asanyarray(img.dataobj), -1, 0), (zooms[2], zooms[0], zooms[1])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='3D lesion statistics of a segmentation mask')
+    parser.add_argument('--mask', required=True, help='Mask as .npy (slices, H, W) or NIfTI')
+    parser.add_argument('--spacing', help='Voxel size "slice,row,column" in mm (NIfTI masks use the header)')
+    parser.add_argument('--chunk-slices', type=int, default=64)
+    parser.add_argument('--min-voxels', type=int, default=1)
+    parser.add_argument('--output', default=None, help='JSON output path (default: stdout)')
+    args = parser.parse_args()
+
+    mask, spacing = load_mask(args.mask)
+    if args.spacing:
+        spacing = tuple(float(s) for s in args.spacing.split(','))
+    report = analyze_lesions(mask, spacing, args.chunk_slices, args.min_voxels)
+    logger.info(f"{report['count']} lesions in {report['seconds'] * 1000:.0f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_EXTENSIONS = ('jpg', 'jpeg', 'png', 'dcm', 'dicom', 'nii', 'nii.gz')
+CONTENT_TYPES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'dcm': 'application/dicom',
+                 'dicom': 'application/dicom'}
+PERCENTILES = (50, 90, 95, 99)
+
+
+def _extension(filename):
+    return 'nii.gz' if filename.lower().endswith('.nii.gz') else filename.rsplit('.', 1)[-1].lower()
+
+
+def synthetic_slice(rng, size=256):
+    """uint16 MRI-like slice: a noisy elliptical head with a bright lesion at a random place"""
+    yy, xx = np.mgrid[:size, :size]
+    head = ((yy - size / 2) / (size * 0.42)) ** 2 + ((xx - size / 2) / (size * 0.36)) ** 2 < 1
+    cy, cx = rng.uniform(0.35, 0.65, 2) * size
+    lesion = (yy - cy) ** 2 + (xx - cx) ** 2 < (rng.uniform(0.03, 0.1) * size) ** 2
+    image = head * 900.0 + lesion * 1200.0 + rng.normal(0, 60, (size, size))
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def _write_dicom(path, image):
+    import pydicom
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MRImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = MRImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = generate_uid()
+    ds.Modality = 'MR'
+    ds.Rows, ds.Columns = image.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelData = image.tobytes()
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+
+def synthetic_inputs(output_dir, formats=('jpg', 'png', 'dcm', 'nii.gz'), variants=8, size=256, slices=8, seed=0):
+    """Write `variants` distinct synthetic uploads per format; returns the file paths
+
+    Every file has its own noise and lesion, so concurrent requests are not
+    coalesced into one execution unless the same file is picked twice.
+    """
+    import nibabel as nib
+
+    rng = np.random.default_rng(seed)
+    paths = []
+    for extension in formats:
+        for variant in range(variants):
+            path = os.path.join(output_dir, f'{extension.replace(".", "_")}_{variant:03d}.{extension}')
+            if extension in ('nii', 'nii.gz'):
+                volume = np.stack([synthetic_slice(rng, size) for _ in range(slices)], axis=-1)
+                nib.save(nib.Nifti1Image(volume.astype(np.int16), np.eye(4)), path)
+            elif extension in ('dcm', 'dicom'):
+                _write_dicom(path, synthetic_slice(rng, size))
+            else:
+                cv2.imwrite(path, (synthetic_slice(rng, size) >> 4).astype(np.uint8))
+            paths.append(path)
+    return paths
+
+
+def load_inputs(paths):
+    """(filename, bytes) of every upload in a list of files and directories (recorded traffic to replay)"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(p for p in glob.glob(os.path.join(path, '*')) if os.path.isfile(p)))
+        else:
+            files.append(path)
+    inputs = []
+    for path in files:
+        if _extension(path) not in UPLOAD_EXTENSIONS:
+            continue
+        with open(path, 'rb') as f:
+            inputs.append((os.path.basename(path), f.read()))
+    if not inputs:
+        raise ValueError(f"No uploadable files ({', '.join(UPLOAD_EXTENSIONS)}) in {paths}")
+    return inputs
+
+
+def multipart_form(filename, data, fields):
+    """multipart/form-data body with the upload as 'file' plus extra form fields; returns (body, content type)"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    content_type = CONTENT_TYPES.get(_extension(filename), 'application/octet-stream')
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: {content_type}\r\n\r\n'.encode())
+    parts.append(data)
+    parts.append(f'\r\n--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class LoadGenerator:
+    """Sends uploads to /api/predict and records one sample per request
+
+    Latency is measured from the time a request was scheduled, not from when a
+    client thread got to send it, so a slow server cannot hide its queueing
+    delay by slowing down the generator (coordinated omission).
+    """
+
+    def __init__(self, url, inputs, fields=None, timeout=120.0, seed=0):
+        self.url = url
+        self.inputs = inputs
+        self.fields = fields or {}
+        self.timeout = timeout
+        self._rng = np.random.default_rng(seed)
+        # Arrival times are drawn by the scheduling thread only, from their own stream
+        self._arrivals = np.random.default_rng([seed, 1])
+        self._lock = threading.Lock()
+
+    def _pick(self):
+        with self._lock:
+            return self.inputs[self._rng.integers(len(self.inputs))]
+
+    def send(self, scheduled=None, client_id=None):
+        scheduled = scheduled if scheduled is not None else time.perf_counter()
+        filename, data = self._pick()
+        body, content_type = multipart_form(filename, data, self.fields)
+        # Every virtual client has its own id, otherwise the server's per-client quota sees one client
+        # (the generator's address) and answers most of the load with 429
+        request = urllib.request.Request(self.url, data=body, headers={
+            'Content-Type': content_type,
+            'X-Client-ID': client_id or f'loadtest-{uuid.uuid4().hex}'
+        })
+        sent = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            status = e.code
+        except (urllib.error.URLError, OSError) as e:
+            # Connection refused, reset or timed out
+            status = type(getattr(e, 'reason', e)).__name__
+        done = time.perf_counter()
+        return {'format': _extension(filename), 'status': status, 'latency_ms': (done - scheduled) * 1000,
+                'service_ms': (done - sent) * 1000, 'finished': done}
+
+    def open_loop(self, rate, duration, max_in_flight=256):
+        """Poisson arrivals at `rate` requests/s for `duration` seconds, independent of response times
+
+        Arrivals that find max_in_flight requests outstanding are recorded as
+        'client_limit' errors instead of delaying later arrivals.
+        """
+        samples, futures = [], []
+        in_flight = threading.Semaphore(max_in_flight)
+        start = time.perf_counter()
+        arrival = start
+
+        def run(scheduled):
+            try:
+                return self.send(scheduled)
+            finally:
+                in_flight.release()
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+            while True:
+                arrival += self._arrivals.exponential(1.0 / rate)
+                if arrival - start >= duration:
+                    break
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+                if not in_flight.acquire(blocking=False):
+                    samples.append({'format': None, 'status': 'client_limit', 'latency_ms': 0.0, 'service_ms': 0.0,
+                                    'finished': arrival})
+                    continue
+                futures.append(pool.submit(run, arrival))
+        samples.extend(future.result() for future in futures)
+        return samples, start
+
+    def closed_loop(self, concurrency, duration):
+        """`concurrency` clients each sending their next request as soon as the previous one returns"""
+        start = time.perf_counter()
+
+        def client():
+            samples = []
+            client_id = f'loadtest-{uuid.uuid4().hex}'
+            while time.perf_counter() - start < duration:
+                samples.append(self.send(client_id=client_id))
+            return samples
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: client(), range(concurrency)))
+        return [sample for samples in results for sample in samples], start
+
+
+def summarize(samples, start, duration):
+    """Throughput, error rate and latency percentiles of one stage's samples"""
+    ok = [s for s in samples if s['status'] == 200]
+    # A stage lasts at least its scheduled duration, longer if the last responses came in after it
+    elapsed = max(duration, max((s['finished'] for s in samples), default=start) - start)
+    statuses = {}
+    for s in samples:
+        statuses[str(s['status'])] = statuses.get(str(s['status']), 0) + 1
+    latencies = np.array([s['latency_ms'] for s in ok])
+    summary = {
+        'requests': len(samples),
+        'ok': len(ok),
+        'error_rate': 1 - len(ok) / len(samples) if samples else 0.0,
+        'statuses': statuses,
+        'seconds': elapsed,
+        'throughput': len(ok) / elapsed if elapsed > 0 else 0.0,
+        'latency_ms': {},
+        'service_ms_p50': float(np.median([s['service_ms'] for s in ok])) if ok else None
+    }
+    if len(latencies):
+        summary['latency_ms'] = {f'p{p}': float(np.percentile(latencies, p)) for p in PERCENTILES}
+        summary['latency_ms'].update(mean=float(latencies.mean()), max=float(latencies.max()))
+    by_format = {}
+    for s in ok:
+        by_format.setdefault(s['format'], []).append(s['latency_ms'])
+    summary['p50_ms_by_format'] = {k: float(np.median(v)) for k, v in sorted(by_format.items())}
+    return summary
+
+
+def check_stage(stage, slo_p99_ms, max_error_rate, min_keep_up=0.9):
+    """Reasons a stage misses its objectives; an empty list means it holds"""
+    reasons = []
+    if stage['error_rate'] > max_error_rate:
+        reasons.append(f"error rate {stage['error_rate']:.1%} > {max_error_rate:.1%}")
+    p99 = stage['latency_ms'].get('p99')
+    if p99 is None or p99 > slo_p99_ms:
+        reasons.append(f"p99 {p99 if p99 is None else round(p99)} ms > {slo_p99_ms:g} ms")
+    # An open-loop server that falls behind the offered rate is saturated even before latency explodes
+    if 'rate' in stage and stage['throughput'] < min_keep_up * stage['rate']:
+        reasons.append(f"throughput {stage['throughput']:.2f}/s < {min_keep_up:.0%} of offered {stage['rate']:g}/s")
+    return reasons
+
+
+def find_knee(stages):
+    """Last stage that held before the first one that did not; its throughput is the usable capacity"""
+    knee, saturated = None, None
+    for stage in stages:
+        if stage['violations']:
+            saturated = stage
+            break
+        knee = stage
+    return {
+        'knee': knee['load'] if knee else None,
+        'capacity': knee['throughput'] if knee else 0.0,
+        'p99_ms_at_knee': knee['latency_ms'].get('p99') if knee else None,
+        'saturated_at': saturated['load'] if saturated else None,
+        'saturation_reasons': saturated['violations'] if saturated else []
+    }
+
+
+def run(url, inputs, mode='open', loads=(0.5, 1, 2, 4), stage_seconds=30.0, fields=None, warmup=3, slo_p99_ms=2000.0,
+        max_error_rate=0.01, max_in_flight=256, timeout=120.0, stop_after=2, seed=0):
+    """Ramp through `loads` (arrival rates in open mode, client counts in closed mode) and report each stage
+
+    The ramp stops after `stop_after` consecutive stages miss the objectives,
+    since pushing further past saturation only grows the server's backlog.
+    """
+    generator = LoadGenerator(url, inputs, fields, timeout, seed)
+    for _ in range(warmup):
+        generator.send()
+
+    stages, misses = [], 0
+    for load in loads:
+        if mode == 'open':
+            samples, start = generator.open_loop(load, stage_seconds, max_in_flight)
+        else:
+            samples, start = generator.closed_loop(int(load), stage_seconds)
+        stage = summarize(samples, start, stage_seconds)
+        stage['load'] = load
+        if mode == 'open':
+            stage['rate'] = load
+        stage['violations'] = check_stage(stage, slo_p99_ms, max_error_rate)
+        stages.append(stage)
+        p99 = stage['latency_ms'].get('p99', float('nan'))
+        logger.info(f"{mode} load {load:g}: {stage['throughput']:.2f} req/s, p99 {p99:.0f} ms, "
+                    f"errors {stage['error_rate']:.1%}{' - ' + '; '.join(stage['violations']) if stage['violations'] else ''}")
+        misses = misses + 1 if stage['violations'] else 0
+        if stop_after and misses >= stop_after:
+            break
+
+    return {
+        'url': url,
+        'mode': mode,
+        'stage_seconds': stage_seconds,
+        'inputs': len(inputs),
+        'fields': fields or {},
+        'slo': {'p99_ms': slo_p99_ms, 'max_error_rate': max_error_rate},
+        'stages': stages,
+        **find_knee(stages)
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Load-test /api/predict and report throughput, latency and the saturation knee')
+    parser.add_argument('--url', default='http://127.0.0.1:5000/api/predict')
+    parser.add_argument('--inputs', nargs='*', help='Files or directories of recorded uploads to replay (default: synthetic)')
+    parser.add_argument('--formats', default='jpg,png,dcm,nii.gz', help='Synthetic upload formats')
+    parser.add_argument('--variants', type=int, default=8, help='Distinct synthetic files per format')
+    parser.add_argument('--mode', choices=['open', 'closed'], default='open',
+                        help='open: Poisson arrival rates; closed: concurrent clients')
+    parser.add_argument('--loads', default='0.5,1,2,4', help='Comma separated arrival rates (req/s) or client counts')
+    parser.add_argument('--stage-seconds', type=float, default=30.0)
+    parser.add_argument('--warmup', type=int, default=3, help='Sequential requests before the first stage')
+    parser.add_argument('--field', action='append', default=[], help='Extra form field, e.g. render=client')
+    parser.add_argument('--slo-p99-ms', type=float, default=2000.0)
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--min-capacity', type=float, default=None,
+                        help='Exit with status 1 unless the knee throughput reaches this many req/s')
+    parser.add_argument('--max-in-flight', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--stop-after', type=int, default=2, help='Stop after this many consecutive failing stages (0 = never)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json', help='JSON report path')
+    args = parser.parse_args()
+
+    fields = dict(field.split('=', 1) for field in args.field)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.inputs:
+            inputs = load_inputs(args.inputs)
+        else:
+            inputs = load_inputs(synthetic_inputs(tmp_dir, args.formats.split(','), args.variants, seed=args.seed))
+    report = run(args.url, inputs, args.mode, [float(load) for load in args.loads.split(',')], args.stage_seconds,
+                 fields, args.warmup, args.slo_p99_ms, args.max_error_rate, args.max_in_flight, args.timeout,
+                 args.stop_after, args.seed)
+
+    report['min_capacity'] = args.min_capacity
+    report['passed'] = args.min_capacity is None or report['capacity'] >= args.min_capacity
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Knee at load {report['knee']} with {report['capacity']:.2f} req/s "
+                f"(saturated at {report['saturated_at']}); report written to {args.output}")
+    if not report['passed']:
+        logger.error(f"Capacity {report['capacity']:.2f} req/s is below the required {args.min_capacity:g} req/s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+import datetime
+import gzip
+import logging
+import os
+import struct
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEGMENTATION_STORAGE = '1.2.840.10008.5.1.4.1.1.66.4'
+# RAS (NIfTI) <-> LPS (DICOM) patient coordinates
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0])
+
+
+def mask_affine(volume, size=256):
+    """RAS affine of a (slices, size, size) mask resized in-plane from the volume's slices
+
+    Pixel centres of the resized grid do not coincide with the input's, so the
+    origin moves by half the change in pixel size.
+    """
+    rows, columns = volume.shape
+    scale = np.array([rows / size, columns / size, 1.0])
+    affine = np.array(volume.affine, dtype=np.float64) @ np.diag(list(scale) + [1.0])
+    affine[:3, 3] += np.array(volume.affine, dtype=np.float64)[:3, :3] @ ((scale - 1) / 2)
+    return affine
+
+
+class NiftiMaskWriter:
+    """Writes a uint8 NIfTI mask one slice at a time, gzip-compressed for .nii.gz paths
+
+    The header is written up front from the final shape, so slices go to disk
+    as they are segmented and the volume is never assembled in memory.
+    """
+
+    def __init__(self, path, depth, affine, size=256):
+        import nibabel as nib
+
+        self.path = path
+        self.depth = depth
+        self.written = 0
+        header = nib.Nifti1Image(np.zeros((1, 1, 1), dtype=np.uint8), affine).header
+        header.set_data_shape((size, size, depth))
+        header.set_data_dtype(np.uint8)
+        header['vox_offset'] = 352
+        self._file = gzip.open(path, 'wb', compresslevel=6) if path.endswith('.gz') else open(path, 'wb')
+        # 348-byte header followed by an empty extension flag
+        self._file.write(header.binaryblock + b'\0' * 4)
+
+    def write(self, slices):
+        """Append a (n, size, size) batch of mask slices"""
+        for plane in slices:
+            # NIfTI data is column-major: the first axis varies fastest
+            self._file.write(np.asarray(plane, dtype=np.uint8).tobytes(order='F'))
+        self.written += len(slices)
+
+    def close(self):
+        self._file.close()
+        if self.written != self.depth:
+            raise ValueError(f"Wrote {self.written} of {self.depth} slices to {self.path}")
+
+
+def _code(value, scheme, meaning):
+    from pydicom.dataset import Dataset
+
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+class DicomSegWriter:
+    """Writes a binary DICOM Segmentation one frame per slice, with bit-packed frames
+
+    Pixel data is the last element of the file and its length follows from the
+    frame count, so the header is written first and frames are appended as
+    slices are segmented. Patient, study and frame of reference are copied from
+    the source DICOM headers when the input was DICOM, and every source
+    instance is referenced.
+    """
+
+    def __init__(self, path, depth, affine, size=256, headers=None, label='Tumor'):
+        import pydicom
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+        self.path = path
+        self.depth = depth
+        self.written = 0
+        self._bits = np.zeros(0, dtype=np.uint8)
+        self._length = (size * size * depth + 7) // 8
+        source = headers[0] if headers else Dataset()
+
+        # Geometry of each frame in DICOM (LPS) patient coordinates
+        column_direction = RAS_TO_LPS @ affine[:3, 0]
+        row_direction = RAS_TO_LPS @ affine[:3, 1]
+        slice_vector = RAS_TO_LPS @ affine[:3, 2]
+        row_spacing, column_spacing = np.linalg.norm(column_direction), np.linalg.norm(row_direction)
+        origin = RAS_TO_LPS @ affine[:3, 3]
+
+        ds = Dataset()
+        now = datetime.datetime.now()
+        ds.SOPClassUID = SEGMENTATION_STORAGE
+        ds.SOPInstanceUID = generate_uid()
+        for keyword in ('PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'StudyDate', 'StudyTime',
+                        'ReferringPhysicianName', 'StudyID', 'AccessionNumber'):
+            setattr(ds, keyword, source.get(keyword, ''))
+        ds.StudyInstanceUID = source.get('StudyInstanceUID', generate_uid())
+        ds.FrameOfReferenceUID = source.get('FrameOfReferenceUID', generate_uid())
+        ds.PositionReferenceIndicator = ''
+        ds.Modality = 'SEG'
+        ds.SeriesInstanceUID = generate_uid()
+        ds.SeriesNumber = 300
+        ds.SeriesDescription = 'Tumor segmentation'
+        ds.InstanceNumber = 1
+        ds.ContentDate = now.strftime('%Y%m%d')
+        ds.ContentTime = now.strftime('%H%M%S')
+        ds.ContentLabel = label.upper()
+        ds.ContentDescription = 'Automatic tumor segmentation'
+        ds.ContentCreatorName = ''
+        ds.Manufacturer = 'Tumor Segmentation'
+        ds.ManufacturerModelName = 'ResUNet'
+        ds.DeviceSerialNumber = '1'
+        ds.SoftwareVersions = '1'
+        ds.ImageType = ['DERIVED', 'PRIMARY']
+        ds.SegmentationType = 'BINARY'
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = ds.Columns = size
+        ds.BitsAllocated = ds.BitsStored = 1
+        ds.HighBit = 0
+        ds.PixelRepresentation = 0
+        ds.LossyImageCompression = '00'
+        ds.NumberOfFrames = depth
+
+        segment = Dataset()
+        segment.SegmentNumber = 1
+        segment.SegmentLabel = label
+        segment.SegmentAlgorithmType = 'AUTOMATIC'
+        segment.SegmentAlgorithmName = 'ResUNet'
+        segment.SegmentedPropertyCategoryCodeSequence = [_code('49755003', 'SCT', 'Morphologically Altered Structure')]
+        segment.SegmentedPropertyTypeCodeSequence = [_code('108369006', 'SCT', 'Neoplasm')]
+        ds.SegmentSequence = [segment]
+
+        dimension_uid = generate_uid()
+        dimensions = []
+        for index_pointer, group_pointer in ((0x0062000B, 0x0062000A), (0x00200032, 0x00209113)):
+            dimension = Dataset()
+            dimension.DimensionOrganizationUID = dimension_uid
+            dimension.DimensionIndexPointer = index_pointer
+            dimension.FunctionalGroupPointer = group_pointer
+            dimensions.append(dimension)
+        organization = Dataset()
+        organization.DimensionOrganizationUID = dimension_uid
+        ds.DimensionOrganizationSequence = [organization]
+        ds.DimensionIndexSequence = dimensions
+
+        orientation, measures, shared = Dataset(), Dataset(), Dataset()
+        orientation.ImageOrientationPatient = [float(v) for v in np.concatenate([
+            row_direction / column_spacing, column_direction / row_spacing])]
+        measures.PixelSpacing = [float(row_spacing), float(column_spacing)]
+        measures.SliceThickness = float(np.linalg.norm(slice_vector))
+        measures.SpacingBetweenSlices = float(np.linalg.norm(slice_vector))
+        shared.PlaneOrientationSequence = [orientation]
+        shared.PixelMeasuresSequence = [measures]
+        ds.SharedFunctionalGroupsSequence = [shared]
+
+        frames = []
+        for z in range(depth):
+            content, position, identification, frame = Dataset(), Dataset(), Dataset(), Dataset()
+            content.DimensionIndexValues = [1, z + 1]
+            position.ImagePositionPatient = [float(v) for v in origin + z * slice_vector]
+            identification.ReferencedSegmentNumber = 1
+            frame.FrameContentSequence = [content]
+            frame.PlanePositionSequence = [position]
+            frame.SegmentIdentificationSequence = [identification]
+            frames.append(frame)
+        ds.PerFrameFunctionalGroupsSequence = frames
+
+        if headers and 'SeriesInstanceUID' in source:
+            referenced = []
+            for header in headers:
+                instance = Dataset()
+                instance.ReferencedSOPClassUID = header.SOPClassUID
+                instance.ReferencedSOPInstanceUID = header.SOPInstanceUID
+                referenced.append(instance)
+            series = Dataset()
+            series.SeriesInstanceUID = source.SeriesInstanceUID
+            series.ReferencedInstanceSequence = referenced
+            ds.ReferencedSeriesSequence = [series]
+
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.preamble = b'\0' * 128
+
+        self._file = open(path, 'wb')
+        pydicom.dcmwrite(self._file, ds, enforce_file_format=True)
+        # Pixel Data (7FE0,0010) header with an explicit even length; the frames follow
+        self._file.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OB', 0, self._length + self._length % 2))
+
+    def write(self, slices):
+        """Append a (n, size, size) batch of mask slices as bit-packed frames (first pixel in the lowest bit)"""
+        bits = np.concatenate([self._bits, (np.asarray(slices) > 0).astype(np.uint8).ravel()])
+        whole = len(bits) - len(bits) % 8
+        self._file.write(np.packbits(bits[:whole], bitorder='little').tobytes())
+        self._bits = bits[whole:]
+        self.written += len(slices)
+
+    def close(self):
+        if len(self._bits):
+            self._file.write(np.packbits(self._bits, bitorder='little').tobytes())
+        if self._length % 2:
+            self._file.write(b'\0')
+        self._file.close()
+        if self.written != self.depth:
+            raise ValueError(f"Wrote {self.written} of {self.depth} frames to {self.path}")
+
+
+# Export formats by name, with the file name they are written to
+EXPORT_FORMATS = {
+    'nifti': ('mask.nii.gz', NiftiMaskWriter),
+    'seg': ('mask.seg.dcm', DicomSegWriter)
+}
+
+
+def open_writers(volume, output_dir, formats, size=256):
+    """Open one streaming writer per export format; returns {format: (file name, writer)}"""
+    affine = mask_affine(volume, size)
+    writers = {}
+    for name in formats:
+        if name not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {name}")
+        filename, writer_class = EXPORT_FORMATS[name]
+        path = os.path.join(output_dir, filename)
+        if writer_class is DicomSegWriter:
+            writers[name] = (filename, writer_class(path, volume.depth, affine, size, headers=volume.headers))
+        else:
+            writers[name] = (filename, writer_class(path, volume.depth, affine, size))
+    return writers
@@ -0,0 +1,64 @@
+import base64
+import cv2
+import numpy as np
+
+
+def _children(hierarchy, index):
+    # Siblings of the first child are linked through the 'next' entry
+    child = hierarchy[0, index, 2]
+    while child != -1:
+        yield child
+        child = hierarchy[0, child, 0]
+
+
+def mask_polygons(mask, tolerance=1.0):
+    """Simplified outlines of a mask's regions as JSON-ready polygons
+
+    Outer boundaries and holes come from a two-level contour hierarchy and are
+    simplified with Douglas-Peucker (cv2.approxPolyDP); tolerance is the maximum
+    deviation in pixels. Each polygon has its points, holes, bounding box
+    [x, y, width, height] and area, largest first.
+    """
+    contours, hierarchy = cv2.findContours((mask > 0).astype(np.uint8), cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None:
+        return []
+
+    def simplify(contour):
+        points = cv2.approxPolyDP(contour, tolerance, True) if tolerance > 0 else contour
+        return points[:, 0].tolist()
+
+    polygons = []
+    for index, contour in enumerate(contours):
+        # Top-level contours (no parent) are outer boundaries; their children are holes
+        if hierarchy[0, index, 3] != -1:
+            continue
+        holes = [contours[child] for child in _children(hierarchy, index)]
+        x, y, width, height = cv2.boundingRect(contour)
+        polygons.append({
+            'points': simplify(contour),
+            'holes': [simplify(hole) for hole in holes],
+            'bbox': [x, y, width, height],
+            'area': float(cv2.contourArea(contour) - sum(cv2.contourArea(hole) for hole in holes))
+        })
+    return sorted(polygons, key=lambda polygon: -polygon['area'])
+
+
+def pack_mask(mask, size=64):
+    """Low-resolution bitmask, row-major and packed 8 pixels per byte (most significant bit first)"""
+    height, width = mask.shape[:2]
+    scale = size / max(height, width)
+    shape = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small = cv2.resize((mask > 0).astype(np.uint8) * 255, shape, interpolation=cv2.INTER_AREA) > 127
+    return {
+        'width': shape[0],
+        'height': shape[1],
+        'bits': base64.b64encode(np.packbits(small).tobytes()).decode('ascii')
+    }
+
+
+def mask_geometry(mask, tolerance=1.0, bitmask_size=64):
+    """Everything a client needs to draw the overlay itself"""
+    return {
+        'polygons': mask_polygons(mask, tolerance),
+        'bitmask': pack_mask(mask, bitmask_size)
+    }
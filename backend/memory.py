@@ -0,0 +1,156 @@
+import ctypes
+import ctypes.util
+import functools
+import logging
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# glibc mallopt parameter for the number of malloc arenas
+M_ARENA_MAX = -8
+
+
+class LimitExceeded(ValueError):
+    """Raised when a request would exceed a configured memory limit"""
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    path = ctypes.util.find_library('c')
+    return ctypes.CDLL(path) if path else None
+
+
+def configure_allocator(arena_max=None):
+    """Cap the number of glibc malloc arenas so RSS does not grow with the thread count"""
+    if not arena_max:
+        return False
+    libc = _libc()
+    if libc is None or not hasattr(libc, 'mallopt'):
+        logger.warning("mallopt is not available, MALLOC_ARENA_MAX ignored")
+        return False
+    return bool(libc.mallopt(M_ARENA_MAX, int(arena_max)))
+
+
+def release_memory():
+    """Return freed heap pages to the OS (glibc only)"""
+    libc = _libc()
+    if libc is not None and hasattr(libc, 'malloc_trim'):
+        libc.malloc_trim(0)
+
+
+def configure_tensorflow(intra_op_threads=0, inter_op_threads=0):
+    """Set TensorFlow thread pools; 0 keeps the TensorFlow default"""
+    import tensorflow as tf
+
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    # Allocate GPU memory on demand instead of reserving the whole device
+    for gpu in tf.config.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+
+def check_voxels(shape, max_voxels):
+    """Raise LimitExceeded if an image or volume of this shape is too large"""
+    voxels = 1
+    for dim in shape:
+        voxels *= int(dim)
+    if max_voxels and voxels > max_voxels:
+        raise LimitExceeded(f"Image has {voxels} voxels, the limit is {max_voxels}")
+    return voxels
+
+
+class MemoryProfile:
+    """Per-stage peak Python/NumPy allocations and RSS of one request
+
+    Call start(stage) at the beginning of each stage; the previous stage ends
+    there. Peaks come from tracemalloc, which is process wide, so concurrent
+    requests inflate each other's numbers.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled and tracemalloc.is_tracing()
+        self.stages = {}
+        self._stage = None
+        self._started = None
+        self._rss = None
+        self._traced = 0
+
+    def start(self, stage):
+        if not self.enabled:
+            return
+        self._close()
+        tracemalloc.reset_peak()
+        self._stage = stage
+        self._started = time.perf_counter()
+        self._rss = current_rss_mb()
+        self._traced = tracemalloc.get_traced_memory()[0]
+
+    def _close(self):
+        if self._stage is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        rss = current_rss_mb()
+        self.stages[self._stage] = {
+            # Allocations on top of what was live when the stage started
+            'peak_alloc_mb': (peak - self._traced) / 2**20,
+            'retained_mb': (current - self._traced) / 2**20,
+            'rss_mb': rss,
+            'rss_delta_mb': rss - self._rss,
+            'ms': (time.perf_counter() - self._started) * 1000
+        }
+        self._stage = None
+
+    def finish(self):
+        """End the current stage and return the per-stage report"""
+        if self.enabled:
+            self._close()
+        return self.stages
+
+
+class MemoryStats:
+    """Process-wide maximum of each stage's peak allocation across requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self.requests = 0
+
+    def record(self, stages):
+        if not stages:
+            return
+        with self._lock:
+            self.requests += 1
+            for name, stage in stages.items():
+                worst = self._stages.setdefault(name, {'max_peak_alloc_mb': 0.0, 'max_rss_delta_mb': 0.0})
+                worst['max_peak_alloc_mb'] = max(worst['max_peak_alloc_mb'], stage['peak_alloc_mb'])
+                worst['max_rss_delta_mb'] = max(worst['max_rss_delta_mb'], stage['rss_delta_mb'])
+
+    def report(self):
+        with self._lock:
+            return {
+                'profiled_requests': self.requests,
+                'stages': {name: dict(stage) for name, stage in self._stages.items()},
+                'rss_mb': current_rss_mb(),
+                'peak_rss_mb': peak_rss_mb()
+            }
@@ -0,0 +1,94 @@
+import numpy as np
+from scipy import ndimage
+
+# Same weighting as the focal Tversky loss used for training (see model.tversky)
+TVERSKY_ALPHA = 0.7
+TVERSKY_BETA = 0.3
+EPSILON = 1e-6
+
+
+def _as_batch(mask):
+    """Return masks as a float32 (N, pixels) array"""
+    mask = np.asarray(mask)
+    if mask.ndim == 2:
+        mask = mask[np.newaxis]
+    return mask.reshape(mask.shape[0], -1).astype(np.float32, copy=False)
+
+
+def confusion_counts(y_true, y_pred):
+    """Per-sample true positive, false positive and false negative pixel counts
+
+    Both inputs are (N, H, W) or (H, W) arrays of binary or soft values in [0, 1].
+    """
+    y_true = _as_batch(y_true)
+    y_pred = _as_batch(y_pred)
+    tp = np.einsum('ij,ij->i', y_true, y_pred)
+    fp = y_pred.sum(axis=1) - tp
+    fn = y_true.sum(axis=1) - tp
+    return tp, fp, fn
+
+
+def dice_from_counts(tp, fp, fn):
+    return (2 * tp + EPSILON) / (2 * tp + fp + fn + EPSILON)
+
+
+def iou_from_counts(tp, fp, fn):
+    return (tp + EPSILON) / (tp + fp + fn + EPSILON)
+
+
+def tversky_from_counts(tp, fp, fn, alpha=TVERSKY_ALPHA, beta=TVERSKY_BETA):
+    return (tp + EPSILON) / (tp + alpha * fp + beta * fn + EPSILON)
+
+
+def dice_score(y_true, y_pred):
+    """Per-sample Dice coefficient"""
+    return dice_from_counts(*confusion_counts(y_true, y_pred))
+
+
+def iou_score(y_true, y_pred):
+    """Per-sample intersection over union"""
+    return iou_from_counts(*confusion_counts(y_true, y_pred))
+
+
+def tversky_index(y_true, y_pred, alpha=TVERSKY_ALPHA, beta=TVERSKY_BETA):
+    """Per-sample Tversky index, the NumPy counterpart of model.tversky"""
+    return tversky_from_counts(*confusion_counts(y_true, y_pred), alpha=alpha, beta=beta)
+
+
+def _surface(mask):
+    return mask & ~ndimage.binary_erosion(mask)
+
+
+def hausdorff_distance(y_true, y_pred, percentile=100):
+    """Symmetric Hausdorff distance in pixels between two binary 2D or 3D masks
+
+    Returns 0 when both masks are empty and inf when only one of them is.
+    Use percentile=95 for the robust HD95 variant.
+    """
+    y_true = np.asarray(y_true, dtype=bool)
+    y_pred = np.asarray(y_pred, dtype=bool)
+    if not y_true.any() and not y_pred.any():
+        return 0.0
+    if not y_true.any() or not y_pred.any():
+        return float('inf')
+
+    true_surface = _surface(y_true)
+    pred_surface = _surface(y_pred)
+    # Distance from every pixel to the nearest surface pixel of the other mask
+    distance_to_true = ndimage.distance_transform_edt(~true_surface)
+    distance_to_pred = ndimage.distance_transform_edt(~pred_surface)
+    distances = np.concatenate([distance_to_true[pred_surface], distance_to_pred[true_surface]])
+    return float(np.percentile(distances, percentile))
+
+
+def segmentation_metrics(y_true, y_pred):
+    """Dice, IoU and Tversky for a batch of masks as a dict of (N,) arrays"""
+    tp, fp, fn = confusion_counts(y_true, y_pred)
+    return {
+        'dice': dice_from_counts(tp, fp, fn),
+        'iou': iou_from_counts(tp, fp, fn),
+        'tversky': tversky_from_counts(tp, fp, fn),
+        'tp': tp,
+        'fp': fp,
+        'fn': fn
+    }
@@ -1,8 +1,10 @@
 import tensorflow as tf
 from tensorflow.keras.layers import Input, Conv2D, MaxPooling2D, AveragePooling2D, Flatten, Dense, Dropout
+from tensorflow.keras.layers import BatchNormalization, GlobalAveragePooling2D, Rescaling
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.applications.resnet50 import ResNet50
+from tensorflow.keras.applications import MobileNetV3Small, EfficientNetB0
 import numpy as np
 import cv2
 import matplotlib.pyplot as plt
@@ -43,30 +45,70 @@ def tversky(y_true, y_pred):
     
     return tf.reduce_mean((tp + epsilon)/(tp + alpha*fp + beta*fn + epsilon))
 
+# Classifier backbones selectable in CustomModel, from heaviest to lightest
+BACKBONES = ('resnet50', 'efficientnet_b0', 'mobilenet_v3', 'small_cnn')
+
+def classifier_weights_path(backbone='resnet50'):
+    """Default checkpoint filename for a classifier backbone"""
+    if backbone == 'resnet50':
+        return 'classifier-resnet-weights.h5'
+    return f'classifier-{backbone}-weights.h5'
+
+def small_cnn(inputs):
+    """Small trainable CNN feature extractor for the tumor classifier"""
+    x = inputs
+    for filters in (16, 32, 64, 128):
+        x = Conv2D(filters, 3, activation='relu', padding='same')(x)
+        x = BatchNormalization()(x)
+        x = MaxPooling2D(pool_size=(2, 2))(x)
+    return x
+
 @tf.keras.utils.register_keras_serializable()
 class CustomModel(Model):
-    def __init__(self, input_shape=(256, 256, 3)):
+    def __init__(self, input_shape=(256, 256, 3), backbone='resnet50', weights='imagenet'):
         super(CustomModel, self).__init__()
         
-        # Get the ResNet50 base model
-        self.basemodel = ResNet50(weights='imagenet', include_top=False, input_tensor=Input(shape=input_shape))
+        if backbone not in BACKBONES:
+            raise ValueError(f"Unknown backbone '{backbone}', expected one of {BACKBONES}")
+        self.backbone = backbone
         
-        # Freeze the base model layers
-        for layer in self.basemodel.layers:
-            layer.trainable = False
+        if backbone == 'resnet50':
+            # Get the ResNet50 base model
+            self.basemodel = ResNet50(weights=weights, include_top=False, input_tensor=Input(shape=input_shape))
+            
+            # Freeze the base model layers
+            for layer in self.basemodel.layers:
+                layer.trainable = False
+            
+            # Add classification head
+            inputs = self.basemodel.input
+            x = self.basemodel.output
+            x = AveragePooling2D(pool_size=(4, 4))(x)
+            x = Flatten(name='flatten')(x)
+            x = Dense(256, activation="relu")(x)
+            x = Dropout(0.3)(x)
+            x = Dense(256, activation="relu")(x)
+            x = Dropout(0.3)(x)
+        else:
+            inputs = Input(shape=input_shape)
+            if backbone == 'small_cnn':
+                x = small_cnn(inputs)
+            else:
+                # MobileNetV3 and EfficientNet normalize internally and expect pixels in [0, 255]
+                application = MobileNetV3Small if backbone == 'mobilenet_v3' else EfficientNetB0
+                self.basemodel = application(weights=weights, include_top=False, input_shape=input_shape)
+                self.basemodel.trainable = False
+                x = self.basemodel(Rescaling(255.0)(inputs), training=False)
+            
+            # Lightweight classification head
+            x = GlobalAveragePooling2D()(x)
+            x = Dense(128, activation="relu")(x)
+            x = Dropout(0.3)(x)
         
-        # Add classification head
-        x = self.basemodel.output
-        x = AveragePooling2D(pool_size=(4, 4))(x)
-        x = Flatten(name='flatten')(x)
-        x = Dense(256, activation="relu")(x)
-        x = Dropout(0.3)(x)
-        x = Dense(256, activation="relu")(x)
-        x = Dropout(0.3)(x)
         output = Dense(2, activation='softmax')(x)
         
         # Build the model
-        super().__init__(inputs=self.basemodel.input, outputs=output)
+        super().__init__(inputs=inputs, outputs=output)
     
     def compile(self, **kwargs):
         if 'optimizer' not in kwargs:
@@ -131,9 +173,9 @@ def visualize_prediction(image_path, true_mask_path=None, model=None):
     plt.tight_layout()
     return fig
 
-def create_model(input_shape=(256, 256, 3)):
+def create_model(input_shape=(256, 256, 3), backbone='resnet50', weights='imagenet'):
     """Create and compile the model."""
-    model = CustomModel(input_shape)
+    model = CustomModel(input_shape, backbone=backbone, weights=weights)
     model.compile()
     return model
 
@@ -3,12 +3,29 @@ from tensorflow.keras import layers, Model
 import numpy as np
 import cv2
 
+def upsample_conv(x, filters, fold=False):
+    """2x nearest upsampling followed by a 2x2 'same' convolution
+
+    With fold=True the pair is computed by a single 3x3 stride-2 transposed
+    convolution plus a one-pixel crop, which gives the same result with 9/16
+    of the multiply-adds; see optimized_inference.fold_upsample_kernel.
+    """
+    if fold:
+        x = tf.keras.layers.Conv2DTranspose(filters, 3, strides=2, activation='relu', padding='valid')(x)
+        return tf.keras.layers.Cropping2D(((1, 0), (1, 0)))(x)
+    x = tf.keras.layers.UpSampling2D(size=(2, 2))(x)
+    return tf.keras.layers.Conv2D(filters, 2, activation='relu', padding='same')(x)
+
 class ResUNet:
-    def __init__(self):
-        self.model = self.build_model()
+    def __init__(self, fold_upsampling=False, output_dtype=None, input_size=256, input_channels=1):
+        self.fold_upsampling = fold_upsampling
+        self.output_dtype = output_dtype
+        self.input_channels = input_channels
+        self.model = self.build_model(fold_upsampling, output_dtype, input_size, input_channels)
         
-    def build_model(self):
-        inputs = tf.keras.layers.Input(shape=(256, 256, 1))
+    def build_model(self, fold_upsampling=False, output_dtype=None, input_size=256, input_channels=1):
+        # input_channels > 1 is the 2.5D variant: the slice to segment with its neighbours stacked as channels
+        inputs = tf.keras.layers.Input(shape=(input_size, input_size, input_channels))
         
         # Encoder
         conv1 = tf.keras.layers.Conv2D(64, 3, activation='relu', padding='same')(inputs)
@@ -28,26 +45,23 @@ class ResUNet:
         conv4 = tf.keras.layers.Conv2D(512, 3, activation='relu', padding='same')(conv4)
         
         # Decoder
-        up5 = tf.keras.layers.UpSampling2D(size=(2, 2))(conv4)
-        up5 = tf.keras.layers.Conv2D(256, 2, activation='relu', padding='same')(up5)
+        up5 = upsample_conv(conv4, 256, fold=fold_upsampling)
         merge5 = tf.keras.layers.concatenate([conv3, up5], axis=3)
         conv5 = tf.keras.layers.Conv2D(256, 3, activation='relu', padding='same')(merge5)
         conv5 = tf.keras.layers.Conv2D(256, 3, activation='relu', padding='same')(conv5)
         
-        up6 = tf.keras.layers.UpSampling2D(size=(2, 2))(conv5)
-        up6 = tf.keras.layers.Conv2D(128, 2, activation='relu', padding='same')(up6)
+        up6 = upsample_conv(conv5, 128, fold=fold_upsampling)
         merge6 = tf.keras.layers.concatenate([conv2, up6], axis=3)
         conv6 = tf.keras.layers.Conv2D(128, 3, activation='relu', padding='same')(merge6)
         conv6 = tf.keras.layers.Conv2D(128, 3, activation='relu', padding='same')(conv6)
         
-        up7 = tf.keras.layers.UpSampling2D(size=(2, 2))(conv6)
-        up7 = tf.keras.layers.Conv2D(64, 2, activation='relu', padding='same')(up7)
+        up7 = upsample_conv(conv6, 64, fold=fold_upsampling)
         merge7 = tf.keras.layers.concatenate([conv1, up7], axis=3)
         conv7 = tf.keras.layers.Conv2D(64, 3, activation='relu', padding='same')(merge7)
         conv7 = tf.keras.layers.Conv2D(64, 3, activation='relu', padding='same')(conv7)
         
         # Output
-        outputs = tf.keras.layers.Conv2D(1, 1, activation='sigmoid')(conv7)
+        outputs = tf.keras.layers.Conv2D(1, 1, activation='sigmoid', dtype=output_dtype)(conv7)
         
         model = tf.keras.Model(inputs=inputs, outputs=outputs)
         model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
@@ -56,6 +70,88 @@ class ResUNet:
     def predict(self, x):
         return self.model.predict(x)
 
+    def at_resolution(self, input_size):
+        """Copy of the model for another (multiple of 8) input size with the same weights"""
+        model = ResUNet(self.fold_upsampling, self.output_dtype, input_size, self.input_channels)
+        model.model.set_weights(self.model.get_weights())
+        return model
+
+def resblock(x, filters):
+    """Residual block of backed.py: 1x1 and 3x3 convolutions with batch norm plus a 1x1 projected shortcut"""
+    shortcut = tf.keras.layers.Conv2D(filters, 1, kernel_initializer='he_normal')(x)
+    shortcut = tf.keras.layers.BatchNormalization()(shortcut)
+    x = tf.keras.layers.Conv2D(filters, 1, kernel_initializer='he_normal')(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Activation('relu')(x)
+    x = tf.keras.layers.Conv2D(filters, 3, padding='same', kernel_initializer='he_normal')(x)
+    x = tf.keras.layers.BatchNormalization()(x)
+    x = tf.keras.layers.Add()([x, shortcut])
+    return tf.keras.layers.Activation('relu')(x)
+
+def upsample_concat(x, skip):
+    x = tf.keras.layers.UpSampling2D(size=(2, 2))(x)
+    return tf.keras.layers.concatenate([x, skip], axis=3)
+
+class CompactResUNet:
+    """The 16-256 filter residual U-Net of backed.py with the serving interface of ResUNet
+
+    It has about a sixth of ResUNet's parameters and runs several times
+    faster on CPU, so it is the model to serve when its Dice is close enough
+    (see distill.py). Input sizes must be multiples of 16. The decoder has no
+    upsampling convolutions, so fold_upsampling is accepted and ignored.
+    """
+
+    def __init__(self, fold_upsampling=False, output_dtype=None, input_size=256, input_channels=1):
+        self.fold_upsampling = fold_upsampling
+        self.output_dtype = output_dtype
+        self.input_channels = input_channels
+        self.model = self.build_model(output_dtype, input_size, input_channels)
+
+    def build_model(self, output_dtype=None, input_size=256, input_channels=1):
+        inputs = tf.keras.layers.Input(shape=(input_size, input_size, input_channels))
+
+        # Encoder
+        conv1 = tf.keras.layers.Conv2D(16, 3, activation='relu', padding='same', kernel_initializer='he_normal')(inputs)
+        conv1 = tf.keras.layers.BatchNormalization()(conv1)
+        conv1 = tf.keras.layers.Conv2D(16, 3, activation='relu', padding='same', kernel_initializer='he_normal')(conv1)
+        conv1 = tf.keras.layers.BatchNormalization()(conv1)
+        conv2 = resblock(tf.keras.layers.MaxPooling2D(pool_size=(2, 2))(conv1), 32)
+        conv3 = resblock(tf.keras.layers.MaxPooling2D(pool_size=(2, 2))(conv2), 64)
+        conv4 = resblock(tf.keras.layers.MaxPooling2D(pool_size=(2, 2))(conv3), 128)
+
+        # Bridge
+        conv5 = resblock(tf.keras.layers.MaxPooling2D(pool_size=(2, 2))(conv4), 256)
+
+        # Decoder
+        up1 = resblock(upsample_concat(conv5, conv4), 128)
+        up2 = resblock(upsample_concat(up1, conv3), 64)
+        up3 = resblock(upsample_concat(up2, conv2), 32)
+        up4 = resblock(upsample_concat(up3, conv1), 16)
+
+        outputs = tf.keras.layers.Conv2D(1, 1, activation='sigmoid', dtype=output_dtype)(up4)
+
+        model = tf.keras.Model(inputs=inputs, outputs=outputs)
+        model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
+        return model
+
+    def predict(self, x):
+        return self.model.predict(x)
+
+    def at_resolution(self, input_size):
+        """Copy of the model for another (multiple of 16) input size with the same weights"""
+        model = CompactResUNet(self.fold_upsampling, self.output_dtype, input_size, self.input_channels)
+        model.model.set_weights(self.model.get_weights())
+        return model
+
+def normalize_to_uint8(image):
+    """Min-max scale an array to uint8 without a float64 intermediate"""
+    image = image.astype(np.float32, copy=False)
+    low = image.min()
+    scale = 255.0 / max(float(image.max() - low), 1e-8)
+    image -= low
+    image *= scale
+    return image.astype(np.uint8)
+
 def preprocess_image(image):
     """Preprocess the image for model input"""
     # Convert to grayscale if needed
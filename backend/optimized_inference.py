@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from model_clean import ResUNet
+
+logger = logging.getLogger(__name__)
+
+# CPU flags that give native bfloat16 matmul/convolution kernels in oneDNN
+BFLOAT16_CPU_FLAGS = ('avx512_bf16', 'amx_bf16')
+
+# Transposed-convolution taps of each 2x2 kernel row/column after folding, see fold_upsample_kernel
+FOLD_TAPS = ((1,), (0, 1), (0,))
+
+
+def cpu_supports_bfloat16():
+    """True if the CPU advertises native bfloat16 instructions"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = set()
+            for line in f:
+                if line.startswith('flags'):
+                    flags.update(line.split(':', 1)[1].split())
+    except OSError:
+        return False
+    return any(flag in flags for flag in BFLOAT16_CPU_FLAGS)
+
+
+def resolve_precision(precision='auto'):
+    """Map 'auto' to bfloat16 on CPUs with native support and float32 elsewhere"""
+    if precision == 'auto':
+        return 'bfloat16' if cpu_supports_bfloat16() else 'float32'
+    if precision not in ('float32', 'bfloat16', 'float16'):
+        raise ValueError(f"Unknown precision '{precision}'")
+    return precision
+
+
+def fold_upsample_kernel(kernel):
+    """Turn the 2x2 kernel of an UpSampling2D(2) + Conv2D('same') pair into a 3x3 stride-2 transposed kernel
+
+    Per axis, after nearest upsampling output 2i sees input i through both taps
+    and output 2i+1 sees input i through tap 0 and input i+1 through tap 1. A
+    'valid' transposed convolution cropped by one pixel reproduces this when its
+    three taps are the sums of original taps (1), (0, 1) and (0).
+    """
+    kh, kw, in_channels, filters = kernel.shape
+    if (kh, kw) != (2, 2):
+        raise ValueError(f"Expected a 2x2 kernel, got {kh}x{kw}")
+    folded = np.zeros((3, 3, filters, in_channels), dtype=kernel.dtype)
+    for ky, rows in enumerate(FOLD_TAPS):
+        for kx, cols in enumerate(FOLD_TAPS):
+            taps = sum(kernel[dy, dx] for dy in rows for dx in cols)
+            # Conv2DTranspose kernels are (height, width, filters, input channels)
+            folded[ky, kx] = taps.T
+    return folded
+
+
+def _weighted_layers(model):
+    return [layer for layer in model.layers if layer.weights]
+
+
+class OptimizedResUNet:
+    """Inference-only copy of a ResUNet with folded decoder upsampling and optional reduced precision
+
+    The copy is built with the reference's architecture class, so a
+    CompactResUNet (which has nothing to fold) still gets the reduced precision
+    and traced prediction.
+
+    The output layer always computes in float32, so the sigmoid mask has the
+    same dtype and range as the reference model. Prediction calls the model
+    through a traced tf.function instead of Model.predict, which avoids
+    rebuilding a data pipeline on every request.
+    """
+
+    def __init__(self, reference, precision='auto', input_size=None):
+        self.precision = resolve_precision(precision)
+        input_size = input_size or reference.model.input_shape[1]
+        self.input_channels = reference.model.input_shape[-1]
+        self.input_shape = (input_size, input_size, self.input_channels)
+        self.architecture = getattr(reference, 'architecture', type(reference))
+
+        previous_policy = tf.keras.mixed_precision.global_policy()
+        if self.precision != 'float32':
+            tf.keras.mixed_precision.set_global_policy(f'mixed_{self.precision}')
+        try:
+            self.model = self.architecture(True, 'float32', input_size, self.input_channels).model
+        finally:
+            tf.keras.mixed_precision.set_global_policy(previous_policy)
+
+        self._copy_weights(reference.model)
+        self._forward = tf.function(lambda x: self.model(x, training=False), reduce_retracing=True)
+
+    def _copy_weights(self, reference):
+        source, target = _weighted_layers(reference), _weighted_layers(self.model)
+        if len(source) != len(target):
+            raise ValueError("Reference model does not match the optimized architecture")
+        for src, dst in zip(source, target):
+            weights = src.get_weights()
+            # Copies of an already optimized model (see at_resolution) take folded kernels as they are
+            if isinstance(dst, tf.keras.layers.Conv2DTranspose) and not isinstance(src, tf.keras.layers.Conv2DTranspose):
+                weights[0] = fold_upsample_kernel(weights[0])
+            dst.set_weights(weights)
+
+    def predict(self, x, batch_size=32):
+        x = np.asarray(x, dtype=np.float32)
+        outputs = [self._forward(tf.constant(x[i:i + batch_size])).numpy() for i in range(0, len(x), batch_size)]
+        return np.concatenate(outputs) if outputs else np.zeros((0,) + self.input_shape[:2] + (1,), np.float32)
+
+    def at_resolution(self, input_size):
+        """Copy of the model for another (multiple of 8) input size with the same weights and precision"""
+        return OptimizedResUNet(self, self.precision, input_size)
+
+
+def build_optimized_model(reference, precision='auto'):
+    return OptimizedResUNet(reference, precision)
+
+
+def measure_latency(predict, images, runs=20, warmup=3):
+    """Median and p95 latency in ms of predict(images)"""
+    for _ in range(warmup):
+        predict(images)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(images)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'p50_ms': float(np.percentile(timings, 50)), 'p95_ms': float(np.percentile(timings, 95))}
+
+
+def compare(reference, batch_sizes=(1, 8), precisions=('float32', 'auto'), runs=20, warmup=3, seed=0):
+    """Latency and output difference of the optimized graph against the reference model"""
+    rng = np.random.default_rng(seed)
+    report = {
+        'onednn': os.environ.get('TF_ENABLE_ONEDNN_OPTS', 'default'),
+        'bfloat16_cpu': cpu_supports_bfloat16(),
+        'results': []
+    }
+    optimized = {p: build_optimized_model(reference, p) for p in dict.fromkeys(resolve_precision(p) for p in precisions)}
+
+    for batch_size in batch_sizes:
+        images = rng.random((batch_size,) + tuple(reference.model.input_shape[1:]), dtype=np.float32)
+        expected = reference.model.predict(images, verbose=0)
+        report['results'].append({
+            'variant': 'reference',
+            'batch_size': batch_size,
+            **measure_latency(lambda x: reference.model.predict(x, verbose=0), images, runs, warmup)
+        })
+        for precision, model in optimized.items():
+            output = model.predict(images)
+            report['results'].append({
+                'variant': f'optimized-{precision}',
+                'batch_size': batch_size,
+                'max_abs_diff': float(np.abs(output - expected).max()),
+                'mask_agreement': float(np.mean((output > 0.5) == (expected > 0.5))),
+                **measure_latency(model.predict, images, runs, warmup)
+            })
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Compare reference and optimized ResUNet inference latency')
+    parser.add_argument('--weights', help='Segmentation weights (default: random initialization)')
+    parser.add_argument('--batch-sizes', default='1,8')
+    parser.add_argument('--precisions', default='float32,auto', help='Comma separated: float32, bfloat16, float16, auto')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Optional JSON report path')
+    args = parser.parse_args()
+
+    reference = ResUNet()
+    if args.weights:
+        reference.model.load_weights(args.weights)
+
+    report = compare(
+        reference,
+        batch_sizes=[int(b) for b in args.batch_sizes.split(',')],
+        precisions=args.precisions.split(','),
+        runs=args.runs,
+        warmup=args.warmup
+    )
+    for row in report['results']:
+        diff = f" max|diff| {row['max_abs_diff']:.2e}" if 'max_abs_diff' in row else ''
+        logger.info(f"{row['variant']:>20} batch {row['batch_size']:>3}: p50 {row['p50_ms']:.1f} ms, p95 {row['p95_ms']:.1f} ms{diff}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
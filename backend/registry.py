@@ -0,0 +1,296 @@
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import numpy as np
+from model_clean import CompactResUNet, ResUNet
+
+logger = logging.getLogger(__name__)
+
+# Segmentation architectures that registry weights can be restored into
+ARCHITECTURES = {
+    'unet': ResUNet,
+    # 2.5D: each slice is segmented with one neighbour on either side as extra input channels
+    'unet_2.5d': functools.partial(ResUNet, input_channels=3),
+    # Residual 16-256 filter U-Net from backed.py, usually distilled from a 'unet' version (see distill.py)
+    'compact_resunet': CompactResUNet
+}
+
+MANIFEST_FILENAME = 'manifest.json'
+ACTIVE_FILENAME = 'ACTIVE'
+# Version names become directory names, so no separators and no leading dot (staging directories use one)
+VERSION_PATTERN = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9._-]*$')
+
+
+def weights_filename(source_path):
+    """Registry filename for a weights file, keeping the extension Keras uses to pick the format"""
+    if source_path.endswith('.weights.h5'):
+        return 'weights.weights.h5'
+    return 'weights' + (os.path.splitext(source_path)[1] or '.h5')
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    """Local store of versioned segmentation weights with checksums"""
+
+    def __init__(self, root='models'):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, version, filename=''):
+        return os.path.join(self.root, version, filename)
+
+    def check_version(self, version):
+        """Raise ValueError unless a version name stays a single directory inside the registry root"""
+        if not isinstance(version, str) or not VERSION_PATTERN.match(version):
+            raise ValueError(f"Invalid model version name: {version!r}")
+        root = os.path.realpath(self.root)
+        if os.path.dirname(os.path.realpath(self._path(version))) != root:
+            raise ValueError(f"Invalid model version name: {version!r}")
+        return version
+
+    def versions(self):
+        """Manifests of all registered versions, oldest first"""
+        manifests = []
+        for name in os.listdir(self.root):
+            manifest_path = self._path(name, MANIFEST_FILENAME)
+            if os.path.isfile(manifest_path):
+                with open(manifest_path) as f:
+                    manifests.append(json.load(f))
+        return sorted(manifests, key=lambda m: m['created_at'])
+
+    def manifest(self, version):
+        try:
+            self.check_version(version)
+        except ValueError:
+            raise KeyError(f"Unknown model version: {version}")
+        manifest_path = self._path(version, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_path):
+            raise KeyError(f"Unknown model version: {version}")
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def register(self, weights_path, version=None, architecture='unet', metadata=None):
+        """Copy a weights file into the registry as a new immutable version"""
+        if architecture not in ARCHITECTURES:
+            raise ValueError(f"Unknown architecture '{architecture}', expected one of {list(ARCHITECTURES)}")
+
+        with self._lock:
+            if version is None:
+                version = f"v{len(self.versions()) + 1}"
+            self.check_version(version)
+            if os.path.exists(self._path(version)):
+                raise ValueError(f"Model version already exists: {version}")
+
+            # Write into a temporary directory and rename so readers never see a partial version
+            staging = self._path(f".{version}.tmp")
+            os.makedirs(staging, exist_ok=True)
+            filename = weights_filename(weights_path)
+            shutil.copyfile(weights_path, os.path.join(staging, filename))
+            manifest = {
+                'version': version,
+                'architecture': architecture,
+                'weights_file': filename,
+                'sha256': file_checksum(os.path.join(staging, filename)),
+                'created_at': time.time(),
+                'source': os.path.basename(weights_path),
+                'metadata': metadata or {}
+            }
+            with open(os.path.join(staging, MANIFEST_FILENAME), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.rename(staging, self._path(version))
+
+        logger.info(f"Registered model version {version} ({manifest['sha256'][:12]})")
+        return manifest
+
+    def verify(self, version):
+        """Raise if the stored weights no longer match the recorded checksum"""
+        manifest = self.manifest(version)
+        checksum = file_checksum(self._path(version, manifest['weights_file']))
+        if checksum != manifest['sha256']:
+            raise ValueError(f"Checksum mismatch for model version {version}")
+        return manifest
+
+    def load(self, version):
+        """Build the version's architecture and restore its verified weights"""
+        manifest = self.verify(version)
+        model = ARCHITECTURES[manifest['architecture']]()
+        model.model.load_weights(self._path(version, manifest['weights_file']))
+        return model
+
+    def get_active(self):
+        """Version marked active, falling back to the most recent one"""
+        active_path = os.path.join(self.root, ACTIVE_FILENAME)
+        if os.path.isfile(active_path):
+            with open(active_path) as f:
+                return f.read().strip()
+        versions = self.versions()
+        return versions[-1]['version'] if versions else None
+
+    def set_active(self, version):
+        self.manifest(version)
+        active_path = os.path.join(self.root, ACTIVE_FILENAME)
+        with open(active_path + '.tmp', 'w') as f:
+            f.write(version)
+        os.replace(active_path + '.tmp', active_path)
+
+
+class ModelManager:
+    """Serves registry versions with background warm loading and atomic swaps
+
+    Requests take a reference to a loaded model through select(); swapping only
+    replaces the references held by the manager, so in-flight requests finish on
+    the model they started with.
+    """
+
+    def __init__(self, registry, optimize=None):
+        self.registry = registry
+        # Optional callable turning a loaded model into the object that is actually served
+        self.optimize = optimize
+        self._models = {}
+        self._active = None
+        self._canary = None
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _warm(self, model):
+        if self.optimize is not None:
+            model = self.optimize(model)
+        # Run one prediction so graph tracing and allocation happen before traffic arrives
+        model.predict(np.zeros((1,) + tuple(model.model.input_shape[1:]), dtype=np.float32))
+        return model
+
+    def start(self):
+        """Load the registry's active version, or an untrained model if the registry is empty"""
+        version = self.registry.get_active()
+        if version is None:
+            logger.warning("Model registry is empty, serving an untrained model")
+            self._models = {'untrained': self._warm(ResUNet())}
+            self._active = 'untrained'
+            return
+        self.activate(version, background=False)
+
+    def _load(self, version):
+        model = self._warm(self.registry.load(version))
+        with self._lock:
+            models = dict(self._models)
+            models[version] = model
+            self._models = models
+        return model
+
+    def load(self, version, background=True, on_loaded=None):
+        """Load and warm a version without serving it"""
+        if not background:
+            self._load(version)
+            if on_loaded is not None:
+                on_loaded()
+            return None
+
+        def run():
+            try:
+                self._load(version)
+                logger.info(f"Model version {version} loaded and warmed")
+                with self._lock:
+                    callbacks = self._loading.pop(version)[1]
+                for callback in callbacks:
+                    callback()
+            except Exception as e:
+                logger.error(f"Failed to load model version {version}: {str(e)}")
+                with self._lock:
+                    self._loading.pop(version, None)
+
+        with self._lock:
+            # A version already loading only gets the extra callback queued
+            if version in self._loading:
+                thread, callbacks = self._loading[version]
+                if on_loaded is not None:
+                    callbacks.append(on_loaded)
+                return thread
+            thread = threading.Thread(target=run, name=f'load-{version}', daemon=True)
+            self._loading[version] = (thread, [on_loaded] if on_loaded is not None else [])
+        thread.start()
+        return thread
+
+    def activate(self, version, background=True):
+        """Load a version (in the background by default) and swap it in once warm"""
+        self.registry.manifest(version)
+
+        def swap():
+            with self._lock:
+                previous = self._active
+                self._active = version
+                self._evict()
+            self.registry.set_active(version)
+            logger.info(f"Serving model version {version} (was {previous})")
+
+        if version in self._models:
+            swap()
+            return None
+        return self.load(version, background=background, on_loaded=swap)
+
+    def set_canary(self, version, percent):
+        """Route a percentage of requests to a version; percent=0 or version=None disables the canary"""
+        if version is None or percent <= 0:
+            with self._lock:
+                self._canary = None
+                self._evict()
+            return None
+
+        self.registry.manifest(version)
+
+        def enable():
+            with self._lock:
+                self._canary = (version, min(float(percent), 100.0))
+
+        if version in self._models:
+            enable()
+            return None
+        return self.load(version, on_loaded=enable)
+
+    def _evict(self):
+        # Drop models that are neither active, canary nor waiting for their swap or canary to be enabled;
+        # in-flight requests keep their own reference
+        keep = {self._active} | set(self._loading)
+        if self._canary is not None:
+            keep.add(self._canary[0])
+        self._models = {v: m for v, m in self._models.items() if v in keep}
+
+    def select(self, version=None):
+        """Pick the model for one request: an explicit version, the canary or the active version"""
+        with self._lock:
+            models, active, canary = self._models, self._active, self._canary
+
+        if version:
+            if version not in models:
+                raise KeyError(f"Model version not loaded: {version}")
+            return version, models[version]
+
+        # A canary whose model is not loaded (evicted before it was enabled) falls back to the active version
+        if canary is not None and canary[0] in models and random.random() * 100 < canary[1]:
+            return canary[0], models[canary[0]]
+
+        return active, models[active]
+
+    def status(self):
+        return {
+            'active': self._active,
+            'canary': {'version': self._canary[0], 'percent': self._canary[1]} if self._canary else None,
+            'loaded': sorted(self._models),
+            'loading': sorted(self._loading),
+            'versions': self.registry.versions()
+        }
@@ -0,0 +1,252 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Lane weights: under contention a lane gets model time in proportion to its weight
+DEFAULT_LANES = {'interactive': 8, 'bulk': 1}
+
+
+class QuotaExceeded(RuntimeError):
+    """Raised when a client already has its maximum number of model calls queued or running"""
+
+
+class _Ticket:
+    def __init__(self, lane, client, cost):
+        self.lane = lane
+        self.client = client
+        self.cost = cost
+        self.enqueued = time.perf_counter()
+        self.granted = threading.Event()
+
+
+class _Lane:
+    def __init__(self, name, weight, window):
+        self.name = name
+        self.weight = weight
+        self.deficit = 0
+        # Waiting tickets per client, served round robin so one client cannot hold up the others in its lane
+        self.clients = collections.OrderedDict()
+        self.waiting = 0
+        self.running = 0
+        self.granted = 0
+        self.images = 0
+        self.rejected = 0
+        self.queue_ms = collections.deque(maxlen=window)
+        self.max_queue_ms = 0.0
+
+    def push(self, ticket):
+        self.clients.setdefault(ticket.client, collections.deque()).append(ticket)
+        self.waiting += 1
+
+    def peek(self):
+        return next(iter(self.clients.values()))[0]
+
+    def pop(self):
+        client, tickets = next(iter(self.clients.items()))
+        ticket = tickets.popleft()
+        del self.clients[client]
+        if tickets:
+            self.clients[client] = tickets
+        self.waiting -= 1
+        return ticket
+
+    def stats(self):
+        queue_ms = np.array(self.queue_ms)
+        return {
+            'weight': self.weight,
+            'waiting': self.waiting,
+            'running': self.running,
+            'granted': self.granted,
+            'images': self.images,
+            'rejected': self.rejected,
+            'queue_ms': {
+                'p50': float(np.percentile(queue_ms, 50)) if len(queue_ms) else 0.0,
+                'p95': float(np.percentile(queue_ms, 95)) if len(queue_ms) else 0.0,
+                'p99': float(np.percentile(queue_ms, 99)) if len(queue_ms) else 0.0,
+                'max': self.max_queue_ms
+            }
+        }
+
+
+class InferenceScheduler:
+    """Hands out model slots to priority lanes by deficit round robin, one model call at a time
+
+    Every model call (one batch) waits for a slot. Lanes are visited in turn
+    and each visit adds quantum * weight images of credit, so a bulk lane
+    still makes progress while an interactive lane with a higher weight gets
+    most of the model time. Long jobs call the model once per batch, so an
+    interactive request waits at most for the batch that is running (batch
+    boundary preemption). Within a lane, clients are served round robin, and
+    a client may only have max_pending calls queued or running at once.
+    """
+
+    def __init__(self, lanes=None, slots=1, quantum=16, max_pending=8, default_lane='bulk', window=1000):
+        lanes = lanes or DEFAULT_LANES
+        if default_lane not in lanes:
+            raise ValueError(f"Default lane '{default_lane}' is not one of {list(lanes)}")
+        # A lane without weight would never earn credit, and _next would spin forever holding the lock
+        for name, weight in lanes.items():
+            if weight < 1:
+                raise ValueError(f"Lane '{name}' needs a weight of at least 1, got {weight}")
+        if quantum < 1:
+            raise ValueError(f"quantum must be at least 1, got {quantum}")
+        if slots < 1:
+            raise ValueError(f"slots must be at least 1, got {slots}")
+        if max_pending < 1:
+            raise ValueError(f"max_pending must be at least 1, got {max_pending}")
+        self.slots = slots
+        self.quantum = quantum
+        self.max_pending = max_pending
+        self.default_lane = default_lane
+        self._lanes = {name: _Lane(name, weight, window) for name, weight in lanes.items()}
+        self._order = list(lanes)
+        self._cursor = 0
+        self._credited = False
+        self._free = slots
+        self._pending = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def lanes(self):
+        return list(self._order)
+
+    @contextlib.contextmanager
+    def context(self, lane=None, client=None, reserved=False):
+        """Lane and client for the model calls this thread makes inside the block
+
+        reserved=True means the client's quota was already taken with reserve(),
+        so the calls in the block do not count against it again.
+        """
+        if lane is not None and lane not in self._lanes:
+            raise ValueError(f"Unknown lane '{lane}', expected one of {self._order}")
+        previous = getattr(self._local, 'context', None)
+        self._local.context = (lane or self.default_lane, client, reserved)
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    def current(self):
+        return (getattr(self._local, 'context', None) or (self.default_lane, None, False))[:2]
+
+    def reserve(self, client, lane=None):
+        """Take one of a client's pending calls up front; raises QuotaExceeded like slot() would
+
+        Used by requests that have to know before they respond whether their
+        model calls will be admitted. Give it back with release().
+        """
+        with self._lock:
+            self._admit(client, lane or self.default_lane)
+
+    def release(self, client):
+        with self._lock:
+            self._leave(client)
+
+    def _admit(self, client, lane):
+        if client is None:
+            return
+        if self._pending[client] >= self.max_pending:
+            self._lanes[lane].rejected += 1
+            raise QuotaExceeded(f"Client {client} already has {self.max_pending} inference calls pending")
+        self._pending[client] += 1
+
+    def _leave(self, client):
+        if client is None:
+            return
+        self._pending[client] -= 1
+        if not self._pending[client]:
+            del self._pending[client]
+
+    def _next(self):
+        # Deficit round robin over the lanes; the caller holds the lock and knows a ticket is waiting
+        while True:
+            lane = self._lanes[self._order[self._cursor]]
+            if lane.waiting:
+                # A lane gets its quantum once per visit and is served while its credit lasts
+                if not self._credited:
+                    lane.deficit += self.quantum * lane.weight
+                    self._credited = True
+                if lane.deficit >= lane.peek().cost:
+                    ticket = lane.pop()
+                    lane.deficit -= ticket.cost
+                    return ticket
+            else:
+                # An idle lane does not save up credit for later
+                lane.deficit = 0
+            self._cursor = (self._cursor + 1) % len(self._order)
+            self._credited = False
+
+    def _dispatch(self):
+        while self._free and any(lane.waiting for lane in self._lanes.values()):
+            ticket = self._next()
+            lane = self._lanes[ticket.lane]
+            waited = (time.perf_counter() - ticket.enqueued) * 1000
+            lane.queue_ms.append(waited)
+            lane.max_queue_ms = max(lane.max_queue_ms, waited)
+            lane.running += 1
+            lane.granted += 1
+            lane.images += ticket.cost
+            self._free -= 1
+            ticket.granted.set()
+
+    @contextlib.contextmanager
+    def slot(self, lane=None, client=None, cost=1):
+        """Wait for a model slot in a lane; cost is the number of images in the call"""
+        reserved = False
+        if lane is None:
+            lane, client, reserved = getattr(self._local, 'context', None) or (self.default_lane, None, False)
+        ticket = _Ticket(lane, client, max(1, int(cost)))
+        # A reserved client's quota was taken by reserve() and is given back by release()
+        quota_client = None if reserved else client
+        with self._lock:
+            self._admit(quota_client, lane)
+            self._lanes[lane].push(ticket)
+            self._dispatch()
+        try:
+            ticket.granted.wait()
+            yield
+        finally:
+            with self._lock:
+                self._lanes[lane].running -= 1
+                self._free += 1
+                self._leave(quota_client)
+                self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'busy': self.slots - self._free,
+                'quantum': self.quantum,
+                'client_quota': self.max_pending,
+                'clients_pending': len(self._pending),
+                'lanes': {name: lane.stats() for name, lane in self._lanes.items()}
+            }
+
+
+class ScheduledModel:
+    """Serving model whose predict() waits for a scheduler slot in the calling thread's lane
+
+    Everything else is forwarded to the wrapped model, so the wrapper can be
+    served wherever a (optimized) ResUNet is expected.
+    """
+
+    def __init__(self, model, scheduler):
+        self.wrapped = model
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def predict(self, x, *args, **kwargs):
+        with self.scheduler.slot(cost=len(x)):
+            return self.wrapped.predict(x, *args, **kwargs)
+
+    def at_resolution(self, input_size):
+        return ScheduledModel(self.wrapped.at_resolution(input_size), self.scheduler)
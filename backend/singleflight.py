@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def content_digest(stream, chunk_size=1 << 20):
+    """SHA-256 of a seekable stream, which is rewound afterwards"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution
+
+    The first caller of a key runs the function; callers that arrive while it
+    is running wait for it and receive the same result, or the same exception.
+    Nothing is kept once the call finishes, so this only removes duplicate
+    work that overlaps in time and never serves stale results.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.saved_seconds = 0.0
+        self.max_waiters = 0
+
+    def do(self, key, fn):
+        """Return (result, shared); shared is True when the result came from another caller's execution"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        start = time.perf_counter()
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                del self._calls[key]
+                if call.error is not None:
+                    self.failed += 1
+                # Every waiter would otherwise have run the same work itself
+                self.saved_seconds += elapsed * call.waiters
+            if call.waiters:
+                logger.info(f"Shared one execution with {call.waiters} identical requests")
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            requests = self.executed + self.coalesced
+            return {
+                'requests': requests,
+                'executed': self.executed,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'in_flight': len(self._calls),
+                'max_waiters': self.max_waiters,
+                'coalesce_rate': self.coalesced / requests if requests else 0.0,
+                'saved_seconds': self.saved_seconds
+            }
@@ -0,0 +1,131 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import tempfile
+import urllib.error
+import urllib.request
+import uuid
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_series(output_dir, slices=16, size=128, study_uid=None):
+    """Write a synthetic single-frame CT series with a bright spherical lesion; returns the file paths"""
+    import pydicom
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+    study_uid = study_uid or generate_uid()
+    series_uid = generate_uid()
+    yy, xx = np.mgrid[:size, :size]
+    paths = []
+    for z in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(output_dir, f'{z:04d}.dcm')
+        ds = FileDataset(path, {}, file_meta=meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'CT'
+        ds.InstanceNumber = z + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(z) * 2.0]
+        ds.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        ds.PixelSpacing = [1.0, 1.0]
+        ds.SliceThickness = 2.0
+        ds.Rows = ds.Columns = size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        tissue = ((yy - size / 2) ** 2 + (xx - size / 2) ** 2 < (size * 0.4) ** 2) * 400
+        radius = max(0.0, (size * 0.15) ** 2 - ((z - slices / 2) * 2.0) ** 2)
+        lesion = ((yy - size * 0.4) ** 2 + (xx - size * 0.55) ** 2 < radius) * 600
+        ds.PixelData = (tissue + lesion).astype(np.uint16).tobytes()
+        pydicom.dcmwrite(path, ds, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+
+def multipart_body(paths, boundary, chunk_size=1 << 16):
+    """Yield a multipart/related body part by part, reading each file in chunks"""
+    for path in paths:
+        yield f'--{boundary}\r\nContent-Type: application/dicom\r\n\r\n'.encode('latin-1')
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode('latin-1')
+
+
+def body_length(paths, boundary):
+    part_header = len(f'--{boundary}\r\nContent-Type: application/dicom\r\n\r\n') + 2
+    return sum(part_header + os.path.getsize(path) for path in paths) + len(f'--{boundary}--\r\n')
+
+
+def parse_body(body):
+    """JSON response body, or {'error': text} when a server or proxy answered with something else"""
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        return {'error': body.decode('utf-8', errors='replace').strip()[:200]}
+
+
+def send(url, paths, study_uid=None):
+    """Stream DICOM files to a STOW-RS endpoint; returns the HTTP status and the JSON response"""
+    boundary = uuid.uuid4().hex
+    if study_uid:
+        url = f"{url.rstrip('/')}/{study_uid}"
+    request = urllib.request.Request(url, data=multipart_body(paths, boundary), method='POST', headers={
+        'Content-Type': f'multipart/related; type="application/dicom"; boundary={boundary}',
+        'Content-Length': str(body_length(paths, boundary)),
+        'Accept': 'application/dicom+json'
+    })
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, parse_body(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, parse_body(e.read())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Send DICOM instances to a STOW-RS endpoint')
+    parser.add_argument('--url', default='http://localhost:5000/dicomweb/studies')
+    parser.add_argument('--input', nargs='*', help='DICOM files or directories (default: a synthetic series)')
+    parser.add_argument('--study-uid', help='Post to /studies/<uid>')
+    parser.add_argument('--slices', type=int, default=16, help='Slices of the synthetic series')
+    parser.add_argument('--batch', type=int, default=0, help='Instances per request (default: all in one)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.input:
+            paths = []
+            for item in args.input:
+                paths.extend(sorted(glob.glob(os.path.join(item, '*'))) if os.path.isdir(item) else [item])
+        else:
+            paths = synthetic_series(workdir, slices=args.slices, study_uid=args.study_uid)
+            logger.info(f"Generated a synthetic series of {len(paths)} instances")
+
+        batch = args.batch or len(paths)
+        for start in range(0, len(paths), batch):
+            status, body = send(args.url, paths[start:start + batch], args.study_uid)
+            stored = len(body.get('00081199', {}).get('Value', []))
+            failed = len(body.get('00081198', {}).get('Value', []))
+            logger.info(f"HTTP {status}: {stored} stored, {failed} failed")
+            if 'error' in body:
+                logger.error(f"Server error: {body['error']}")
+
+
+if __name__ == '__main__':
+    main()
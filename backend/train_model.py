@@ -1,7 +1,7 @@
 import os
 import numpy as np
 import cv2
-from model import CustomModel
+from model import CustomModel, classifier_weights_path
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
@@ -58,11 +58,12 @@ def setup_data_generators(train_df, test_df, batch_size=16):
     
     return train_generator, valid_generator, test_generator
 
-def train_model(train_df, test_df, epochs=50, batch_size=16):
+def train_model(train_df, test_df, epochs=50, batch_size=16, backbone='resnet50'):
     """Train the model using data generators"""
     try:
         # Create model
-        model = CustomModel(input_shape=(256, 256, 3))
+        model = CustomModel(input_shape=(256, 256, 3), backbone=backbone)
+        model.compile()
         
         # Setup data generators
         train_generator, valid_generator, test_generator = setup_data_generators(train_df, test_df, batch_size)
@@ -76,7 +77,7 @@ def train_model(train_df, test_df, epochs=50, batch_size=16):
                 patience=20
             ),
             ModelCheckpoint(
-                filepath="classifier-resnet-weights.h5",
+                filepath=classifier_weights_path(backbone),
                 verbose=1,
                 save_best_only=True
             ),
@@ -218,23 +219,32 @@ def predict_and_visualize(model, image_path):
             'error': str(e)
         }
 
-def load_trained_model():
-    """Load the pre-trained model"""
+def load_trained_model(weights_path=None, strict=False):
+    """Load the pre-trained model
+    
+    With strict=True a missing or incompatible weights file raises instead of
+    returning an untrained model.
+    """
     try:
         # Create model instance
         model = CustomModel(input_shape=(256, 256, 3))
         
         # Load weights if they exist
-        weights_path = os.path.join(os.path.dirname(__file__), 'weights_seg.h5')
+        if weights_path is None:
+            weights_path = os.path.join(os.path.dirname(__file__), 'weights_seg.h5')
         if os.path.exists(weights_path):
             try:
                 model.load_weights(weights_path)
                 print("Model loaded successfully!")
             except Exception as e:
-                print(f"Warning: Could not load weights: {str(e)}")
+                if strict:
+                    raise
+                print(f"Warning: Could not load weights from {weights_path}: {str(e)}")
                 print("Using untrained model instead.")
         else:
-            print("No pre-trained weights found. Using untrained model.")
+            if strict:
+                raise FileNotFoundError(f"No pre-trained weights found at {weights_path}")
+            print(f"No pre-trained weights found at {weights_path}. Using untrained model.")
         
         # Compile model
         model.compile(
@@ -245,6 +255,8 @@ def load_trained_model():
         
         return model
     except Exception as e:
+        if strict:
+            raise
         print(f"Error loading model: {str(e)}")
         return None
 
@@ -259,7 +271,7 @@ if __name__ == '__main__':
         print("\nAvailable functions:")
         print("1. predict_and_visualize(model, image_path)")
         print("   - Returns predicted class and confidence")
-        print("2. train_model(train_df, test_df, epochs=50, batch_size=16)")
+        print("2. train_model(train_df, test_df, epochs=50, batch_size=16, backbone='resnet50')")
         print("   - Trains the model on provided data")
             
     except Exception as e:
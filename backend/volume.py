@@ -0,0 +1,324 @@
+import argparse
+import collections
+import logging
+import os
+import time
+import numpy as np
+from gzip_index import close_nifti, open_nifti
+from lesions import analyze_lesions
+from mask_export import mask_affine, open_writers
+from memory import check_voxels
+from model_clean import ResUNet, normalize_to_uint8, preprocess_image
+
+logger = logging.getLogger(__name__)
+
+# A lazily read volume: read_slice(z) returns one raw 2D slice, spacing is (row, column, slice) in mm,
+# affine maps (row, column, slice) indices to RAS mm, headers are the source DICOM headers, if any, and
+# close, if set, releases the open source file once no more slices are read
+Volume = collections.namedtuple('Volume', ['depth', 'shape', 'read_slice', 'spacing', 'affine', 'headers', 'close'],
+                                defaults=(None, None))
+
+
+def dicom_affine(header, row_spacing, column_spacing, slice_spacing):
+    """RAS affine of a DICOM slice stack from its first header, or a scaling matrix without patient geometry"""
+    if 'ImageOrientationPatient' not in header or 'ImagePositionPatient' not in header:
+        return np.diag([row_spacing, column_spacing, slice_spacing, 1.0])
+    orientation = np.array(header.ImageOrientationPatient, dtype=np.float64)
+    # Rows advance along the column direction (second triplet), columns along the row direction
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[3:] * row_spacing
+    affine[:3, 1] = orientation[:3] * column_spacing
+    affine[:3, 2] = np.cross(orientation[:3], orientation[3:]) * slice_spacing
+    affine[:3, 3] = np.array(header.ImagePositionPatient, dtype=np.float64)
+    # DICOM patient coordinates are LPS
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+
+def load_volume(file_path, max_voxels=None):
+    """Open a NIfTI volume or multi-frame DICOM without decoding all slices up front"""
+    lower = file_path.lower()
+    if lower.endswith('.nii') or lower.endswith('.nii.gz'):
+        # One open file and a seek index, instead of nibabel decompressing a .nii.gz from the start for every slice
+        img = open_nifti(file_path)
+        try:
+            check_voxels(img.shape, max_voxels)
+            if len(img.shape) != 3:
+                raise ValueError(f"Expected a 3D volume, got shape {img.shape}")
+        except Exception:
+            close_nifti(img)
+            raise
+        return Volume(
+            depth=img.shape[2],
+            shape=img.shape[:2],
+            read_slice=lambda z: np.asarray(img.dataobj[:, :, z], dtype=np.float32),
+            spacing=tuple(float(s) for s in img.header.get_zooms()[:3]),
+            affine=img.affine,
+            close=lambda: close_nifti(img)
+        )
+
+    import pydicom
+
+    header = pydicom.dcmread(file_path, stop_before_pixels=True)
+    frames = int(header.get('NumberOfFrames', 1) or 1)
+    check_voxels((header.Rows, header.Columns, frames), max_voxels)
+    pixels = pydicom.dcmread(file_path).pixel_array.reshape(frames, header.Rows, header.Columns)
+    row_spacing, column_spacing = (float(s) for s in header.get('PixelSpacing', (1.0, 1.0)))
+    slice_spacing = float(header.get('SpacingBetweenSlices', header.get('SliceThickness', 1.0)) or 1.0)
+    return Volume(
+        depth=frames,
+        shape=(header.Rows, header.Columns),
+        read_slice=lambda z: pixels[z].astype(np.float32),
+        spacing=(row_spacing, column_spacing, slice_spacing),
+        affine=dicom_affine(header, row_spacing, column_spacing, slice_spacing),
+        headers=[header]
+    )
+
+
+def prepare_slice(raw):
+    """Raw slice to a (256, 256) model input plane, with the same normalization as single images"""
+    return preprocess_image(normalize_to_uint8(raw))[0, ..., 0]
+
+
+def model_context(model):
+    """Neighbouring slices on each side a model takes as extra channels (0 for 2D models)"""
+    return model.model.input_shape[-1] // 2
+
+
+def expand_context(images, channels):
+    """Repeat a single-slice (N, H, W, 1) batch across the channels of a 2.5D model"""
+    if channels == images.shape[-1]:
+        return images
+    return np.repeat(images[..., :1], channels, axis=-1)
+
+
+def inflate_weights(model, context=1):
+    """2.5D ResUNet initialized from a 2D one; it gives the same output until it is fine-tuned
+
+    The first convolution only gets the 2D kernel on the centre channel, the
+    neighbour channels start at zero.
+    """
+    inflated = ResUNet(input_channels=2 * context + 1)
+    weights = model.model.get_weights()
+    kernel = np.zeros(weights[0].shape[:2] + (2 * context + 1,) + weights[0].shape[3:], dtype=weights[0].dtype)
+    kernel[:, :, context] = weights[0][:, :, 0]
+    inflated.model.set_weights([kernel] + weights[1:])
+    return inflated
+
+
+def smooth_mask(mask, min_voxels=64, min_slices=2):
+    """Drop 3D connected components that are too small or do not continue to a neighbouring slice
+
+    mask is (slices, H, W); components are 26-connected so a lesion that shifts
+    by a pixel between slices stays one component. Returns the cleaned mask and
+    the number of components kept and removed.
+    """
+    from scipy import ndimage
+
+    labels, count = ndimage.label(mask, structure=np.ones((3, 3, 3), dtype=bool))
+    if count == 0:
+        return mask, 0, 0
+    sizes = np.bincount(labels.ravel(), minlength=count + 1)
+    extents = np.array([0] + [obj[0].stop - obj[0].start for obj in ndimage.find_objects(labels)])
+    keep = (sizes >= min_voxels) & (extents >= min_slices)
+    keep[0] = False
+    return keep[labels].astype(mask.dtype), int(keep.sum()), int(count - keep.sum())
+
+
+class VolumeSegmenter:
+    """Streams a volume through a (2.5D) segmentation model in batches of slice windows
+
+    Each slice is read and preprocessed once into a ring buffer of 2 * context + 1
+    planes; windows are stacked from the buffer, replicating the first and last
+    slice at the volume edges. 2D models (context 0) use the same path, so a
+    volume costs one decode and one model pass per slice either way.
+    """
+
+    def __init__(self, model, batch_size=16, threshold=0.5, gate=None, size=256):
+        self.model = model
+        self.context = model_context(model)
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.gate = gate
+        self.size = size
+
+    def segment(self, volume, on_batch=None):
+        """Return the binary (slices, size, size) mask, per-slice peak probability and run statistics
+
+        on_batch(masks) is called with each finished batch of mask slices, in slice order.
+        """
+        depth, context = volume.depth, self.context
+        window = 2 * context + 1
+        ring = np.empty((window, self.size, self.size), dtype=np.float32)
+        batch = np.empty((self.batch_size, self.size, self.size, window), dtype=np.float32)
+        mask = np.zeros((depth, self.size, self.size), dtype=np.uint8)
+        peak = np.zeros(depth, dtype=np.float32)
+        decisions = collections.Counter()
+        pending = []
+        loaded = -1
+        start = time.perf_counter()
+
+        def flush():
+            images = batch[:len(pending)]
+            if self.gate is not None:
+                probabilities, gate_decisions = self.gate.run(self.model, images)
+                decisions.update(gate_decisions)
+            else:
+                probabilities = self.model.predict(images)
+            mask[pending] = probabilities[..., 0] > self.threshold
+            peak[pending] = probabilities.reshape(len(pending), -1).max(axis=1)
+            if on_batch is not None:
+                on_batch(mask[pending[0]:pending[-1] + 1])
+            pending.clear()
+
+        for index in range(depth):
+            # Read ahead up to the last slice of this window; older slices are overwritten in the ring
+            while loaded < min(index + context, depth - 1):
+                loaded += 1
+                ring[loaded % window] = prepare_slice(volume.read_slice(loaded))
+            for channel in range(window):
+                neighbour = min(max(index - context + channel, 0), depth - 1)
+                batch[len(pending), ..., channel] = ring[neighbour % window]
+            pending.append(index)
+            if len(pending) == self.batch_size:
+                flush()
+        if pending:
+            flush()
+
+        elapsed = time.perf_counter() - start
+        stats = {
+            'slices': depth,
+            'context': context,
+            'seconds': elapsed,
+            'slices_per_second': depth / elapsed if elapsed > 0 else 0.0
+        }
+        if self.gate is not None:
+            stats['early_exit'] = dict(decisions)
+        return mask, peak, stats
+
+
+def mask_spacing(volume, size=256):
+    """(slice, row, column) voxel size in mm of a mask resized to size x size in-plane"""
+    rows, columns = volume.shape
+    return volume.spacing[2], volume.spacing[0] * rows / size, volume.spacing[1] * columns / size
+
+
+def voxel_volume_ml(volume, size=256):
+    """Volume in ml of one voxel of a mask resized to size x size in-plane"""
+    return float(np.prod(mask_spacing(volume, size))) / 1000.0
+
+
+def mask_to_nifti(mask, volume, size=256):
+    """(slices, size, size) mask as a NIfTI image in the input's (rescaled) voxel space"""
+    import nibabel as nib
+
+    return nib.Nifti1Image(np.ascontiguousarray(np.moveaxis(mask, 0, -1)), mask_affine(volume, size))
+
+
+def segment_file(model, file_path, smooth=True, min_voxels=64, batch_size=16, threshold=0.5, gate=None,
+                 max_voxels=None, export_dir=None, export_formats=()):
+    """Segment a volume file; returns the mask, the volume and a JSON-serializable summary"""
+    volume = load_volume(file_path, max_voxels)
+    try:
+        mask, summary = segment_volume(model, volume, smooth, min_voxels, batch_size, threshold, gate,
+                                       export_dir, export_formats)
+    finally:
+        if volume.close is not None:
+            volume.close()
+    return mask, volume, summary
+
+
+def segment_volume(model, volume, smooth=True, min_voxels=64, batch_size=16, threshold=0.5, gate=None,
+                   export_dir=None, export_formats=()):
+    """Segment a Volume; returns the mask and a JSON-serializable summary
+
+    export_formats ('nifti', 'seg') are streamed to files in export_dir: unsmoothed
+    masks batch by batch as slices finish, smoothed masks once the 3D components are known.
+    """
+    writers = open_writers(volume, export_dir, export_formats) if export_formats else {}
+
+    def write(masks):
+        for _, writer in writers.values():
+            writer.write(masks)
+
+    try:
+        segmenter = VolumeSegmenter(model, batch_size=batch_size, threshold=threshold, gate=gate)
+        mask, peak, stats = segmenter.segment(volume, on_batch=None if smooth else write)
+        summary = {'stats': stats}
+        if smooth:
+            mask, kept, removed = smooth_mask(mask, min_voxels=min_voxels)
+            summary['components'] = kept
+            summary['removed_components'] = removed
+            for z in range(0, len(mask), batch_size):
+                write(mask[z:z + batch_size])
+    finally:
+        for _, writer in writers.values():
+            writer.close()
+    summary['exports'] = {name: filename for name, (filename, _) in writers.items()}
+
+    tumor_pixels = mask.reshape(len(mask), -1).sum(axis=1)
+    summary['tumor_voxels'] = int(tumor_pixels.sum())
+    summary['tumor_volume_ml'] = summary['tumor_voxels'] * voxel_volume_ml(volume)
+    summary['lesions'] = analyze_lesions(mask, mask_spacing(volume))
+    summary['slices'] = [
+        {'index': i, 'tumor_pixels': int(pixels), 'max_probability': float(p)}
+        for i, (pixels, p) in enumerate(zip(tumor_pixels, peak))
+    ]
+    return mask, summary
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Segment a NIfTI or multi-frame DICOM volume slice by slice')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    segment = subparsers.add_parser('segment', help='Write the 3D mask of a volume')
+    segment.add_argument('--input', required=True)
+    segment.add_argument('--output', help='Output mask (.nii or .nii.gz)')
+    segment.add_argument('--export-dir', help='Stream the mask to files in this directory instead')
+    segment.add_argument('--formats', default='nifti,seg', help='Formats written to --export-dir: nifti, seg')
+    segment.add_argument('--weights', help='Segmentation weights (2D or 2.5D, see --context)')
+    segment.add_argument('--version', help='Model registry version to use instead of --weights')
+    segment.add_argument('--registry', default='models')
+    segment.add_argument('--context', type=int, default=0, help='Neighbour slices per side of the --weights model')
+    segment.add_argument('--batch-size', type=int, default=16)
+    segment.add_argument('--threshold', type=float, default=0.5)
+    segment.add_argument('--no-smooth', action='store_true', help='Keep all 3D connected components')
+    segment.add_argument('--min-voxels', type=int, default=64)
+
+    inflate = subparsers.add_parser('inflate', help='Initialize 2.5D weights from 2D weights')
+    inflate.add_argument('--weights', required=True)
+    inflate.add_argument('--output', required=True, help='Output weights (.weights.h5)')
+    inflate.add_argument('--context', type=int, default=1)
+    args = parser.parse_args()
+    if args.command == 'segment' and not (args.output or args.export_dir):
+        parser.error('segment needs --output or --export-dir')
+
+    if args.command == 'inflate':
+        model = ResUNet()
+        model.model.load_weights(args.weights)
+        inflate_weights(model, args.context).model.save_weights(args.output)
+        logger.info(f"Saved {2 * args.context + 1}-channel weights to {args.output}")
+        return
+
+    if args.version:
+        from registry import ModelRegistry
+        model = ModelRegistry(args.registry).load(args.version)
+    else:
+        model = ResUNet(input_channels=2 * args.context + 1)
+        if args.weights:
+            model.model.load_weights(args.weights)
+
+    formats = args.formats.split(',') if args.export_dir else ()
+    if args.export_dir:
+        os.makedirs(args.export_dir, exist_ok=True)
+    mask, volume, summary = segment_file(model, args.input, smooth=not args.no_smooth, min_voxels=args.min_voxels,
+                                         batch_size=args.batch_size, threshold=args.threshold,
+                                         export_dir=args.export_dir, export_formats=formats)
+    if args.output:
+        mask_to_nifti(mask, volume).to_filename(args.output)
+    logger.info(f"{summary['stats']['slices']} slices at {summary['stats']['slices_per_second']:.1f} slices/s, "
+                f"tumor volume {summary['tumor_volume_ml']:.2f} ml")
+
+
+if __name__ == '__main__':
+    main()
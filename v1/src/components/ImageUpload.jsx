@@ -1,10 +1,77 @@
-import React, { useState, useCallback, useRef } from 'react';
+import React, { useState, useCallback, useRef, useEffect } from 'react';
 import { Upload, X, AlertCircle, Image as ImageIcon, Loader2, ZoomIn, Brain } from 'lucide-react';
 
 const ALLOWED_EXTENSIONS = ['dcm', 'nii', 'nii.gz', 'dicom', 'jpg', 'jpeg', 'png'];
 const MAX_FILE_SIZE = 50 * 1024 * 1024; // 50MB for medical images
 const MEDICAL_IMAGE_KEYWORDS = ['mri', 'scan', 'tumor', 'brain', 'ct', 'xray', 'medical'];
 
+// Draws the tumor overlay from the polygons returned by /api/predict with render=client
+const OverlayCanvas = ({ imageUrl, imageSize, polygons }) => {
+    const canvasRef = useRef(null);
+
+    useEffect(() => {
+        const canvas = canvasRef.current;
+        if (!canvas || !imageUrl) return;
+        const ctx = canvas.getContext('2d');
+        const image = new Image();
+        image.onload = () => {
+            // Polygons are in the coordinates of the server's display image
+            ctx.drawImage(image, 0, 0, imageSize.width, imageSize.height);
+            ctx.beginPath();
+            polygons.forEach(polygon => {
+                [polygon.points, ...polygon.holes].forEach(ring => {
+                    ring.forEach(([x, y], i) => (i === 0 ? ctx.moveTo(x, y) : ctx.lineTo(x, y)));
+                    ctx.closePath();
+                });
+            });
+            ctx.fillStyle = 'rgba(0, 255, 0, 0.3)';
+            ctx.fill('evenodd');
+            ctx.strokeStyle = 'rgb(0, 255, 0)';
+            ctx.lineWidth = 1;
+            ctx.stroke();
+        };
+        image.src = imageUrl;
+    }, [imageUrl, imageSize, polygons]);
+
+    return (
+        <canvas
+            ref={canvasRef}
+            width={imageSize.width}
+            height={imageSize.height}
+            className="w-full rounded-lg object-contain border border-gray-200"
+        />
+    );
+};
+
+// Unpacks the low-resolution bitmask (8 pixels per byte, most significant bit first) into a canvas
+const BitmaskCanvas = ({ bitmask }) => {
+    const canvasRef = useRef(null);
+
+    useEffect(() => {
+        const canvas = canvasRef.current;
+        if (!canvas || !bitmask) return;
+        const bytes = Uint8Array.from(atob(bitmask.bits), c => c.charCodeAt(0));
+        const pixels = new ImageData(bitmask.width, bitmask.height);
+        for (let i = 0; i < bitmask.width * bitmask.height; i++) {
+            const value = (bytes[i >> 3] >> (7 - (i & 7))) & 1 ? 255 : 0;
+            pixels.data[i * 4] = value;
+            pixels.data[i * 4 + 1] = value;
+            pixels.data[i * 4 + 2] = value;
+            pixels.data[i * 4 + 3] = 255;
+        }
+        canvas.getContext('2d').putImageData(pixels, 0, 0);
+    }, [bitmask]);
+
+    return (
+        <canvas
+            ref={canvasRef}
+            width={bitmask.width}
+            height={bitmask.height}
+            className="w-full rounded-lg object-contain border border-gray-200"
+        />
+    );
+};
+
 export const ImageUpload = ({ onUploadComplete }) => {
     const [dragActive, setDragActive] = useState(false);
     const [files, setFiles] = useState([]);
@@ -16,8 +83,16 @@ export const ImageUpload = ({ onUploadComplete }) => {
     const [isAnnotating, setIsAnnotating] = useState(false);
     const [currentImage, setCurrentImage] = useState(null);
     const [annotation, setAnnotation] = useState(null);
+    // Off by default: the preview costs an extra low-resolution model pass per upload
+    const [fastPreview, setFastPreview] = useState(false);
     const canvasRef = useRef(null);
 
+    // Release an upload's object URL once a new preview replaces it, or when the component unmounts
+    useEffect(() => {
+        if (!preview) return undefined;
+        return () => URL.revokeObjectURL(preview);
+    }, [preview]);
+
     const validateMedicalImage = (file) => {
         // Check file type
         const extension = file.name.split('.').pop().toLowerCase();
@@ -75,6 +150,13 @@ export const ImageUpload = ({ onUploadComplete }) => {
                 if (file.type.startsWith('image/')) {
                     const formData = new FormData();
                     formData.append('file', file);
+                    // Draw the overlay here instead of downloading server-rendered PNGs
+                    formData.append('render', 'client');
+                    formData.append('include_original', '0');
+                    if (fastPreview) {
+                        // Stream a coarse low-resolution mask first, then the refined result
+                        formData.append('progressive', '1');
+                    }
 
                     // Call the actual API
                     const response = await fetch('http://127.0.0.1:5000/api/predict', {
@@ -83,24 +165,50 @@ export const ImageUpload = ({ onUploadComplete }) => {
                     });
 
                     if (!response.ok) {
-                        throw new Error('Failed to process image');
+                        const failure = await response.json().catch(() => ({}));
+                        throw new Error(failure.error || 'Failed to process image');
                     }
 
-                    const data = await response.json();
-
                     // Update the preview and analysis with real data
-                    setPreview(`data:image/png;base64,${data.original}`);
-                    setSelectedImage(`data:image/png;base64,${data.original}`);
-                    
-                    // Create analysis object from API response
-                    const analysis = {
-                        tumorProbability: data.tumor_percentage,
-                        originalImage: data.original,
-                        maskImage: data.mask,
-                        overlayImage: data.overlay
+                    const imageUrl = URL.createObjectURL(file);
+                    setPreview(imageUrl);
+                    setSelectedImage(imageUrl);
+
+                    const showResult = (data, refined) => {
+                        // Create analysis object from API response
+                        setAnalysis({
+                            tumorProbability: data.tumor_percentage,
+                            originalImage: imageUrl,
+                            imageSize: data.image_size,
+                            polygons: data.polygons,
+                            bitmask: data.bitmask,
+                            refined
+                        });
                     };
-                    
-                    setAnalysis(analysis);
+
+                    if (!fastPreview) {
+                        showResult(await response.json(), true);
+                        continue;
+                    }
+
+                    // Every line of the NDJSON response is one stage: 'coarse', then 'final' or 'error'
+                    const reader = response.body.getReader();
+                    const decoder = new TextDecoder();
+                    let buffered = '';
+                    for (;;) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+                        buffered += decoder.decode(value, { stream: true });
+                        const lines = buffered.split('\n');
+                        buffered = lines.pop();
+                        for (const line of lines.filter(l => l.trim())) {
+                            const data = JSON.parse(line);
+                            if (data.stage === 'error') {
+                                throw new Error(data.error || 'Failed to process image');
+                            }
+                            showResult(data, data.stage === 'final');
+                        }
+                    }
                 }
             }
 
@@ -229,6 +337,16 @@ export const ImageUpload = ({ onUploadComplete }) => {
                 </div>
             </div>
 
+            <label className="flex items-center text-sm text-gray-600">
+                <input
+                    type="checkbox"
+                    checked={fastPreview}
+                    onChange={(e) => setFastPreview(e.target.checked)}
+                    className="mr-2"
+                />
+                Show a fast low-resolution preview while the full analysis runs
+            </label>
+
             {error && (
                 <div className="p-4 bg-red-50 rounded-lg flex items-center text-red-700 animate-shake">
                     <AlertCircle className="h-5 w-5 mr-2 flex-shrink-0" />
@@ -246,13 +364,21 @@ export const ImageUpload = ({ onUploadComplete }) => {
             {selectedImage && analysis && (
                 <div className="mt-4 bg-gray-50 rounded-lg p-6 animate-fadeIn">
                     <div className="flex flex-col space-y-4">
-                        <h3 className="text-lg font-semibold text-gray-900">Medical Scan Analysis</h3>
+                        <div className="flex items-center justify-between">
+                            <h3 className="text-lg font-semibold text-gray-900">Medical Scan Analysis</h3>
+                            {!analysis.refined && (
+                                <span className="flex items-center text-sm text-blue-700">
+                                    <Loader2 className="h-4 w-4 mr-1 animate-spin" />
+                                    Preview, refining...
+                                </span>
+                            )}
+                        </div>
 
                         <div className="grid grid-cols-1 md:grid-cols-3 gap-4">
                             <div className="space-y-2">
                                 <h4 className="text-sm font-medium text-gray-700">Original Image</h4>
                                 <img
-                                    src={`data:image/png;base64,${analysis.originalImage}`}
+                                    src={analysis.originalImage}
                                     alt="Original MRI"
                                     className="w-full rounded-lg object-contain border border-gray-200"
                                 />
@@ -260,19 +386,15 @@ export const ImageUpload = ({ onUploadComplete }) => {
 
                             <div className="space-y-2">
                                 <h4 className="text-sm font-medium text-gray-700">Segmentation Mask</h4>
-                                <img
-                                    src={`data:image/png;base64,${analysis.maskImage}`}
-                                    alt="Segmentation Mask"
-                                    className="w-full rounded-lg object-contain border border-gray-200"
-                                />
+                                <BitmaskCanvas bitmask={analysis.bitmask} />
                             </div>
 
                             <div className="space-y-2">
                                 <h4 className="text-sm font-medium text-gray-700">Overlay</h4>
-                                <img
-                                    src={`data:image/png;base64,${analysis.overlayImage}`}
-                                    alt="Overlay"
-                                    className="w-full rounded-lg object-contain border border-gray-200"
+                                <OverlayCanvas
+                                    imageUrl={analysis.originalImage}
+                                    imageSize={analysis.imageSize}
+                                    polygons={analysis.polygons}
                                 />
                             </div>
                         </div>